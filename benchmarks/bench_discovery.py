@@ -0,0 +1,250 @@
+'''
+Timing and peak-memory benchmarks for build context discovery.
+
+Generates (or reuses) a synthetic workspace and measures discover_jobs,
+parse_manifests, discover_yamls and discover_manifests against it. Results
+can be saved as JSON and compared against a previous run to catch
+regressions before release:
+
+    python benchmarks/bench_discovery.py --json baseline.json
+    python benchmarks/bench_discovery.py --compare baseline.json
+'''
+import gc
+import sys
+import copy
+import json
+import time
+import logging
+import pathlib
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+
+from workspace import generate_workspace
+
+from pyatsimagebuilder import utils
+
+RELATIVE_PATH = '/pyats'
+
+
+def _manifest_files(workspace):
+    return utils.search_regex([utils.MANIFEST_REGEX], workspace)
+
+
+def bench_discover_jobs(workspace):
+    def setup():
+        return ()
+
+    def run():
+        return utils.discover_jobs(jobfiles={},
+                                   search_path=workspace,
+                                   relative_path=RELATIVE_PATH)
+
+    return setup, run
+
+
+def bench_parse_manifests(workspace):
+    manifests = _manifest_files(workspace)
+
+    def setup():
+        return ()
+
+    def run():
+        return utils.parse_manifests(manifests,
+                                     search_path=workspace,
+                                     relative_path=RELATIVE_PATH,
+                                     repo_data={})
+
+    return setup, run
+
+
+def bench_discover_yamls(workspace):
+    parsed = utils.parse_manifests(_manifest_files(workspace),
+                                   search_path=workspace,
+                                   relative_path=RELATIVE_PATH,
+                                   repo_data={})
+
+    def setup():
+        # discover_yamls enriches the manifests in place
+        return (copy.deepcopy(parsed), )
+
+    def run(jobs):
+        return utils.discover_yamls(jobs,
+                                    search_path=workspace,
+                                    relative_path=RELATIVE_PATH)
+
+    return setup, run
+
+
+def bench_discover_manifests(workspace):
+    def setup():
+        return ()
+
+    def run():
+        return utils.discover_manifests(search_path=workspace,
+                                        relative_path=RELATIVE_PATH,
+                                        repo_data={})
+
+    return setup, run
+
+
+BENCHMARKS = {
+    'discover_jobs': bench_discover_jobs,
+    'parse_manifests': bench_parse_manifests,
+    'discover_yamls': bench_discover_yamls,
+    'discover_manifests': bench_discover_manifests,
+}
+
+
+def measure(setup, run, repeat):
+    '''
+    returns wall time statistics over `repeat` runs and the peak traced
+    memory of one additional run
+
+    Memory is traced in this process only: with at least
+    utils.PROCESS_POOL_THRESHOLD manifests (--manifests), they are parsed in
+    worker processes whose memory is not part of the peak.
+    '''
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+        del args
+
+    # memory is measured separately, tracing slows down execution
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times),
+        'peak_memory': peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    returns list of regression messages against a baseline result file
+    '''
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        previous = baseline['benchmarks'].get(name)
+        if not previous:
+            continue
+        for key in ('median', 'peak_memory'):
+            if previous[key] and result[key] > previous[key] * threshold:
+                regressions.append(
+                    '%s %s regressed: %.4g -> %.4g (x%.2f)' %
+                    (name, key, previous[key], result[key],
+                     result[key] / previous[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark build context discovery')
+    parser.add_argument('--workspace',
+                        help='use an existing (or generate into this) '
+                        'workspace directory instead of a temporary one')
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--py-files', type=int, default=2000)
+    parser.add_argument('--manifests', type=int, default=200)
+    parser.add_argument('--profiles', type=int, default=5)
+    parser.add_argument('--testbeds', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only',
+                        action='append',
+                        choices=sorted(BENCHMARKS),
+                        help='only run the given benchmark(s)')
+    parser.add_argument('--json', metavar='FILE', help='save results')
+    parser.add_argument('--compare',
+                        metavar='FILE',
+                        help='compare against previously saved results and '
+                        'exit with an error on regression')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=1.25,
+                        help='allowed slowdown/growth ratio for --compare')
+    args = parser.parse_args(argv)
+
+    # discovery functions log at info level for every call
+    utils.logger.setLevel(logging.WARNING)
+
+    tempdir = None
+    if args.workspace:
+        workspace = args.workspace
+    else:
+        tempdir = tempfile.TemporaryDirectory(prefix='pyats-image-bench.')
+        workspace = tempdir.name
+
+    params = {
+        'repos': args.repos,
+        'py_files': args.py_files,
+        'manifests': args.manifests,
+        'profiles': args.profiles,
+        'testbeds': args.testbeds,
+        'devices': args.devices,
+    }
+
+    try:
+        workspace = pathlib.Path(workspace)
+        if not workspace.exists() or not any(workspace.iterdir()):
+            print('Generating workspace in %s' % workspace)
+            start = time.perf_counter()
+            generate_workspace(workspace, **params)
+            print('Generated in %.2fs' % (time.perf_counter() - start))
+
+        results = {
+            'python': platform.python_version(),
+            'params': params,
+            'repeat': args.repeat,
+            'benchmarks': {},
+        }
+
+        print('%-20s %10s %10s %10s %12s' %
+              ('benchmark', 'min (s)', 'median (s)', 'max (s)', 'peak (MiB)'))
+        for name in sorted(args.only or BENCHMARKS):
+            setup, run = BENCHMARKS[name](workspace)
+            result = measure(setup, run, args.repeat)
+            results['benchmarks'][name] = result
+            print('%-20s %10.4f %10.4f %10.4f %12.2f' %
+                  (name, result['min'], result['median'], result['max'],
+                   result['peak_memory'] / 2**20))
+
+        if args.manifests >= utils.PROCESS_POOL_THRESHOLD:
+            print('Manifests are parsed in worker processes, the peak memory '
+                  'of parsing them is not measured')
+    finally:
+        if tempdir:
+            tempdir.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(regression)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+'''
+Start up time budget of the command line entry points.
+
+Imports each entry point module in a fresh interpreter with
+`python -X importtime` and fails when the median import time goes over the
+budget, or when showing `--help` imports one of the heavy dependencies
+(docker, requests, git, yaml, jinja2, jsonschema), which are only to be
+imported at first use:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --budget 100 --json startup.json
+'''
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+import importlib.util
+
+from pyatsimagebuilder.utils import IMPORTTIME_REGEX
+
+ENTRY_POINTS = [
+    'pyatsimagebuilder.main',
+    'pyatsimagebuilder.server',
+    'pyatsimagebuilder.snapshot',
+]
+
+# `pyats image` lists its subcommands through this one, when pyats is there
+PYATS_ENTRY_POINT = 'pyatsimagebuilder.commands'
+
+HEAVY_MODULES = ['docker', 'requests', 'git', 'yaml', 'jinja2', 'jsonschema']
+
+# milliseconds
+DEFAULT_BUDGET = 200
+
+HELP_SCRIPT = '''
+import sys
+import %(module)s as entry_point
+try:
+    entry_point.main(['--help'])
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(m for m in %(heavy)r if m in sys.modules))
+'''
+
+
+def import_time(module):
+    '''
+    returns the time (s) importing module takes in a new interpreter, as
+    reported by `python -X importtime`
+    '''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True)
+
+    # the package is imported first and may import the module itself, add
+    # up the top level imports of the package and its modules
+    package = module.split('.')[0]
+    total = None
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if match and not match.group('indent') and \
+                match.group('module').split('.')[0] == package:
+            total = (total or 0) + int(match.group('cumulative'))
+
+    if total is None:
+        raise Exception('No import time reported for %s' % module)
+    return total / 1e6
+
+
+def heavy_imports(module):
+    '''
+    returns the heavy dependencies imported by showing the `--help` of the
+    entry point module
+    '''
+    if module == PYATS_ENTRY_POINT:
+        # listing the subcommands is what `pyats image --help` does
+        script = HELP_SCRIPT.replace(
+            'entry_point.main', 'entry_point.ImageCommand("pyats image").main')
+    else:
+        script = HELP_SCRIPT
+    result = subprocess.run(
+        [sys.executable, '-c', script % {'module': module,
+                                         'heavy': HEAVY_MODULES}],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True)
+    return result.stderr.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the start up time of the command line entry '
+        'points against a budget')
+    parser.add_argument('--budget',
+                        type=float,
+                        default=DEFAULT_BUDGET,
+                        help='allowed median import time of each entry point '
+                        'in milliseconds (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', metavar='FILE', help='save results')
+    args = parser.parse_args(argv)
+
+    entry_points = list(ENTRY_POINTS)
+    if importlib.util.find_spec('pyats'):
+        entry_points.append(PYATS_ENTRY_POINT)
+
+    results = {
+        'python': platform.python_version(),
+        'budget': args.budget / 1000,
+        'repeat': args.repeat,
+        'benchmarks': {},
+    }
+
+    failures = []
+    print('%-30s %10s %10s %10s  %s' %
+          ('entry point', 'min (s)', 'median (s)', 'max (s)', 'heavy imports'))
+    for module in entry_points:
+        times = [import_time(module) for _ in range(args.repeat)]
+        heavy = heavy_imports(module)
+        result = {
+            'min': min(times),
+            'median': statistics.median(times),
+            'max': max(times),
+            'heavy_imports': heavy,
+        }
+        results['benchmarks'][module] = result
+        print('%-30s %10.4f %10.4f %10.4f  %s' %
+              (module, result['min'], result['median'], result['max'],
+               ', '.join(heavy) or '-'))
+
+        if result['median'] * 1000 > args.budget:
+            failures.append('%s imports in %.0f ms, over the budget of '
+                            '%.0f ms' % (module, result['median'] * 1000,
+                                         args.budget))
+        if heavy:
+            failures.append('%s --help imports %s' % (module,
+                                                      ', '.join(heavy)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    for failure in failures:
+        print(failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+'''
+Synthetic build context generator used by the discovery benchmarks.
+
+Creates a directory laid out like a populated docker build context: a number
+of git repositories containing python files (some of them pyATS jobfiles),
+`.tem` manifest files with profiles, and testbed YAML files with many devices
+referenced from those manifests.
+'''
+import os
+import random
+import pathlib
+import argparse
+import subprocess
+
+JOBFILE_TEMPLATE = '''"""
+{name}
+<PYATS_JOBFILE>
+
+Synthetic benchmark jobfile.
+"""
+from pyats.easypy import run
+
+
+def main(runtime):
+    run(testscript='{name}', runtime=runtime)
+'''
+
+MODULE_TEMPLATE = '''"""
+{name}
+
+Synthetic benchmark module.
+"""
+import os
+
+
+def func_{index}(arg):
+    return os.path.join(str(arg), '{name}')
+'''
+
+MANIFEST_TEMPLATE = '''version: 1
+type: easypy
+tags:
+  - synthetic
+arguments:
+  testbed-file: {testbed}
+  clean-file: {clean}
+runtimes:
+  system:
+    source: system
+    environment:
+      BENCH: "1"
+profiles:
+{profiles}'''
+
+PROFILE_TEMPLATE = '''  profile{index}:
+    tags:
+      - profile{index}
+    arguments:
+      testbed-file: {testbed}
+'''
+
+DEVICE_TEMPLATE = '''  dev{index}:
+    os: iosxe
+    platform: cat9k
+    type: router
+    connections:
+      a:
+        protocol: telnet
+        ip: 10.{a}.{b}.{c}
+        port: {port}
+'''
+
+CLEAN_TEMPLATE = '''bringup:
+  BringUpWorker:
+    module: synthetic.bringup
+'''
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def _testbed(devices):
+    lines = ['testbed:\n  name: synthetic\n', 'devices:\n']
+    for i in range(devices):
+        lines.append(DEVICE_TEMPLATE.format(index=i,
+                                            a=(i >> 16) & 255,
+                                            b=(i >> 8) & 255,
+                                            c=i & 255,
+                                            port=2000 + i % 1000))
+    return ''.join(lines)
+
+
+def generate_workspace(path,
+                       repos=10,
+                       py_files=2000,
+                       jobfile_ratio=0.05,
+                       manifests=200,
+                       profiles=5,
+                       testbeds=4,
+                       devices=500,
+                       depth=3,
+                       git=True,
+                       seed=0):
+    '''
+    Generate a synthetic build context at `path`
+
+    Arguments:
+        path (str): directory to generate the workspace in
+        repos (int): number of repositories
+        py_files (int): total number of python files across all repos
+        jobfile_ratio (float): fraction of python files that are jobfiles
+        manifests (int): total number of .tem manifest files
+        profiles (int): number of profiles per manifest
+        testbeds (int): number of testbed YAML files per repository
+        devices (int): number of devices per testbed YAML file
+        depth (int): directory nesting depth within each repository
+        git (bool): initialize each repository as a git repository
+        seed (int): random seed so the layout is reproducible
+
+    Returns:
+        pathlib.Path of the generated workspace
+    '''
+    rng = random.Random(seed)
+    path = pathlib.Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    testbed_content = _testbed(devices)
+
+    for r in range(repos):
+        repo = path / ('repo%s' % r)
+
+        # shared testbed and clean files for this repo
+        for t in range(testbeds):
+            _write(repo / 'testbeds' / ('testbed%s.yaml' % t),
+                   testbed_content)
+        _write(repo / 'testbeds' / 'clean.yaml', CLEAN_TEMPLATE)
+
+        def subdir():
+            parts = ['pkg%s' % rng.randrange(10)
+                     for _ in range(rng.randrange(depth + 1))]
+            return repo.joinpath(*parts)
+
+        # python files, a fraction of them being jobfiles
+        for i in range(r, py_files, repos):
+            name = 'module_%s.py' % i
+            if rng.random() < jobfile_ratio:
+                _write(subdir() / name, JOBFILE_TEMPLATE.format(name=name))
+            else:
+                _write(subdir() / name,
+                       MODULE_TEMPLATE.format(name=name, index=i))
+
+        # manifests referencing testbeds relative to the repo root
+        for i in range(r, manifests, repos):
+            folder = subdir()
+            to_root = os.path.relpath(repo, folder)
+            testbed = os.path.join(to_root, 'testbeds',
+                                   'testbed%s.yaml' % rng.randrange(testbeds))
+            clean = os.path.join(to_root, 'testbeds', 'clean.yaml')
+            profile_content = ''.join(
+                PROFILE_TEMPLATE.format(
+                    index=p,
+                    testbed=os.path.join(
+                        to_root, 'testbeds',
+                        'testbed%s.yaml' % rng.randrange(testbeds)))
+                for p in range(profiles))
+            _write(folder / ('manifest_%s.tem' % i),
+                   MANIFEST_TEMPLATE.format(testbed=testbed,
+                                            clean=clean,
+                                            profiles=profile_content))
+
+        if git:
+            env = dict(os.environ,
+                       GIT_AUTHOR_NAME='bench',
+                       GIT_AUTHOR_EMAIL='bench@localhost',
+                       GIT_COMMITTER_NAME='bench',
+                       GIT_COMMITTER_EMAIL='bench@localhost')
+            for cmd in (['git', 'init', '-q'],
+                        ['git', 'add', '-A'],
+                        ['git', 'commit', '-q', '-m', 'synthetic']):
+                subprocess.check_call(cmd, cwd=str(repo), env=env)
+
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic pyATS image build context')
+    parser.add_argument('path', help='directory to generate into')
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--py-files', type=int, default=2000)
+    parser.add_argument('--jobfile-ratio', type=float, default=0.05)
+    parser.add_argument('--manifests', type=int, default=200)
+    parser.add_argument('--profiles', type=int, default=5)
+    parser.add_argument('--testbeds', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--no-git', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    generate_workspace(args.path,
+                       repos=args.repos,
+                       py_files=args.py_files,
+                       jobfile_ratio=args.jobfile_ratio,
+                       manifests=args.manifests,
+                       profiles=args.profiles,
+                       testbeds=args.testbeds,
+                       devices=args.devices,
+                       git=not args.no_git,
+                       seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -109,6 +109,8 @@ setup(
     entry_points={
         'console_scripts': [
             'pyats-image-build = pyatsimagebuilder.main:main',
+            'pyats-image-serve = pyatsimagebuilder.server:main',
+            'pyats-image-snapshot = pyatsimagebuilder.snapshot:main',
             'pyats-image-build-askpass = pyatsimagebuilder.askpass:main'],
         'pyats.cli.commands': [
             'image = pyatsimagebuilder.commands:ImageCommand'],
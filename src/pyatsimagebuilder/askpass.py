@@ -4,11 +4,45 @@
 # Requires GIT_USERNAME and GIT_PASSWORD environment variables,
 # intended to be called by Git via GIT_ASKPASS.
 #
+# With GIT_CREDENTIALS_URL set, credentials are only given for prompts
+# about that scheme, host and port, so submodules hosted elsewhere do not
+# receive them.
+#
 
+import re
 from sys import argv
 from os import environ
+from urllib.parse import urlsplit
+
+# Username for 'https://host': / Password for 'https://user@host':
+PROMPT_URL = re.compile(r"'(?P<url>[^']+)'")
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    return (parts.scheme.lower(), (parts.hostname or '').lower(),
+            parts.port or {'http': 80, 'https': 443}.get(parts.scheme.lower()))
+
+
+def allowed(prompt):
+    if not environ.get('GIT_CREDENTIALS_URL'):
+        return True
+
+    match = PROMPT_URL.search(prompt)
+    if not match:
+        return False
+
+    try:
+        return _origin(match.group('url')) == \
+            _origin(environ['GIT_CREDENTIALS_URL'])
+    except ValueError:
+        return False
+
 
 def main():
+    if len(argv) < 2 or not allowed(argv[1]):
+        exit(1)
+
     if 'username' in argv[1].lower():
         print(environ['GIT_USERNAME'])
         exit()
@@ -20,4 +54,4 @@ def main():
     exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
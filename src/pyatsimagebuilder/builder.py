@@ -1,21 +1,40 @@
+import io
 import os
 import re
-import yaml
 import json
-import docker
 import logging
+import shutil
 import pathlib
-import requests
+import tarfile
+import threading
 import configparser
 import urllib.parse
 
 from .utils import (scp, git_clone, ftp_retrieve, stringify_config_lists,
-                    discover_jobs, discover_manifests, to_image_path,
-                    search_regex)
+                    discover_jobs, find_manifests, iter_manifests,
+                    discover_repository, write_manifest_json, to_image_path,
+                    search_regex, run_async, requests_proxies,
+                    parse_importtime, MANIFEST_PARSER_VERSION,
+                    DISCOVERY_VERSION)
 
 from .image import Image
 from .schema import validate_builder_schema
 from .context import Context
+from .timings import Timings
+from .buildsteps import BuildSteps
+from .cache import (DEFAULT_CACHE_DIR, ManifestCache, DiscoveryCache,
+                    hash_key)
+from .fingerprint import context_fingerprint, file_digest, FINGERPRINT_LABEL
+from .dedup import dedup_tree
+from .remote import DeltaContext
+from .fetch import FetchScheduler
+from .download import ResumableDownload, DEFAULT_SPLIT_SIZE
+from .snapshot import resolve_repositories, resolve_packages, FULL_SHA
+from .plan import probe_files, layer_cache
+from .lazy import lazy_import
+
+yaml = lazy_import('yaml')
+docker = lazy_import('docker')
 
 HERE = pathlib.Path(os.path.dirname(__file__))
 
@@ -23,35 +42,82 @@ PIP_CONF_FILE = 'pip.conf'
 INSTALLATION = pathlib.Path('installation')
 REQUIREMENTS = pathlib.Path('requirements')
 REQUIREMENTS_FILE = 'requirements.txt'
+TIMINGS_FILE = 'build-timings.json'
 ENV_PATTERN = re.compile(r'(%ENV{ *([0-9a-zA-Z\_]+) *})')
 IMAGE_BUILD_SUCCESSUL = \
     re.compile(r' *Successfully built (?P<image_id>[a-z0-9]{12}) *$')
 
+FETCH_SCHEMES = {
+    'https': 'http',
+    'ftps': 'ftp',
+}
+
+# fingerprints of the builds running in this process, so identical builds
+# requested at the same time only run once
+_builds_lock = threading.Lock()
+_builds_in_progress = {}
+
 
 class ImageBuilder(object):
-    def __init__(self, config, logger=logging.getLogger(__name__)):
+    def __init__(self,
+                 config,
+                 logger=logging.getLogger(__name__),
+                 cache_dir=DEFAULT_CACHE_DIR,
+                 docker_api=None):
         """
         Arguments
         ---------
             config (dict): Build configuration
             logger (logging.Logger): python logger to use for this build
+            cache_dir (str): directory for caches persisted between builds,
+                             None disables them
+            docker_api (docker.APIClient): docker api client to reuse,
+                                           a new one is created by default
         """
 
         self._logger = logger
+        self._docker_api = docker_api
         self._req_counter = 0
 
+        # caches persisted between builds
+        self.cache_dir = cache_dir
+        self._manifest_cache = None
+        self._discovery_cache = None
+        if cache_dir:
+            self._manifest_cache = ManifestCache(cache_dir,
+                                                 MANIFEST_PARSER_VERSION)
+            self._discovery_cache = DiscoveryCache(
+                cache_dir, '%s.%s' % (DISCOVERY_VERSION,
+                                      MANIFEST_PARSER_VERSION))
+
         # init defaults
         self.context = None
+        self.timings = None
         self._docker_build_args = {}
+        self._file_targets = []
+        self._local_files = []
+        self._repo_list = []
+        self._repository_records = {}
+        self._pristine_repositories = {}
+        self._proxy_env = {}
+        self._fetch_scheduler = None
 
         # Verify schema
         self._logger.info('Verifying schema')
         validate_builder_schema(config)
 
         self.config = config
-        self.image = Image()
-
-    def run(self, keep_context=False, tag=None, no_cache=True, dry_run=False):
+        self.image = Image(logger=self._logger)
+
+    def run(self,
+            keep_context=False,
+            tag=None,
+            no_cache=True,
+            dry_run=False,
+            timings_file=None,
+            reuse_unchanged=False,
+            dedup=False,
+            delta_context=False):
         """
         Arguments
         ---------
@@ -63,6 +129,17 @@ class ImageBuilder(object):
             no_cache (bool): Forces the rebuilding of intermediate docker image
                              layers
             dry_run (bool): Set up docker build context but do not run build
+            timings_file (str): Additional file to write the build timing
+                                report to
+            reuse_unchanged (bool): Do not build when an image built from
+                                    the same inputs exists locally or under
+                                    the tag in the registry, tag and return
+                                    that image instead
+            dedup (bool): Replace files with identical content in the
+                          context by hard links before building
+            delta_context (bool): Only send file content the docker daemon
+                                  has not received for a previous build,
+                                  through a helper container on the daemon
 
         Returns
         -------
@@ -70,47 +147,529 @@ class ImageBuilder(object):
         """
         # create context obj
         self.context = Context(keep=keep_context, logger=self._logger)
+        self.timings = Timings()
 
         with self.context:
+            try:
+                with self.timings.span('run'):
+                    self._run(tag=tag,
+                              no_cache=no_cache,
+                              dry_run=dry_run,
+                              reuse_unchanged=reuse_unchanged,
+                              dedup=dedup,
+                              delta_context=delta_context)
+            finally:
+                # written after the build so the report never invalidates
+                # the docker layer cache
+                self._write_timings(timings_file)
+
+        return self.image
+
+    def snapshot(self, packages=True):
+        """
+        Resolve the inputs of this build that change over time: the
+        branches and tags (or HEAD) of its repositories to commits, and the
+        python packages it installs to exact versions
 
-            # create our installation directory
+        Use the result as the `snapshot` of the build file, so later builds
+        install exactly the same. A `snapshot` the build file already uses is
+        left out, it is what gets replaced.
+
+        Arguments
+        ---------
+            packages (bool): also resolve python packages. The context is
+                             populated (with the repositories at the resolved
+                             commits) and pip's resolver is run in the base
+                             image, which requires docker.
+
+        Returns
+        -------
+            dict of `repositories` (name to url and commit_id) and
+            `packages` (list of name==version)
+        """
+        self._replace_environment_variables()
+        self.config.pop('snapshot', None)
+        if 'proxy' in self.config:
+            self._process_proxy(self.config['proxy'])
+
+        repositories = self.config.get('repositories', {})
+        resolved = resolve_repositories(repositories,
+                                        env=self._proxy_env,
+                                        logger=self._logger)
+        snapshot = {'repositories': resolved}
+        if not packages:
+            return snapshot
+
+        # requirements of the repositories at the resolved commits
+        for name, vals in repositories.items():
+            vals['commit_id'] = resolved[name]['commit_id']
+
+        self.context = Context(logger=self._logger)
+        self.timings = Timings()
+        with self.context:
             self.context.mkdir(INSTALLATION)
             self.context.mkdir(INSTALLATION / REQUIREMENTS)
+            self._populate_context()
+            self.image.platform = self.config.get('platform', None)
+
+            api = self._docker_api or docker.from_env().api
+            try:
+                snapshot['packages'] = resolve_packages(
+                    api,
+                    self.image,
+                    self.context.path,
+                    env=self._proxy_env,
+                    logger=self._logger)
+            finally:
+                if api is not self._docker_api:
+                    api.close()
+
+        return snapshot
+
+    def plan(self):
+        """
+        Estimate the work of a build without fetching anything: resolve the
+        commits of the repositories with `git ls-remote`, ask the size and
+        last modification of downloads with HEAD requests, and check which
+        repository discoveries and docker layers are likely cached
+
+        Returns
+        -------
+            dict of the `repositories` to clone, the `files` to fetch (with
+            their size when known), the bytes to `download` and `copy`, the
+            number of inputs of `unknown` size, the `base_image` and the
+            state of the docker `layers` (None without docker)
+        """
+        self._replace_environment_variables()
+
+        if 'python' in self.config:
+            self._process_python(self.config['python'])
+
+        if 'proxy' in self.config:
+            self._process_proxy(self.config['proxy'])
 
+        snapshot = {}
+        if 'snapshot' in self.config:
+            snapshot = self._load_snapshot(self.config['snapshot'])
+
+        # repositories as they would be cloned
+        snapshot_repos, config_repos, pinned = \
+            self._split_repositories(snapshot)
+        repositories = dict(snapshot_repos)
+        for name, vals in config_repos.items():
+            repositories[name] = dict(vals, commit_id=pinned.get(name) or
+                                      vals.get('commit_id'))
+
+        resolved = resolve_repositories(repositories,
+                                        env=self._proxy_env,
+                                        logger=self._logger)
+
+        files = []
+        for from_path in self.config.get('files', []):
+            name, from_path, url_parts = self._parse_file_entry(from_path)
+            files.append({'name': name,
+                          'source': from_path,
+                          'scheme': url_parts.scheme or 'local'})
+
+        partial_dir = None
+        if self.cache_dir:
+            partial_dir = pathlib.Path(self.cache_dir).expanduser() / \
+                'downloads'
+        probe_files(files,
+                    proxies=lambda url: requests_proxies(url,
+                                                         self._proxy_env),
+                    partial_dir=partial_dir,
+                    logger=self._logger)
+
+        targets = [pathlib.Path(name) for name in repositories] + \
+            [pathlib.Path(item['name']) for item in files]
+        jobfiles = dict(self.config.get('jobfiles', {}))
+        jobfiles.pop('paths', None)
+
+        plan_repositories = []
+        for name, vals in repositories.items():
+            commit = resolved[name]['commit_id']
+            # discovery is only cached for repositories cloned as they are,
+            # at a known commit
+            cached = bool(
+                self._discovery_cache and FULL_SHA.match(commit) and
+                not vals.get('submodules') and
+                not any(pathlib.Path(name) in target.parents
+                        for target in targets) and
+                self._discovery_cache.get(self._discovery_key(
+                    vals['url'], commit, jobfiles,
+                    pathlib.PurePath(name).as_posix())) is not None)
+            plan_repositories.append({'name': name,
+                                      'url': vals['url'],
+                                      'ref': vals.get('commit_id'),
+                                      'commit': commit,
+                                      'discovery_cached': cached})
+
+        base_image = '%s:%s' % (self.image.base_image,
+                                self.image.base_image_label)
+        try:
+            api = self._docker_api or docker.from_env().api
+        except docker.errors.DockerException as e:
+            self._logger.debug('Cannot check the docker layer cache: %s' % e)
+            layers = None
+        else:
+            try:
+                layers = layer_cache(api, base_image)
+            except docker.errors.DockerException as e:
+                self._logger.debug('Cannot check the docker layer cache: '
+                                   '%s' % e)
+                layers = None
+            finally:
+                if api is not self._docker_api:
+                    api.close()
+
+        remote = [item for item in files if item['scheme'] != 'local']
+        return {
+            'repositories': plan_repositories,
+            'files': files,
+            'download': sum(item['size'] - item.get('resumable', 0)
+                            for item in remote if item['size'] is not None),
+            'copy': sum(item['size'] for item in files
+                        if item['scheme'] == 'local' and
+                        item['size'] is not None),
+            'unknown': sum(1 for item in files if item['size'] is None),
+            'base_image': base_image,
+            'layers': layers,
+        }
+
+    def log_plan(self, plan):
+        """
+        Log a plan returned by plan()
+
+        Arguments
+        ---------
+            plan (dict): plan to log
+        """
+        repositories = plan['repositories']
+        self._logger.info('Repositories to clone: %s' % len(repositories))
+        for repo in repositories:
+            message = '  %s: %s at %s' % (repo['name'], repo['url'],
+                                          repo['commit'])
+            if repo['ref'] and repo['ref'] != repo['commit']:
+                message += ' (%s)' % repo['ref']
+            if repo['discovery_cached']:
+                message += ', discovery cached'
+            self._logger.info(message)
+
+        self._logger.info('Files to fetch: %s' % len(plan['files']))
+        for item in plan['files']:
+            message = '  %s: %s' % (item['source'],
+                                    'size unknown' if item['size'] is None
+                                    else _format_size(item['size']))
+            if item.get('resumable'):
+                message += ', %s resumable' % _format_size(item['resumable'])
+            if item.get('last_modified'):
+                message += ', modified %s' % item['last_modified']
+            if item.get('error'):
+                message += ' (%s)' % item['error']
+            self._logger.info(message)
+
+        message = 'Expected download: %s' % _format_size(plan['download'])
+        if plan['unknown']:
+            message += ', and %s input(s) of unknown size' % plan['unknown']
+        self._logger.info(message)
+        self._logger.info('Expected local copy: %s' %
+                          _format_size(plan['copy']))
+        self._logger.info('Repository discoveries cached: %s of %s' %
+                          (sum(1 for repo in repositories
+                               if repo['discovery_cached']),
+                           len(repositories)))
+
+        layers = plan['layers']
+        if layers is None:
+            self._logger.info('Docker layer cache: unknown, docker is not '
+                              'available')
+        elif not layers['base_image']:
+            self._logger.info('Docker layer cache: %s is not present and '
+                              'would be pulled' % plan['base_image'])
+        elif layers['builds']:
+            self._logger.info('Docker layer cache: %s is present, setup '
+                              'layers likely cached (%s previous build(s) '
+                              'on it)' % (plan['base_image'],
+                                          layers['builds']))
+        else:
+            self._logger.info('Docker layer cache: %s is present, no '
+                              'previous build on it' % plan['base_image'])
+
+    def _run(self, tag, no_cache, dry_run, reuse_unchanged, dedup,
+             delta_context):
+
+        # create our installation directory
+        self.context.mkdir(INSTALLATION)
+        self.context.mkdir(INSTALLATION / REQUIREMENTS)
+
+        with self.timings.span('populate_context'):
             self._populate_context()
 
-            # Tag for docker image   argument (cli) > config (yaml) > None
-            self.image.tag = tag or self.config.get('tag', None)
+        if dedup:
+            self._dedup_context()
 
-            # Get Arch for image
-            self.image.platform = self.config.get('platform', None)
+        # Tag for docker image   argument (cli) > config (yaml) > None
+        self.image.tag = tag or self.config.get('tag', None)
+
+        # Get Arch for image
+        self.image.platform = self.config.get('platform', None)
+
+        self._fingerprint_and_build(no_cache=no_cache,
+                                    dry_run=dry_run,
+                                    reuse_unchanged=reuse_unchanged,
+                                    delta_context=delta_context)
+
+    def rebuild(self,
+                changes,
+                no_cache=False,
+                dry_run=False,
+                timings_file=None,
+                dedup=False,
+                delta_context=False):
+        """
+        Apply changed local `files` inputs to the context kept by a previous
+        run() and build again
+
+        Only the changed files are copied (or removed), the installation
+        metadata (jobfiles, manifests) is discovered again and the image is
+        rebuilt, unless the build inputs did not change at all.
+
+        Arguments
+        ---------
+            changes (list): changed/created/removed local paths, within the
+                            sources of `files` entries
+            no_cache, dry_run, timings_file, dedup, delta_context: see run()
 
-            # Start docker build
-            if not dry_run:
-                self._logger.info('Building image')
-                self._build_image(no_cache=no_cache)
-                self._logger.info("Built image '%s' successfully" %
-                                  tag if tag else self.image.id)
+        Returns
+        -------
+            Image object when successful
+        """
+        if not self.context or not self.context.path:
+            raise Exception('Nothing to rebuild, run() with keep_context '
+                            'first')
+
+        previous = self.image.fingerprint
+        self.timings = Timings()
+        try:
+            with self.timings.span('run'):
+                with self.timings.span('apply_changes', count=len(changes)):
+                    applied = self._apply_changes(changes)
+                self._logger.info('Applied %s change(s) to the context' %
+                                  applied)
+
+                with self.timings.span('populate_context'):
+                    self._discover_context()
+
+                if dedup:
+                    self._dedup_context()
+
+                # the report of the previous build would change the context
+                timings = self.context.path / INSTALLATION / TIMINGS_FILE
+                if timings.exists():
+                    timings.unlink()
+
+                self._fingerprint_and_build(no_cache=no_cache,
+                                            dry_run=dry_run,
+                                            skip_fingerprint=previous,
+                                            delta_context=delta_context)
+        finally:
+            self._write_timings(timings_file)
 
         return self.image
 
+    def _fingerprint_and_build(self,
+                               no_cache,
+                               dry_run,
+                               reuse_unchanged=False,
+                               delta_context=False,
+                               skip_fingerprint=None):
+        with self.timings.span('fingerprint') as fingerprint_span:
+            self.image.fingerprint = self._fingerprint()
+            fingerprint_span['fingerprint'] = self.image.fingerprint
+        self._logger.info('Build input fingerprint: %s' %
+                          self.image.fingerprint)
+
+        if skip_fingerprint and self.image.fingerprint == skip_fingerprint:
+            self._logger.info('Build inputs did not change, not building')
+            return
+
+        # Start docker build
+        if not dry_run:
+            with self.timings.span('build_image'):
+                self._build_once(no_cache=no_cache,
+                                 reuse_unchanged=reuse_unchanged,
+                                 delta_context=delta_context)
+
+    @property
+    def local_files(self):
+        '''
+        (source, target) paths of the `files` entries copied from the local
+        file system
+        '''
+        return list(self._local_files)
+
+    def _apply_changes(self, changes):
+        # copy changed local sources into the context, remove deleted ones.
+        # Targets are always replaced and never written to in place, they
+        # may be hard links shared with other files after deduplication.
+        applied = 0
+        for change in sorted(set(pathlib.Path(c) for c in changes)):
+            for source, target in self._local_files:
+                if change == source:
+                    to_path = target
+                elif source in change.parents:
+                    to_path = target / change.relative_to(source)
+                else:
+                    continue
+
+                if to_path.is_dir() and not to_path.is_symlink():
+                    if not change.is_dir():
+                        shutil.rmtree(str(to_path))
+                elif to_path.exists() or to_path.is_symlink():
+                    to_path.unlink()
+
+                if change.is_symlink():
+                    to_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.symlink(os.readlink(str(change)), str(to_path))
+                elif change.is_dir():
+                    # contents of new directories may not be reported
+                    # individually
+                    if not to_path.exists():
+                        shutil.copytree(str(change), str(to_path),
+                                        symlinks=True)
+                elif change.exists():
+                    to_path.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy(str(change), str(to_path))
+
+                self._logger.debug('Updated %s' % to_path)
+                applied += 1
+                break
+
+        return applied
+
+    def _dedup_context(self):
+        # installation files are still written to after this point, links
+        # would change every copy at once
+        with self.timings.span('dedup') as dedup_span:
+            result = dedup_tree(self.context.path, exclude=[INSTALLATION])
+            dedup_span.update(result._asdict())
+
+        self._logger.info('Deduplicated context: %s of %s files replaced by '
+                          'links, %s saved' %
+                          (result.linked, result.files,
+                           _format_size(result.bytes_saved)))
+
+    def _fingerprint(self):
+        # fingerprint of everything the image is built from
+        inputs = {
+            'base_image': self.image.base_image,
+            'base_image_label': self.image.base_image_label,
+            'platform': self.image.platform,
+            'build_args': self._docker_build_args,
+            'entrypoint': file_digest(HERE / 'docker-entrypoint.sh'),
+        }
+        repositories = {
+            repo_dir.relative_to(self.context.path): info
+            for repo_dir, info in self._pristine_repositories.items()
+        }
+        return context_fingerprint(self.context.path,
+                                   inputs=inputs,
+                                   repositories=repositories,
+                                   exclude=[INSTALLATION / TIMINGS_FILE])
+
+    def _build_once(self, no_cache=False, reuse_unchanged=False,
+                    delta_context=False):
+        # Build the image, unless an identical build is already running in
+        # this process: then wait for it and use its image
+        fingerprint = self.image.fingerprint
+        while True:
+            with _builds_lock:
+                event = _builds_in_progress.get(fingerprint)
+                if event is None:
+                    event = _builds_in_progress[fingerprint] = \
+                        threading.Event()
+                    break
+
+            self._logger.info('Waiting for an identical build in progress')
+            event.wait()
+            if self._reuse_image(pull=False):
+                return
+            # the other build failed, try building it here
+
+        try:
+            if reuse_unchanged and self._reuse_image():
+                return
+
+            self._logger.info('Building image')
+            self._build_image(no_cache=no_cache, delta_context=delta_context)
+            self._logger.info("Built image '%s' successfully" %
+                              (self.image.tag or self.image.id))
+        finally:
+            with _builds_lock:
+                del _builds_in_progress[fingerprint]
+            event.set()
+
+    def _reuse_image(self, pull=True):
+        # Look for an image built from the same inputs, locally or under the
+        # image tag in the registry. Tags and uses it when found.
+        api = self._docker_api or docker.from_env().api
+        label = '%s=%s' % (FINGERPRINT_LABEL, self.image.fingerprint)
+        try:
+            images = api.images(filters={'label': label})
+
+            if not images and pull and self.image.tag:
+                repository, tag = \
+                    docker.utils.parse_repository_tag(self.image.tag)
+                try:
+                    self._logger.info("Checking registry image '%s'" %
+                                      self.image.tag)
+                    api.pull(repository, tag=tag or 'latest',
+                             platform=self.image.platform)
+                except docker.errors.APIError:
+                    # nothing under this tag in the registry
+                    pass
+                else:
+                    images = api.images(filters={'label': label})
+
+            if not images:
+                return False
+
+            # newest image first
+            image = max(images, key=lambda i: i.get('Created', 0))
+            self.image.id = image['Id']
+
+            if self.image.tag:
+                repository, tag = \
+                    docker.utils.parse_repository_tag(self.image.tag)
+                api.tag(self.image.id, repository, tag=tag)
+        finally:
+            if api is not self._docker_api:
+                api.close()
+
+        self._logger.info("Inputs unchanged, reusing image '%s' (%s)" %
+                          (self.image.tag or self.image.id, self.image.id))
+        return True
+
+    def _write_timings(self, timings_file=None):
+        if (self.context.path / INSTALLATION).exists():
+            self.context.write_file(INSTALLATION / TIMINGS_FILE,
+                                    self.timings.to_json())
+
+            self._logger.info('Build timings written to: %s' %
+                              (INSTALLATION / TIMINGS_FILE))
+
+        if timings_file:
+            self.timings.write(timings_file)
+            self._logger.info('Build timings written to: %s' % timings_file)
+
     def _populate_context(self):
 
         # replace config with environment variables
         self._replace_environment_variables()
 
         if 'python' in self.config:
-            # user specified python version/label
-
-            # Ensure python version is a valid format to use as the base
-            # docker image. Appends '-slim' to the given version to acquire
-            # the docker image tag.
-            label = str(self.config['python'])
-            if not all([n.isdigit() for n in label.split('.')]):
-                raise TypeError('Python version must be in format '
-                                '3[.X][.X]')
-
-            self.image.base_image_label = label + '-slim'
+            self._process_python(self.config['python'])
 
         # Formatted environment variable to add to Dockerfile
         if 'env' in self.config:
@@ -120,6 +679,15 @@ class ImageBuilder(object):
         if 'cmds' in self.config:
             self.image.pre_pip_cmds = self.config['cmds'].get('pre', '')
             self.image.post_pip_cmds = self.config['cmds'].get('post', '')
+            self.image.runtime_cmds = self.config['cmds'].get('runtime', '')
+
+        # build in a builder stage and copy the results to a runtime stage
+        self.image.multistage = self.config.get('multistage', False)
+        if self.image.runtime_cmds and not self.image.multistage:
+            raise Exception('cmds.runtime requires multistage to be enabled')
+
+        # compile bytecode at build time and record an import time profile
+        self.image.precompile = self.config.get('precompile', False)
 
         # handle proxy
         if 'proxy' in self.config:
@@ -129,20 +697,51 @@ class ImageBuilder(object):
         if 'pip-config' in self.config:
             self._process_pip_config(self.config['pip-config'])
 
-        repo_list = []
+        snapshot = {}
         if 'snapshot' in self.config:
-            repo_list.extend(
-                self._process_snapshot(self.config['snapshot']))
-
-        if 'repositories' in self.config:
-            repo_list.extend(
-                self._process_repositories(self.config['repositories']))
+            with self.timings.span('snapshot'):
+                snapshot = self._process_snapshot(self.config['snapshot'])
+
+        # fetch all repositories and files at once
+        fetches = []
+        snapshot_repos, config_repos, pinned = \
+            self._split_repositories(snapshot)
+        if snapshot_repos or config_repos:
+            self._logger.info('Cloning git repositories')
+        for name, vals in snapshot_repos.items():
+            fetches.append(self._repository_fetch(name, vals))
+        for name, vals in config_repos.items():
+            fetches.append(self._repository_fetch(name, vals,
+                                                  pinned.get(name)))
 
         if 'files' in self.config:
-            self._process_files(self.config['files'])
+            self._logger.info('Adding files to workspace')
+            for from_path in self.config['files']:
+                fetches.append(self._file_fetch(from_path))
+
+        self._fetch_scheduler = FetchScheduler.from_config(
+            self.config.get('fetch', {}), logger=self._logger)
+        with self.timings.span('fetch', count=len(fetches)) as fetch_span:
+            try:
+                results = run_async(self._fetch_all(fetches, fetch_span))
+            finally:
+                fetch_span['hosts'] = self._fetch_scheduler.summary()
+                self._log_fetch_summary(fetch_span['hosts'])
+        repo_list = [r for f, r in zip(fetches, results)
+                     if f['kind'] == 'repository']
+
+        # requirement files are numbered in the same order as they would be
+        # fetched one after the other
+        self._register_repository_requirements(snapshot_repos)
+
+        if 'packages' in snapshot:
+            self._write_requirements_file(snapshot['packages'])
+
+        self._register_repository_requirements(config_repos)
 
         if 'requirements' in self.config:
-            self._discover_requirements_txt(self.config['requirements'])
+            with self.timings.span('requirements'):
+                self._discover_requirements_txt(self.config['requirements'])
 
         # write config/packages last
         # this ensures these "high-level" packages are installed last
@@ -151,11 +750,32 @@ class ImageBuilder(object):
         if 'packages' in self.config:
             self._write_requirements_file(self.config['packages'])
 
+        self._pristine_repositories = \
+            self._find_pristine_repositories(repo_list)
+
+        # discovery results of repositories at a commit seen before
+        with self.timings.span('discover_repositories'):
+            self._repository_records = self._discover_repositories()
+
+        self._repo_list = repo_list
+        self._discover_context()
+
+    def _discover_context(self):
+        # (re)write the installation metadata of the populated context
+        repositories = self._repository_records
+        for name in ('jobfiles.txt', 'manifest.json'):
+            # left from a previous pass, only rewritten when not empty
+            if (self.context.path / INSTALLATION / name).exists():
+                (self.context.path / INSTALLATION / name).unlink()
+
         # job discovery
-        job_paths = discover_jobs(jobfiles=self.config.get('jobfiles', {}),
-                                  search_path=self.context.path,
-                                  ignore_folders=[INSTALLATION],
-                                  relative_path=self.image.workspace_dir)
+        with self.timings.span('discover_jobs'):
+            job_paths = discover_jobs(
+                jobfiles=self.config.get('jobfiles', {}),
+                search_path=self.context.path,
+                ignore_folders=[INSTALLATION],
+                relative_path=self.image.workspace_dir,
+                repositories=repositories)
 
         if job_paths:
             # write the files into a file as json
@@ -168,24 +788,34 @@ class ImageBuilder(object):
         # Convert list of repos into a dict with corrected image paths
         # This is the format that will be written to a json file
         repo_data = {}
-        if repo_list:
-            for repo in repo_list:
-                repo['path'] = to_image_path(repo['path'],
-                                             self.context.path,
-                                             self.image.workspace_dir)
-                repo_data[repo['path']] = repo
+        for repo in self._repo_list:
+            repo = dict(repo,
+                        path=to_image_path(repo['path'], self.context.path,
+                                           self.image.workspace_dir))
+            repo_data[repo['path']] = repo
 
         # manifest/repo discovery
-        super_manifest = discover_manifests(search_path=self.context.path,
-                                            ignore_folders=[INSTALLATION],
-                                            relative_path=self.image.workspace_dir,
-                                            repo_data=repo_data)
-
-        if super_manifest:
-            # write the files into a file as json
-            self.context.write_file(INSTALLATION / 'manifest.json',
-                                    json.dumps(super_manifest))
-
+        with self.timings.span('discover_manifests'):
+            manifest_files = find_manifests(
+                search_path=self.context.path,
+                ignore_folders=[INSTALLATION],
+                relative_path=self.image.workspace_dir,
+                repo_data=repo_data,
+                timings=self.timings,
+                repositories=repositories)
+
+            # parse, enrich and write the manifests one batch at a time
+            manifests = iter_manifests(manifest_files,
+                                       search_path=self.context.path,
+                                       relative_path=self.image.workspace_dir,
+                                       repo_data=repo_data,
+                                       timings=self.timings,
+                                       cache=self._manifest_cache,
+                                       repositories=repositories)
+            count = write_manifest_json(
+                self.context.path / INSTALLATION / 'manifest.json', manifests)
+
+        if count:
             self._logger.info('List of manifest files written to: %s' %
                               (INSTALLATION / 'manifest.json'))
 
@@ -208,147 +838,304 @@ class ImageBuilder(object):
             INSTALLATION / 'build.yaml',
             yaml.safe_dump(self.config, default_flow_style=False))
 
+    def _find_pristine_repositories(self, repo_list):
+        # Cloned repositories holding exactly the contents of their commit,
+        # with no files or other repositories placed inside them. Returns a
+        # dict of repository directory to (url, commit).
+        targets = self._file_targets + \
+            [pathlib.Path(repo['path']) for repo in repo_list]
+
+        pristine = {}
+        for repo in repo_list:
+            repo_dir = pathlib.Path(repo['path'])
+            url = repo['remotes'].get('origin')
+            if url and not any(repo_dir in target.parents
+                               for target in targets):
+                commit = repo['commit']
+                if repo.get('submodules'):
+                    # checked out submodules are part of the contents
+                    commit = hash_key(commit, json.dumps(repo['submodules'],
+                                                         sort_keys=True))
+                pristine[repo_dir] = (url, commit)
+
+        return pristine
+
+    def _discovery_key(self, url, commit, jobfiles, location):
+        # Key of the cached discovery of a repository. Job files matched by
+        # `glob` patterns, relative to the context, also depend on where the
+        # repository is in the context.
+        if jobfiles.get('glob'):
+            jobfiles = dict(jobfiles, location=location)
+        return self._discovery_cache.key(url, commit, jobfiles)
+
+    def _discover_repositories(self):
+        # Discover each cloned repository on its own, so the results can be
+        # reused by later builds of the same commit. Returns a dict of
+        # repository directory to discovery results.
+        repositories = {}
+        if not self._discovery_cache:
+            return repositories
+
+        jobfiles = dict(self.config.get('jobfiles', {}))
+        jobfiles.pop('paths', None)
+
+        for repo_dir, (url, commit) in self._pristine_repositories.items():
+            key = self._discovery_key(
+                url, commit, jobfiles,
+                repo_dir.relative_to(self.context.path).as_posix())
+            record = self._discovery_cache.get(key)
+            if record is None:
+                with self.timings.span('repository', path=str(repo_dir)):
+                    record = discover_repository(
+                        repo_dir,
+                        search_path=self.context.path,
+                        jobfiles=jobfiles,
+                        relative_path=self.image.workspace_dir,
+                        cache=self._manifest_cache)
+                if record['portable']:
+                    self._discovery_cache.set(key, record)
+            else:
+                self._logger.info('Using cached discovery of %s at %s' %
+                                  (url, commit))
+
+            repositories[repo_dir] = record
+
+        return repositories
+
+    def _process_python(self, python):
+        # user specified python version/label
+
+        # Ensure python version is a valid format to use as the base
+        # docker image. Appends '-slim' to the given version to acquire
+        # the docker image tag.
+        label = str(python)
+        if not all([n.isdigit() for n in label.split('.')]):
+            raise TypeError('Python version must be in format '
+                            '3[.X][.X]')
+
+        self.image.base_image_label = label + '-slim'
+
+    def _load_snapshot(self, snapshot_file):
+        with open(snapshot_file) as f:
+            return yaml.safe_load(f.read()) or {}
+
     def _process_snapshot(self, snapshot_file):
         # Extend given packages and repositories with any python
         # packages or repositories in the snapshot file
-        with open(snapshot_file) as f:
-            snapshot = yaml.safe_load(f.read())
+        snapshot = self._load_snapshot(snapshot_file)
 
         self._logger.info('Copying %s to context' % snapshot_file)
 
         # keep a copy of it in context
         self.context.copy(snapshot_file, INSTALLATION / 'snapshot.yaml')
 
-        # process the snapshot content
-        repo_list = []
-        if 'repositories' in snapshot:
-            repo_list = self._process_repositories(snapshot['repositories'])
+        return snapshot
 
-        if 'packages' in snapshot:
-            self._write_requirements_file(snapshot['packages'])
-
-        return repo_list
+    def _split_repositories(self, snapshot):
+        # Returns the repositories of the snapshot, those of the build file,
+        # and the commits the snapshot pins repositories of the build file
+        # to. Those are cloned with the credentials and options of the build
+        # file.
+        snapshot_repos = dict(snapshot.get('repositories', {}))
+        config_repos = self.config.get('repositories', {})
+        pinned = {name: snapshot_repos.pop(name).get('commit_id')
+                  for name in list(snapshot_repos) if name in config_repos}
+        return snapshot_repos, config_repos, pinned
 
     def _process_proxy(self, proxy_config):
         self._logger.info('Setting proxy environment variables')
         # Proxy values must only belong to specifically defined keys
 
-        # Update environment with proxy for git and file downloads
-        os.environ.update(proxy_config)
+        # Environment with proxy for git and file downloads, passed to each
+        # of them rather than set for the whole process
+        self._proxy_env = {k: str(v) for k, v in proxy_config.items()}
 
         # if proxy is set, it's required for docker build
         self._docker_build_args.update(proxy_config)
 
-    def _process_files(self, files):
-        self._logger.info('Adding files to workspace')
-        for from_path in files:
-            name = None
-            # If a file/dir is given as a dict, the key is the desired name for
-            # that file/dir in the docker image
-            # files:
-            #   - /path/to/a_file
-            #   - new_name: /path/to/original_name
-            if isinstance(from_path, dict):
-                name, from_path = next(iter(from_path.items()))
-
-            # Files can be given as urls to be downloaded
-            url_parts = urllib.parse.urlsplit(from_path)
-
-            # Use original file name if a new one is not provided
-            if not name:
-                name = os.path.basename(url_parts.path.rstrip('/'))
-
-            # compute where it goes to
-            to_path = self.context.path / name
-
+    async def _fetch_all(self, fetches, parent_span=None):
+        # Run all fetches through the fetch scheduler. Returns the results in
+        # order, or raises one exception listing all the failed fetches.
+        results = await self._fetch_scheduler.run(fetches, parent_span)
+
+        errors = []
+        for item, result in zip(fetches, results):
+            if isinstance(result, Exception):
+                self._logger.error('Failed to fetch %s: %s' %
+                                   (item['source'], result))
+                errors.append('- %s: %s' % (item['source'],
+                                            str(result).strip()))
+
+        if errors:
+            raise Exception('Could not fetch %s input(s):\n%s' %
+                            (len(errors), '\n'.join(errors)))
+
+        return results
+
+    def _log_fetch_summary(self, hosts):
+        for host, stats in hosts.items():
+            message = '%s: %s fetch(es), %s retried, %s failed, %s' % (
+                host, stats['fetches'], stats['retries'], stats['failed'],
+                _format_size(stats['bytes']))
+            if stats['throughput'] is not None:
+                message += ' in %.1fs (%.2f MB/s)' % (stats['seconds'],
+                                                     stats['throughput'])
+            self._logger.info(message)
+
+    def _parse_file_entry(self, from_path):
+        # Returns the target name, source and url parts of a `files` entry
+        name = None
+        # If a file/dir is given as a dict, the key is the desired name for
+        # that file/dir in the docker image
+        # files:
+        #   - /path/to/a_file
+        #   - new_name: /path/to/original_name
+        if isinstance(from_path, dict):
+            name, from_path = next(iter(from_path.items()))
+
+        # Files can be given as urls to be downloaded
+        url_parts = urllib.parse.urlsplit(from_path)
+
+        # Use original file name if a new one is not provided
+        if not name:
+            name = os.path.basename(url_parts.path.rstrip('/'))
+
+        return name, from_path, url_parts
+
+    def _file_fetch(self, from_path):
+        # Returns the fetch of one `files` entry
+        name, from_path, url_parts = self._parse_file_entry(from_path)
+
+        # compute where it goes to
+        to_path = self.context.path / name
+        self._file_targets.append(to_path)
+
+        scheme = url_parts.scheme or 'local'
+        if scheme == 'local':
+            self._local_files.append(
+                (pathlib.Path(from_path).expanduser().absolute(), to_path))
+
+        # Separate host and port, if given
+        host = port = None
+        if url_parts.netloc:
+            host = url_parts.netloc
+            if ':' in host:
+                host, port = host.split(':')
+                port = int(port) if port else None
+
+        def run(parent_span=None):
             # Prevent overwriting existing files
             assert not to_path.exists(), "%s already exists" % to_path
 
             # Make sure parent dir exists
-            if not to_path.parent.exists():
-                to_path.parent.mkdir(parents=True)
-
-            # Separate host and port, if given
-            host = port = None
-            if url_parts.netloc:
-                host = url_parts.netloc
-                if ':' in host:
-                    host, port = host.split(':')
-                    port = int(port) if port else None
-
-            # Perform action dictated by scheme, or lack of one.
-            if not url_parts.scheme:
-                # Copy file or dir directly
-                self._logger.info('Copying %s' % from_path)
-                self.context.copy(from_path, to_path)
-
-            elif url_parts.scheme in ['http', 'https']:
-                # Download with GET request
-                self._logger.info('Downloading %s' % from_path)
-                r = requests.get(from_path)
-                if r.status_code == 200:
-                    to_path.write_bytes(r.content)
-                else:
-                    raise Exception('Could not download %s' % from_path)
-            elif url_parts.scheme == 'scp':
-                # scp file or dir. Must have passwordless ssh set up.
-                self._logger.info('Copying with scp %s' % from_path)
+            to_path.parent.mkdir(parents=True, exist_ok=True)
+
+            with self.timings.span('file',
+                                   parent=parent_span,
+                                   source=from_path,
+                                   scheme=scheme):
+                self._fetch_file(url_parts, from_path, to_path, host, port)
+
+        return {'kind': 'file',
+                'source': from_path,
+                'target': to_path,
+                'scheme': FETCH_SCHEMES.get(scheme, scheme),
+                'run': run}
+
+    def _fetch_file(self, url_parts, from_path, to_path, host, port):
+        # Perform action dictated by scheme, or lack of one.
+        if not url_parts.scheme:
+            # Copy file or dir directly
+            self._logger.info('Copying %s' % from_path)
+            self.context.copy(from_path, to_path)
+
+        elif url_parts.scheme in ['http', 'https']:
+            # Download with GET request
+            self._logger.info('Downloading %s' % from_path)
+            fetch_config = self.config.get('fetch', {})
+            ResumableDownload(
+                from_path,
+                to_path,
+                partial_dir=pathlib.Path(self.cache_dir).expanduser() /
+                'downloads' if self.cache_dir else None,
+                proxies=requests_proxies(from_path, self._proxy_env),
+                segments=fetch_config.get('segments', 1),
+                split_size=fetch_config.get('split_size',
+                                            DEFAULT_SPLIT_SIZE),
+                throttle=self._fetch_scheduler.throttle,
+                logger=self._logger).run()
+        elif url_parts.scheme == 'scp':
+            # scp file or dir. Must have passwordless ssh set up.
+            self._logger.info('Copying with scp %s' % from_path)
+            with self._fetch_scheduler.scp_transfer() as limit:
                 scp(host=host,
                     from_path=url_parts.path,
                     to_path=to_path,
-                    port=port)
-            elif url_parts.scheme in ['ftp', 'ftps']:
-                # ftp file. Uses anonymous credentials.
-                self._logger.info('Retreiving from ftp %s' % from_path)
-                ftp_retrieve(host=host,
-                             from_path=url_parts.path,
-                             to_path=to_path,
-                             port=port,
-                             secure=url_parts.scheme == 'ftps')
-
-    def _process_repositories(self, repositories):
-        # Clone all git repositories and checkout a specific commit
-        # if one is given
-        self._logger.info('Cloning git repositories')
-
-        repo_list = []
-        for name, vals in repositories.items():
+                    port=port,
+                    env=self._proxy_env,
+                    limit=limit)
+        elif url_parts.scheme in ['ftp', 'ftps']:
+            # ftp file. Uses anonymous credentials.
+            self._logger.info('Retreiving from ftp %s' % from_path)
+            ftp_retrieve(host=host,
+                         from_path=url_parts.path,
+                         to_path=to_path,
+                         port=port,
+                         secure=url_parts.scheme == 'ftps',
+                         throttle=self._fetch_scheduler.throttle)
+
+    def _repository_fetch(self, name, vals, commit_id=None):
+        # Returns the fetch of one git repository, cloned and checked out at
+        # a specific commit if one is given (commit_id overrides the one of
+        # vals)
+        target = self.context.path / name
+        commit_id = commit_id or vals.get('commit_id', None)
+
+        credentials = vals.pop('credentials', None)
+        if credentials:
+            vals['credentials'] = {
+                'username': '*' * 8,
+                'password': '*' * 8
+            }
+
+        ssh_key = vals.pop('ssh_key', None)
+        if ssh_key:
+            vals['ssh_key'] = '*' * 8
+
+        GIT_SSL_NO_VERIFY = vals.get('GIT_SSL_NO_VERIFY', False)
+
+        def run(parent_span=None):
             self._logger.info('Cloning repo %s' % vals['url'])
 
             # Ensure dir is within workspace, and does not already exist
-            target = self.context.path / name
-
             assert not target.exists(), "%s already exists" % name
 
-            credentials = vals.pop('credentials', None)
-            if credentials:
-                vals['credentials'] = {
-                    'username': '*' * 8,
-                    'password': '*' * 8
-                }
-
-            ssh_key = vals.pop('ssh_key', None)
-            if ssh_key:
-                vals['ssh_key'] = '*' * 8
-
-            GIT_SSL_NO_VERIFY = vals.get('GIT_SSL_NO_VERIFY', False)
-
             # Clone and checkout the repo
-            git_info = git_clone(vals['url'], target,
-                                 vals.get('commit_id', None), True,
-                                 credentials, ssh_key, GIT_SSL_NO_VERIFY)
-
-            # Save repo info here since .git was deleted
-            repo_list.append(git_info)
-
-            # clone repo's requirements-txt file
+            with self.timings.span('repository',
+                                   parent=parent_span,
+                                   target=name,
+                                   url=vals['url']):
+                # Save repo info here since .git was deleted
+                return git_clone(vals['url'], target, commit_id, True,
+                                 credentials, ssh_key, GIT_SSL_NO_VERIFY,
+                                 env=self._proxy_env,
+                                 submodules=vals.get('submodules', False))
+
+        return {'kind': 'repository',
+                'source': vals['url'],
+                'target': target,
+                'scheme': 'git',
+                'run': run}
+
+    def _register_repository_requirements(self, repositories):
+        # register the requirements-txt file of cloned repos
+        for name, vals in repositories.items():
+            target = self.context.path / name
             if vals.get('requirements_file', False) is True:
                 if (target / REQUIREMENTS_FILE).exists():
                     self._register_requirements_file(target /
                                                      REQUIREMENTS_FILE)
 
-        return repo_list
-
     def _write_requirements_file(self, packages):
         # Generate python requirements file
         self._req_counter += 1
@@ -406,7 +1193,7 @@ class ImageBuilder(object):
             confparse.read_string(config)
             self.context.write_file(PIP_CONF_FILE, config)
 
-    def _build_image(self, no_cache=False):
+    def _build_image(self, no_cache=False, delta_context=False):
 
         # copy entrypoint to the context
         self._logger.info('Copying entrypoint to context')
@@ -414,40 +1201,87 @@ class ImageBuilder(object):
                           INSTALLATION / 'entrypoint.sh')
 
         # Get docker client api
-        api = docker.from_env().api
+        api = self._docker_api or docker.from_env().api
+        delta = None
+        try:
+            context = str(self.context.path)
+            if delta_context:
+                delta = DeltaContext(api,
+                                     '%s:%s' % (self.image.base_image,
+                                                self.image.base_image_label),
+                                     logger=self._logger)
+                context = self._upload_context(delta)
+
+            self._run_docker_build(api, context, no_cache=no_cache)
+        finally:
+            if delta:
+                delta.remove()
+            if api is not self._docker_api:
+                api.close()
+
+    def _upload_context(self, delta):
+        # send only the content the daemon side does not have yet, the
+        # daemon then builds from the context assembled there
+        with self.timings.span('context_upload') as upload_span:
+            url = delta.upload(self.context.path,
+                               str(INSTALLATION / 'Dockerfile'))
+            upload_span.update(delta.stats)
+
+        self._logger.info(
+            'Context upload: sent %s of %s (%s of %s distinct files)' %
+            (_format_size(delta.stats['bytes_sent']),
+             _format_size(delta.stats['context_bytes']),
+             delta.stats['blobs_sent'], delta.stats['blobs']))
+        return url
+
+    def _run_docker_build(self, api, context, no_cache=False):
         build_error = []
 
+        # parse build stream into per-instruction records
+        steps = BuildSteps()
+
         # Trigger docker build
-        for line in api.build(path=str(self.context.path),
-                              dockerfile=str(INSTALLATION / 'Dockerfile'),
-                              tag=self.image.tag,
-                              platform=self.image.platform,
-                              rm=True,
-                              forcerm=True,
-                              buildargs=self._docker_build_args,
-                              decode=True,
-                              nocache=no_cache):
-
-            # If we encounter an error, capture it
-            if 'errorDetail' in line:
-                build_error.append(line['errorDetail']['message'])
-
-            # retrieve image ID
-            if 'aux' in line and 'ID' in line['aux']:
-                self.image.id = line['aux']['ID']
-
-            # Log stream from build
-            if 'stream' in line:
-                contents = line['stream'].rstrip()
-                if contents:
-                    self._logger.debug(contents)
-
-                # retrive image ID in steam log
-                match = IMAGE_BUILD_SUCCESSUL.search(contents)
-                if match:
-                    self.image.id = match.group('image_id')
-
-        api.close()
+        with self.timings.span('docker_build') as build_span:
+            for line in api.build(path=context,
+                                  dockerfile=str(INSTALLATION / 'Dockerfile'),
+                                  tag=self.image.tag,
+                                  platform=self.image.platform,
+                                  rm=True,
+                                  forcerm=True,
+                                  buildargs=self._docker_build_args,
+                                  labels={
+                                      FINGERPRINT_LABEL:
+                                      self.image.fingerprint
+                                  },
+                                  decode=True,
+                                  nocache=no_cache):
+
+                # If we encounter an error, capture it
+                if 'errorDetail' in line:
+                    build_error.append(line['errorDetail']['message'])
+
+                # retrieve image ID
+                if 'aux' in line and 'ID' in line['aux']:
+                    self.image.id = line['aux']['ID']
+
+                # Log stream from build
+                if 'stream' in line:
+                    steps.feed(line['stream'])
+
+                    contents = line['stream'].rstrip()
+                    if contents:
+                        self._logger.debug(contents)
+
+                    # retrive image ID in steam log
+                    match = IMAGE_BUILD_SUCCESSUL.search(contents)
+                    if match:
+                        self.image.id = match.group('image_id')
+
+            self.image.build_steps = steps.finish()
+            build_span['steps'] = self.image.build_steps
+
+        if steps.steps:
+            self._logger.info('Build steps:\n%s' % steps.summary())
 
         # Error encountered, raise exception with message
         if build_error:
@@ -457,11 +1291,96 @@ class ImageBuilder(object):
             # we've failed to set the image id - something is wrong!
             raise Exception('No confirmation of successful build.')
 
+        if self.image.multistage:
+            self._report_stage_sizes(api, steps)
+
+        if self.image.precompile:
+            self._report_import_time(api)
+
+    def _report_stage_sizes(self, api, steps):
+        # Compare the final image against the builder stage it was copied
+        # from, the image the first stage ended with in the build stream
+        images = steps.stage_images()
+        if len(images) < 2 or not images[0]:
+            return
+
+        with self.timings.span('stage_sizes') as span:
+            try:
+                final_size = api.inspect_image(self.image.id)['Size']
+                builder_size = api.inspect_image(images[0])['Size']
+            except docker.errors.APIError as e:
+                # informational only, never fail the build over it
+                self._logger.warning('Could not inspect builder stage: %s' %
+                                     e)
+                return
+            span['final_size'] = final_size
+            span['builder_size'] = builder_size
+
+        self._logger.info(
+            'Multi-stage build: final image %s, builder stage %s '
+            '(%s smaller)' %
+            (_format_size(final_size), _format_size(builder_size),
+             _format_size(builder_size - final_size)))
+
+    def _report_import_time(self, api):
+        # Read the import time profile recorded during the build back out of
+        # the image. The container is only created to access its filesystem,
+        # it is never started.
+        path = '%s/%s/%s' % (self.image.workspace_dir, INSTALLATION,
+                             self.image.importtime_file)
+        with self.timings.span('import_time') as span:
+            try:
+                container = api.create_container(self.image.id,
+                                                 entrypoint=['true'])
+            except docker.errors.APIError as e:
+                self._logger.warning('Could not read import time profile: %s'
+                                     % e)
+                return
+
+            try:
+                stream, _ = api.get_archive(container['Id'], path)
+                archive = io.BytesIO(b''.join(stream))
+            except docker.errors.APIError as e:
+                self._logger.warning('Could not read import time profile: %s'
+                                     % e)
+                return
+            finally:
+                api.remove_container(container['Id'], force=True)
+
+            with tarfile.open(fileobj=archive) as tar:
+                member = tar.next()
+                text = tar.extractfile(member).read().decode(errors='replace')
+
+            self.image.import_time = parse_importtime(text)
+            span['profile'] = self.image.import_time
+
+        if not self.image.import_time:
+            self._logger.warning('Import time profile of %s is empty, see %s '
+                                 'in the image' %
+                                 (self.image.importtime_module, path))
+            return
+
+        self._logger.info(
+            'Import time of %s: %.3fs (%s modules), slowest:\n%s' %
+            (self.image.importtime_module,
+             self.image.import_time['total'] / 1e6,
+             self.image.import_time['modules'], '\n'.join(
+                 '  %8.3fs  %s' % (m['self'] / 1e6, m['module'])
+                 for m in self.image.import_time['slowest'])))
+
     def _replace_environment_variables(self):
 
         _recursive_handle_leaf(self.config, _replace_environment_variable)
 
 
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1000:
+            return '%.1f %s' % (size, unit)
+        size /= 1000
+    return '%.2f GB' % size
+
+
 def _replace_environment_variable(data):
     replace_list = re.findall(ENV_PATTERN, data)
     for replace_item in replace_list:
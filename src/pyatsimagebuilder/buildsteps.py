@@ -0,0 +1,126 @@
+import re
+import time
+
+STEP_PATTERN = re.compile(
+    r'^Step (?P<step>\d+)/(?P<total>\d+) : (?P<instruction>.*)$')
+USING_CACHE_PATTERN = re.compile(r'^ ---> Using cache$')
+RUNNING_IN_PATTERN = re.compile(r'^ ---> Running in (?P<container>[0-9a-f]+)$')
+IMAGE_PATTERN = re.compile(r'^ ---> (?P<image>[0-9a-f]+)$')
+
+SUMMARY_INSTRUCTION_WIDTH = 60
+
+
+class BuildSteps(object):
+    def __init__(self, clock=time.perf_counter):
+        '''
+        parses the docker build stream into per-instruction records
+
+        each record holds the step number, instruction text, whether the
+        layer was taken from cache, the image resulting from the step and the
+        wall time spent on the step.
+        '''
+        self.steps = []
+
+        self._clock = clock
+        self._current = None
+        self._started = None
+
+    def feed(self, contents):
+        '''
+        process a chunk of the `stream` output of docker build
+        '''
+        now = self._clock()
+        for line in contents.splitlines():
+            line = line.rstrip()
+
+            match = STEP_PATTERN.match(line)
+            if match:
+                self._close(now)
+                self._current = {
+                    'step': int(match.group('step')),
+                    'total': int(match.group('total')),
+                    'instruction': match.group('instruction'),
+                    'cached': False,
+                    'container': None,
+                    'image': None,
+                    'duration': None
+                }
+                self._started = now
+                self.steps.append(self._current)
+                continue
+
+            if self._current is None:
+                continue
+
+            if USING_CACHE_PATTERN.match(line):
+                self._current['cached'] = True
+                continue
+
+            match = RUNNING_IN_PATTERN.match(line)
+            if match:
+                self._current['container'] = match.group('container')
+                continue
+
+            match = IMAGE_PATTERN.match(line)
+            if match:
+                self._current['image'] = match.group('image')
+
+    def finish(self):
+        '''
+        close the last step once the build stream ends
+        '''
+        self._close(self._clock())
+        return self.steps
+
+    def _close(self, now):
+        if self._current is not None:
+            self._current['duration'] = round(now - self._started, 3)
+        self._current = None
+
+    def stage_images(self):
+        '''
+        returns the image each stage of a multi-stage build ended with, in
+        the order of the stages
+        '''
+        images = []
+        for step in self.steps:
+            if step['instruction'].upper().startswith('FROM '):
+                images.append(None)
+            if images:
+                images[-1] = step['image'] or images[-1]
+        return images
+
+    @property
+    def cache_hits(self):
+        return sum(1 for step in self.steps if step['cached'])
+
+    @property
+    def duration(self):
+        return sum(step['duration'] or 0 for step in self.steps)
+
+    def summary(self):
+        '''
+        returns a printable table of all the steps
+        '''
+        total = self.duration
+        lines = ['%-7s %9s %6s %6s  %s' %
+                 ('Step', 'Time (s)', '%', 'Cache', 'Instruction')]
+
+        for step in self.steps:
+            duration = step['duration'] or 0
+            instruction = step['instruction']
+            if len(instruction) > SUMMARY_INSTRUCTION_WIDTH:
+                instruction = \
+                    instruction[:SUMMARY_INSTRUCTION_WIDTH - 3] + '...'
+
+            lines.append('%-7s %9.2f %6.1f %6s  %s' % (
+                '%s/%s' % (step['step'], step['total']),
+                duration,
+                100.0 * duration / total if total else 0,
+                'hit' if step['cached'] else 'miss',
+                instruction))
+
+        lines.append('Total %.2fs, cache hits %s/%s' %
+                     (total, self.cache_hits, len(self.steps)))
+
+        return '\n'.join(lines)
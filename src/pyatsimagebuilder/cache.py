@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import logging
+import pathlib
+import tempfile
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'pyats-image-builder')
+
+logger = logging.getLogger(__name__)
+
+
+def hash_key(*parts):
+    '''
+    returns a sha256 hex digest over all the given str/bytes parts
+    '''
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # length prefix so ('ab', 'c') and ('a', 'bc') differ
+        digest.update(str(len(part)).encode() + b':')
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+    def __init__(self, path, namespace):
+        '''
+        content-addressed store of JSON documents on disk
+
+        entries are stored as <path>/<namespace>/<key[:2]>/<key>.json and
+        written atomically, so multiple builds can share the same cache
+        directory.
+        '''
+        self.path = pathlib.Path(path).expanduser() / namespace
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, key):
+        return self.path / key[:2] / (key + '.json')
+
+    def get(self, key):
+        '''
+        returns the stored document or None
+        '''
+        try:
+            with open(self._file(key)) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        file = self._file(key)
+        temp = None
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=str(file.parent), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.replace(temp, str(file))
+        except (OSError, TypeError, ValueError):
+            # the cache is an optimization, never fail the build over it
+            logger.debug('Could not write cache entry %s' % file,
+                         exc_info=True)
+            if temp and os.path.exists(temp):
+                os.remove(temp)
+
+
+class ManifestCache(DiskCache):
+    '''
+    parsed .tem manifest structures keyed by file content and parser version
+    '''
+
+    def __init__(self, path, version):
+        super().__init__(path, 'manifests')
+        self.version = str(version)
+
+    def key(self, content):
+        return hash_key(self.version, content)
+
+
+class DiscoveryCache(DiskCache):
+    '''
+    per repository discovery results keyed by repository url, commit and
+    the discovery configuration
+    '''
+
+    def __init__(self, path, version):
+        super().__init__(path, 'discovery')
+        self.version = str(version)
+
+    def key(self, url, commit, config):
+        return hash_key(self.version, url, commit,
+                        json.dumps(config, sort_keys=True))
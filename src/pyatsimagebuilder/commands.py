@@ -4,8 +4,6 @@ from pyats.cli.base import Command
 from pyats.cli.base import CommandWithSubcommands
 from pyats.cli.base import Subcommand
 
-from . import main as builder_main
-
 
 class ImageBuild(Command):
 
@@ -13,9 +11,33 @@ class ImageBuild(Command):
     help = 'Build a Docker image from a YAML file'
 
     def main(self, argv):
+        # imported when run, listing the subcommands stays fast
+        from . import main as builder_main
         return builder_main.main(argv, self.prog)
 
 
+class ImageServe(Command):
+
+    name = 'serve'
+    help = 'Run a build server accepting YAML files over a local HTTP API'
+
+    def main(self, argv):
+        # imported when run, listing the subcommands stays fast
+        from . import server as builder_server
+        return builder_server.main(argv, self.prog)
+
+
+class ImageSnapshot(Command):
+
+    name = 'snapshot'
+    help = 'Pin the repositories and python packages of a YAML file'
+
+    def main(self, argv):
+        # imported when run, listing the subcommands stays fast
+        from . import snapshot as builder_snapshot
+        return builder_snapshot.main(argv, self.prog)
+
+
 class ImageCommand(Command):
 
     name = 'image'
@@ -28,7 +50,7 @@ Docker image related subcommands for pyATS.
     # this command contains entrypoints
     SUBCMDS_ENTRYPOINT = 'pyats.cli.commands.image'
     SUBCMDS_BASECLS = Command
-    SUBCOMMANDS = [ImageBuild]
+    SUBCOMMANDS = [ImageBuild, ImageServe, ImageSnapshot]
 
     def __init__(self, prog):
         super().__init__(prog)
@@ -0,0 +1,109 @@
+import os
+import stat
+import logging
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .fingerprint import file_digest, HASH_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# files smaller than this are not worth a hash and a link
+DEDUP_MIN_SIZE = 1024
+
+DedupResult = collections.namedtuple(
+    'DedupResult', ['files', 'candidates', 'linked', 'bytes_saved'])
+
+
+def _regular_files(path, skip):
+    # yields (full path, lstat) of regular files below path, not descending
+    # into skipped directories and not following symlinks
+    for root, dirs, files in os.walk(str(path)):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in skip]
+        for name in files:
+            full = os.path.join(root, name)
+            if full in skip:
+                continue
+            st = os.lstat(full)
+            if stat.S_ISREG(st.st_mode):
+                yield full, st
+
+
+def _link(source, target):
+    # atomically replace target with a hard link to source
+    temp = '%s.dedup-%s' % (target, os.getpid())
+    os.link(source, temp)
+    try:
+        os.replace(temp, target)
+    except OSError:
+        os.remove(temp)
+        raise
+
+
+def dedup_tree(path,
+               exclude=(),
+               min_size=DEDUP_MIN_SIZE,
+               max_workers=HASH_WORKERS):
+    '''
+    replaces files with identical content below path by hard links to one
+    copy of it
+
+    Only files of equal size, permissions, ownership and modification time
+    are compared, so that every path keeps the exact content and metadata
+    docker copies into the image. Content is compared by sha256, hashed in
+    parallel, and only for files that have a candidate to begin with.
+
+    Arguments:
+        path (Path): directory to deduplicate
+        exclude (list): files/directories (relative to path) to leave alone
+        min_size (int): ignore files smaller than this many bytes
+        max_workers (int): number of threads hashing files
+
+    Returns:
+        DedupResult(files, candidates, linked, bytes_saved)
+    '''
+    skip = {os.path.join(str(path), str(i)) for i in exclude}
+
+    # group by everything that has to match besides the content. Paths that
+    # already share an inode only need to be looked at once.
+    groups = collections.defaultdict(dict)
+    files = 0
+    for full, st in _regular_files(path, skip):
+        files += 1
+        if st.st_size < min_size:
+            continue
+        key = (st.st_size, st.st_mode, st.st_uid, st.st_gid,
+               st.st_mtime_ns, st.st_dev)
+        groups[key].setdefault(st.st_ino, []).append(full)
+
+    candidates = [(key, paths) for key, inodes in groups.items()
+                  if len(inodes) > 1 for paths in inodes.values()]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = executor.map(file_digest,
+                               [paths[0] for _, paths in candidates])
+
+        originals = {}
+        linked = 0
+        saved = 0
+        for (key, paths), digest in zip(candidates, digests):
+            original = originals.setdefault((key, digest), paths[0])
+            if original == paths[0]:
+                continue
+
+            for duplicate in paths:
+                try:
+                    _link(original, duplicate)
+                except OSError as e:
+                    # leave the copy in place, eg. when the filesystem does
+                    # not support hard links
+                    logger.debug('Could not link %s to %s: %s' %
+                                 (duplicate, original, e))
+                    break
+                linked += 1
+            else:
+                # the data is freed once the last path to the inode is gone
+                saved += key[0]
+
+    return DedupResult(files, len(candidates), linked, saved)
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import hash_key
+from .fetch import FetchError, HTTP_TIMEOUT, RETRY_STATUS, retry_after
+from .lazy import lazy_import
+
+requests = lazy_import('requests')
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# progress of a download is saved at least this often, data written since
+# the last save is downloaded again when resuming
+SAVE_INTERVAL = 8 * 1024 * 1024
+
+# files at least this large (MB) are split into parallel ranges, when asked
+# for more than one segment
+DEFAULT_SPLIT_SIZE = 256
+
+# partial downloads not resumed for this long are removed
+PARTIAL_TTL = 7 * 24 * 3600
+
+
+def resumable_bytes(url, partial_dir, validator=None):
+    '''
+    returns how many bytes of url a partial download in partial_dir holds,
+    0 if there is none or it is of another version of the file (when
+    validator, the current ETag or Last-Modified, is given)
+    '''
+    try:
+        with open(os.path.join(str(partial_dir), hash_key(url) + '.json')) \
+                as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0
+
+    if state.get('url') != url or \
+            (validator and state.get('validator') != validator):
+        return 0
+    return sum(state['done'])
+
+
+class _Changed(Exception):
+    # the file changed on the server since the partial download started, or
+    # the server stopped honoring ranges
+    pass
+
+
+class ResumableDownload(object):
+    def __init__(self,
+                 url,
+                 path,
+                 partial_dir=None,
+                 proxies=None,
+                 segments=1,
+                 split_size=DEFAULT_SPLIT_SIZE,
+                 throttle=None,
+                 timeout=HTTP_TIMEOUT,
+                 logger=logger):
+        '''
+        http(s) download into a partial file that is resumed with range
+        requests after a failure, and optionally split into parallel ranges
+
+        A partial download is only resumed when the server sent a strong
+        ETag or a Last-Modified date, and through `If-Range`, so a file that
+        changed in the meantime is downloaded again from the start.
+
+        Arguments:
+            url (str): file to download
+            path (Path): where to put the complete file
+            partial_dir (Path): directory keeping partial downloads between
+                                builds, next to path by default
+            proxies (dict): requests proxies
+            segments (int): parallel ranges of large files
+            split_size (float): only split files of at least this many MB
+            throttle (callable): called with the size of each chunk received
+            timeout (tuple): requests (connect, read) timeout
+        '''
+        self._logger = logger
+        self.url = url
+        self.path = str(path)
+        self.partial_dir = str(partial_dir) if partial_dir else None
+        self.proxies = proxies
+        self.segments = max(1, segments)
+        self.split_size = split_size * 1000 * 1000
+        self.throttle = throttle
+        self.timeout = timeout
+
+        self.partial = None
+        self.resumed = 0
+        self._state = None
+        self._state_lock = threading.Lock()
+        self._unsaved = 0
+        self._lock_file = None
+
+    def run(self):
+        '''
+        download the file
+
+        Returns:
+            dict with the size of the file, the bytes resumed from a partial
+            download and the number of segments
+        '''
+        self._acquire()
+        try:
+            state = self._load()
+            if state:
+                try:
+                    self._resume(state)
+                except _Changed:
+                    self._logger.info('%s changed on the server, '
+                                      'downloading it again' % self.url)
+                    self.resumed = 0
+                    self._start()
+            else:
+                self._start()
+
+            shutil.move(self.partial, self.path)
+            self._remove(self.partial + '.json')
+        finally:
+            self._release()
+
+        return {'size': os.path.getsize(self.path),
+                'resumed': self.resumed,
+                'segments': len(self._state['segments'])}
+
+    def _acquire(self):
+        # pick the partial file, shared between builds through partial_dir
+        # unless another build is downloading the same url right now
+        fallback = self.path + '.part'
+        if not self.partial_dir:
+            self.partial = fallback
+            return
+
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self._prune()
+        self.partial = os.path.join(self.partial_dir, hash_key(self.url))
+
+        if fcntl is None:
+            return
+        self._lock_file = open(self.partial + '.lock', 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            self.partial = fallback
+
+    def _release(self):
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _prune(self):
+        expired = time.time() - PARTIAL_TTL
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _load(self):
+        # state of a partial download of this url, None if there is none to
+        # resume
+        try:
+            with open(self.partial + '.json') as f:
+                state = json.load(f)
+            size = os.path.getsize(self.partial)
+        except (OSError, ValueError):
+            return None
+
+        if state.get('url') != self.url or \
+                (state['size'] is not None and size != state['size']):
+            return None
+        if state['size'] is None:
+            # single stream of unknown size, the file holds what was written
+            state['done'] = [size]
+        return state
+
+    def _save(self):
+        # progress to the state file, atomically
+        with self._state_lock:
+            self._unsaved = 0
+            temp = self.partial + '.json.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self._state, f)
+            os.replace(temp, self.partial + '.json')
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _get(self, headers=None):
+        headers = dict(headers or {})
+        # ranges are offsets into the file as stored
+        headers['Accept-Encoding'] = 'identity'
+        r = requests.get(self.url,
+                         headers=headers,
+                         proxies=self.proxies,
+                         stream=True,
+                         timeout=self.timeout)
+        if r.status_code not in (200, 206, 416):
+            r.close()
+            raise FetchError('Could not download %s: HTTP %s' %
+                             (self.url, r.status_code),
+                             retry=r.status_code in RETRY_STATUS,
+                             delay=retry_after(r.headers.get('Retry-After')))
+        return r
+
+    def _start(self, split=True):
+        self._remove(self.partial + '.json')
+        r = self._get()
+        if r.status_code != 200:
+            r.close()
+            raise FetchError('Could not download %s: HTTP %s' %
+                             (self.url, r.status_code))
+
+        etag = r.headers.get('ETag')
+        if etag and etag.startswith('W/'):
+            # weak validators cannot be used with If-Range
+            etag = None
+        validator = etag or r.headers.get('Last-Modified')
+
+        size = r.headers.get('Content-Length')
+        encoded = r.headers.get('Content-Encoding', 'identity') != 'identity'
+        size = int(size) if size and not encoded else None
+
+        self._state = {
+            'url': self.url,
+            'validator': validator,
+            'size': size,
+            'segments': [[0, size - 1 if size else None]],
+            'done': [0],
+        }
+
+        with open(self.partial, 'wb') as f:
+            if size:
+                # sparse until written, so ranges can be written anywhere
+                f.truncate(size)
+
+        resumable = validator and not encoded
+        if resumable and split and size and self.segments > 1 and \
+                size >= self.split_size and \
+                r.headers.get('Accept-Ranges') == 'bytes':
+            r.close()
+            length = -(-size // self.segments)
+            self._state['segments'] = [
+                [start, min(start + length, size) - 1]
+                for start in range(0, size, length)]
+            self._state['done'] = [0] * len(self._state['segments'])
+            self._save()
+            self._logger.info('Downloading %s in %s parallel ranges' %
+                              (self.url, len(self._state['segments'])))
+            try:
+                self._fetch_segments()
+            except _Changed:
+                # the file changed since the first request, or the server
+                # does not honor ranges after all
+                self._logger.info('%s could not be downloaded in ranges, '
+                                  'downloading it in one stream' % self.url)
+                self._start(split=False)
+            return
+
+        if resumable:
+            self._save()
+        try:
+            self._write(r, 0)
+        finally:
+            r.close()
+            if resumable:
+                self._save()
+        self._check(0)
+
+    def _resume(self, state):
+        self._state = state
+        self.resumed = sum(state['done'])
+        self._logger.info('Resuming download of %s at %.1f MB' %
+                          (self.url, self.resumed / 1e6))
+        self._fetch_segments()
+
+    def _fetch_segments(self):
+        pending = [i for i in range(len(self._state['segments']))
+                   if not self._complete(i)]
+        if len(pending) == 1:
+            self._fetch_range(pending[0])
+        elif pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                # raises the first failure once all ranges are done
+                for future in [executor.submit(self._fetch_range, i)
+                               for i in pending]:
+                    future.result()
+
+    def _complete(self, index):
+        start, end = self._state['segments'][index]
+        return end is not None and \
+            self._state['done'][index] >= end - start + 1
+
+    def _fetch_range(self, index):
+        start, end = self._state['segments'][index]
+        offset = start + self._state['done'][index]
+        r = self._get({
+            'Range': 'bytes=%s-%s' % (offset, '' if end is None else end),
+            'If-Range': self._state['validator'],
+        })
+        try:
+            if r.status_code == 416 and end is None:
+                # nothing left of a file of unknown size
+                return
+            if r.status_code != 206 or not r.headers.get(
+                    'Content-Range', '').startswith('bytes %s-' % offset):
+                # a complete (changed) file, or ranges no longer supported
+                raise _Changed()
+            self._write(r, index)
+        finally:
+            r.close()
+            self._save()
+        self._check(index)
+
+    def _write(self, response, index):
+        start, end = self._state['segments'][index]
+        # unbuffered, so what is counted as done is in the file
+        with open(self.partial, 'r+b', buffering=0) as f:
+            f.seek(start + self._state['done'][index])
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if end is not None and \
+                        self._state['done'][index] + len(chunk) > \
+                        end - start + 1:
+                    raise FetchError('Received more data than expected for '
+                                     '%s' % self.url)
+                if self.throttle:
+                    self.throttle(len(chunk))
+                f.write(chunk)
+                with self._state_lock:
+                    self._state['done'][index] += len(chunk)
+                    self._unsaved += len(chunk)
+                    save = self._unsaved >= SAVE_INTERVAL
+                if save and self._state['validator']:
+                    self._save()
+
+    def _check(self, index):
+        start, end = self._state['segments'][index]
+        if end is not None and not self._complete(index):
+            raise FetchError('Download of %s ended after %s of %s bytes' %
+                             (self.url, self._state['done'][index],
+                              end - start + 1))
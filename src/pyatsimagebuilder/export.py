@@ -0,0 +1,191 @@
+import os
+import time
+import zlib
+import struct
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import cpu_count
+
+logger = logging.getLogger(__name__)
+
+# size of the blocks compressed in parallel
+BLOCK_SIZE = 1024 * 1024
+
+# deflate back-references reach this far, each block is primed with the end
+# of the previous one so compression ratio matches a sequential gzip
+DICT_SIZE = 32 * 1024
+
+COMPRESSIONS = ('gzip', 'zstd', 'none')
+EXTENSIONS = (
+    ('.tar.gz', 'gzip'),
+    ('.tgz', 'gzip'),
+    ('.gz', 'gzip'),
+    ('.tar.zst', 'zstd'),
+    ('.zst', 'zstd'),
+)
+
+
+def compression_for(path):
+    '''
+    returns the compression matching the extension of path
+    '''
+    for extension, compression in EXTENSIONS:
+        if str(path).endswith(extension):
+            return compression
+    return 'none'
+
+
+def _deflate(data, level, zdict):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                  zdict=zdict) if zdict else \
+        zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # sync flush ends the block on a byte boundary without ending the
+    # stream, so blocks compressed independently can be concatenated
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    def __init__(self, fileobj, level=6, threads=None,
+                 block_size=BLOCK_SIZE):
+        '''
+        file-like object writing a single gzip member to fileobj, with the
+        data compressed in blocks by several threads (like pigz)
+
+        zlib releases the GIL while compressing. At most twice as many blocks
+        as threads are held in memory at any time.
+        '''
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or cpu_count()
+        self.block_size = block_size
+
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._previous = b''
+        self._crc = 0
+        self._size = 0
+        self.bytes_out = 0
+
+        # gzip header: no name, no mtime, unknown os
+        self._write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def close(self):
+        if self._executor is None:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write(self._pending.popleft().result())
+        self._executor.shutdown()
+        self._executor = None
+
+        # empty final block, then crc and size of the uncompressed data
+        self._write(zlib.compressobj(self.level, zlib.DEFLATED,
+                                     -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+        self._write(struct.pack('<II', self._crc & 0xffffffff,
+                                self._size & 0xffffffff))
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(_deflate, block, self.level,
+                                  self._previous))
+        self._previous = block[-DICT_SIZE:]
+
+        # bounded memory: wait for the oldest block before reading on
+        while len(self._pending) >= 2 * self.threads:
+            self._write(self._pending.popleft().result())
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _zstd_writer(fileobj, level, threads):
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("zstd compression requires the 'zstandard' package")
+
+    compressor = zstandard.ZstdCompressor(level=level,
+                                          threads=threads or cpu_count())
+    return compressor.stream_writer(fileobj, closefd=False)
+
+
+def export_stream(chunks, path, compression=None, level=None, threads=None):
+    '''
+    write an iterable of byte chunks to path, compressed on the fly
+
+    Arguments:
+        chunks (iterable): data, eg. from docker.APIClient.get_image()
+        path (str): file to write
+        compression (str): gzip, zstd or none, from the extension of path by
+                           default
+        level (int): compression level (gzip: 6, zstd: 3 by default)
+        threads (int): compression threads, number of cpus by default
+
+    Returns:
+        dict with bytes_in, bytes_out, seconds and throughput (MB/s of
+        uncompressed data)
+    '''
+    compression = compression or compression_for(path)
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression %s, expected one of: %s' %
+                         (compression, ', '.join(COMPRESSIONS)))
+
+    start = time.perf_counter()
+    bytes_in = 0
+    temp = '%s.tmp' % path
+    try:
+        with open(temp, 'wb') as f:
+            if compression == 'gzip':
+                writer = ParallelGzipWriter(
+                    f, level=6 if level is None else level, threads=threads)
+            elif compression == 'zstd':
+                writer = _zstd_writer(f, 3 if level is None else level,
+                                      threads)
+            else:
+                writer = None
+
+            for chunk in chunks:
+                bytes_in += len(chunk)
+                (writer or f).write(chunk)
+
+            if writer:
+                writer.close()
+            bytes_out = f.tell()
+        os.replace(temp, str(path))
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+    seconds = time.perf_counter() - start
+    return {
+        'path': str(path),
+        'compression': compression,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'seconds': round(seconds, 3),
+        'throughput': round(bytes_in / 1e6 / seconds, 1) if seconds else None,
+    }
@@ -0,0 +1,396 @@
+import os
+import re
+import time
+import random
+import shutil
+import asyncio
+import logging
+import threading
+import contextlib
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# number of fetches of each kind running at the same time
+FETCH_CONCURRENCY = {
+    'git': 4,
+    'local': 4,
+    'http': 8,
+    'scp': 4,
+    'ftp': 2,
+}
+
+# fetches from the same server running at the same time, whatever their kind
+DEFAULT_HOST_LIMIT = 4
+
+# a failed fetch is tried this many more times, waiting DEFAULT_BACKOFF
+# seconds before the first retry, doubling for each next one up to
+# MAX_BACKOFF
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+# (connect, read) timeout of http downloads, in seconds
+HTTP_TIMEOUT = (30, 300)
+
+# http status codes worth retrying, anything else fails right away
+RETRY_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+LOCAL_HOST = 'local'
+SCP_LIKE_URL = re.compile(r'^(?:[^@/]+@)?(?P<host>[^:/]+):(?!//)')
+
+
+class FetchError(Exception):
+    def __init__(self, message, retry=True, delay=None):
+        '''
+        failure of a fetch
+
+        Arguments:
+            message (str): error message
+            retry (bool): whether trying again may succeed
+            delay (float): seconds to wait at least before trying again (eg.
+                           from a Retry-After header)
+        '''
+        super().__init__(message)
+        self.retry = retry
+        self.delay = delay
+
+
+def fetch_host(source):
+    '''
+    returns the host a fetch source (url, scp-like git url or path) is
+    fetched from, LOCAL_HOST for local paths
+    '''
+    source = str(source)
+    parts = urllib.parse.urlsplit(source)
+    if parts.scheme and parts.scheme != 'file':
+        return parts.hostname or LOCAL_HOST
+
+    match = SCP_LIKE_URL.match(source)
+    if not parts.scheme and match and not os.path.exists(source):
+        return match.group('host')
+
+    return LOCAL_HOST
+
+
+def tree_size(path):
+    # bytes of the regular files below (or at) path
+    path = str(path)
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _discard(path):
+    # remove what a failed attempt left at path
+    if os.path.isdir(str(path)) and not os.path.islink(str(path)):
+        shutil.rmtree(str(path))
+    elif os.path.lexists(str(path)):
+        os.remove(str(path))
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        '''
+        thread-safe token bucket limiting a byte rate
+
+        Arguments:
+            rate (float): bytes per second
+            burst (float): bytes that can go through at once after being idle,
+                           one second worth by default
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        '''
+        take `amount` bytes from the bucket, sleeping until they are
+        available. Callers going over the rate are put in debt, so large
+        chunks are allowed but delay what follows.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+    @contextlib.contextmanager
+    def reserve(self, rate):
+        '''
+        sets `rate` bytes per second aside from the bucket for the duration
+        of the with block, for a transfer limited by other means (eg. scp -l)
+        '''
+        self._adjust(-rate)
+        try:
+            yield
+        finally:
+            self._adjust(rate)
+
+    def _adjust(self, delta):
+        with self._lock:
+            # refill at the rate up to now before changing it
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            burst = self.burst / self.rate
+            self.rate += delta
+            self.burst = burst * self.rate
+            self._tokens = min(self._tokens, self.burst)
+
+
+class FetchScheduler(object):
+    def __init__(self,
+                 scheme_limits=FETCH_CONCURRENCY,
+                 host_limit=DEFAULT_HOST_LIMIT,
+                 host_limits=None,
+                 bandwidth=None,
+                 retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 max_backoff=MAX_BACKOFF,
+                 logger=logger):
+        '''
+        runs fetches (git clones, downloads, copies) concurrently, within
+        per kind and per host connection limits and a global bandwidth
+        ceiling, retrying failed ones with exponential backoff and jitter
+
+        http and ftp downloads take from one token bucket. Each scp copy
+        running sets its share of the ceiling (scp_limit) aside from the
+        bucket, so scp copies and downloads together stay within it. Git
+        clones are not limited.
+
+        Arguments:
+            scheme_limits (dict): fetches of each kind (git, http, scp, ftp,
+                                  local) at the same time
+            host_limit (int): fetches from the same host at the same time
+            host_limits (dict): host to limit, overriding host_limit
+            bandwidth (float): ceiling of http/ftp/scp transfers together in
+                               bytes per second, unlimited by default
+            retries (int): times a failed fetch is tried again
+            backoff (float): seconds before the first retry, doubled for each
+                             next one
+            max_backoff (float): longest wait before a retry
+        '''
+        self._logger = logger
+        self.scheme_limits = dict(scheme_limits)
+        self.host_limit = host_limit
+        self.host_limits = dict(host_limits or {})
+        self.bandwidth = bandwidth
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._bucket = TokenBucket(bandwidth) if bandwidth else None
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, logger=logger):
+        '''
+        returns a scheduler for the `fetch` section of a build config
+        '''
+        bandwidth = config.get('bandwidth')
+        return cls(host_limit=config.get('host_limit', DEFAULT_HOST_LIMIT),
+                   host_limits=config.get('hosts'),
+                   bandwidth=bandwidth * 1000 * 1000 if bandwidth else None,
+                   retries=config.get('retries', DEFAULT_RETRIES),
+                   backoff=config.get('backoff', DEFAULT_BACKOFF),
+                   max_backoff=config.get('max_backoff', MAX_BACKOFF),
+                   logger=logger)
+
+    def throttle(self, amount):
+        '''
+        account for `amount` bytes transferred, blocking while over the
+        bandwidth ceiling
+        '''
+        if self._bucket:
+            self._bucket.consume(amount)
+
+    @property
+    def scp_limit(self):
+        '''
+        bandwidth ceiling in Kbit/s of each `scp -l`, None when unlimited
+
+        The ceiling is split between the scp copies that may run at the same
+        time and the downloads, which always keep one share of it.
+        '''
+        if not self.bandwidth:
+            return None
+        return max(1, int(self._scp_share() * 8 / 1024))
+
+    @contextlib.contextmanager
+    def scp_transfer(self):
+        '''
+        context manager returning the `scp -l` limit of an scp copy, and
+        setting its share of the bandwidth ceiling aside from the downloads
+        while the copy runs
+        '''
+        if not self._bucket:
+            yield None
+            return
+        with self._bucket.reserve(self._scp_share()):
+            yield self.scp_limit
+
+    def _scp_share(self):
+        # bytes per second of one scp copy
+        return self.bandwidth / (max(1, self.scheme_limits.get('scp', 1)) + 1)
+
+    def summary(self):
+        '''
+        returns per host statistics of the fetches run so far: fetches,
+        retries, failed, bytes (fetched content), seconds (from the first
+        start to the last end) and throughput (MB/s)
+        '''
+        summary = {}
+        with self._stats_lock:
+            for host, stats in sorted(self._stats.items()):
+                seconds = (stats['end'] or stats['start']) - stats['start']
+                summary[host] = {
+                    'fetches': stats['fetches'],
+                    'retries': stats['retries'],
+                    'failed': stats['failed'],
+                    'bytes': stats['bytes'],
+                    'seconds': round(seconds, 3),
+                    'throughput': round(stats['bytes'] / 1e6 / seconds, 2)
+                    if seconds else None,
+                }
+        return summary
+
+    async def run(self, fetches, parent_span=None):
+        '''
+        run fetches concurrently. A fetch only starts once earlier fetches
+        into the same directory tree are done.
+
+        Arguments:
+            fetches (list): dicts with the `source` and `target` (Path) of
+                            each fetch, its `scheme` and the function to
+                            `run` it, called with parent_span
+            parent_span (dict): timing span to attach the fetch spans to
+
+        Returns:
+            list of the results (or exceptions) of the fetches, in order
+        '''
+        loop = asyncio.get_running_loop()
+
+        schemes = {scheme: asyncio.Semaphore(limit)
+                   for scheme, limit in self.scheme_limits.items()}
+        hosts = {}
+
+        executor = ThreadPoolExecutor(
+            max_workers=sum(self.scheme_limits.values()))
+
+        def host_slot(host):
+            if host not in hosts:
+                hosts[host] = asyncio.Semaphore(
+                    self.host_limits.get(host, self.host_limit))
+            return hosts[host]
+
+        async def fetch(item, after):
+            if after:
+                await asyncio.wait(after)
+
+            host = fetch_host(item['source'])
+            scheme = schemes.get(item['scheme'], schemes['local'])
+            attempt = 0
+            while True:
+                async with scheme, host_slot(host):
+                    self._record(host, start=time.perf_counter())
+                    try:
+                        result = await loop.run_in_executor(
+                            executor, item['run'], parent_span)
+                    except Exception as e:
+                        error = e
+                    else:
+                        self._record(host, end=time.perf_counter(),
+                                     fetches=1,
+                                     bytes=tree_size(item['target']))
+                        return result
+                    self._record(host, end=time.perf_counter())
+
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    self._record(host, fetches=1, failed=1)
+                    raise error
+
+                attempt += 1
+                self._record(host, retries=1)
+                self._logger.warning(
+                    'Fetching %s failed (%s), retrying in %.1fs '
+                    '(%s of %s)' % (item['source'], str(error).strip(),
+                                    delay, attempt, self.retries))
+                await loop.run_in_executor(executor, _discard,
+                                           item['target'])
+                await asyncio.sleep(delay)
+
+        tasks = []
+        for i, item in enumerate(fetches):
+            after = [tasks[j] for j in range(i)
+                     if _overlaps(fetches[j]['target'], item['target'])]
+            tasks.append(asyncio.ensure_future(fetch(item, after)))
+
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            executor.shutdown(wait=True)
+
+    def _retry_delay(self, error, attempt):
+        # seconds to wait before trying again, None to give up
+        if attempt >= self.retries or isinstance(error, AssertionError):
+            # AssertionError: the target already existed, not ours to touch
+            return None
+        if isinstance(error, FetchError) and not error.retry:
+            return None
+
+        # "equal jitter": half of the backoff, plus up to the other half at
+        # random, so fetches failing together do not retry together
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+
+        if isinstance(error, FetchError) and error.delay:
+            delay = max(delay, min(error.delay, self.max_backoff))
+        return delay
+
+    def _record(self, host, start=None, end=None, **counts):
+        with self._stats_lock:
+            stats = self._stats.setdefault(host, {
+                'fetches': 0, 'retries': 0, 'failed': 0, 'bytes': 0,
+                'start': start, 'end': None})
+            if start is not None and stats['start'] is None:
+                stats['start'] = start
+            if end is not None:
+                stats['end'] = max(end, stats['end'] or end)
+            for name, value in counts.items():
+                stats[name] += value
+
+
+def retry_after(value):
+    '''
+    returns the seconds of a Retry-After header given in seconds, None
+    otherwise (or for dates)
+    '''
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _overlaps(path, other):
+    # whether one path is within (or the same as) the other
+    return path == other or path in other.parents or other in path.parents
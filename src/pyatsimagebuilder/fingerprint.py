@@ -0,0 +1,91 @@
+import os
+import json
+import stat
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+# image label holding the fingerprint of the inputs an image was built from
+FINGERPRINT_LABEL = 'pyats-image-builder.fingerprint'
+
+# bump when the fingerprint computation changes
+FINGERPRINT_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = 8
+
+
+def file_digest(path):
+    '''
+    returns the sha256 hex digest of a file's content
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _tree_entries(path, skip):
+    # yields (relative path, full path, lstat) of everything below path,
+    # in a stable order, not descending into skipped directories
+    for root, dirs, files in os.walk(str(path)):
+        dirs.sort()
+        dirs[:] = [d for d in dirs
+                   if os.path.join(root, d) not in skip]
+        for name in sorted(dirs + files):
+            full = os.path.join(root, name)
+            if full in skip:
+                continue
+            yield os.path.relpath(full, str(path)), full, os.lstat(full)
+
+
+def context_fingerprint(path, inputs=None, repositories=None, exclude=()):
+    '''
+    returns a fingerprint (sha256 hex digest) of a build context directory
+
+    every file is hashed by relative path, executable bit and content
+    (symlinks by their target). Repositories known to hold exactly the
+    contents of a commit are hashed by url and commit instead of by content.
+
+    Arguments:
+        path (Path): build context directory
+        inputs (dict): other build inputs (eg. base image, build args), must
+                       be JSON serializable
+        repositories (dict): directory (relative to path) to (url, commit)
+        exclude (list): files/directories (relative to path) to leave out
+    '''
+    repositories = {str(k): v for k, v in (repositories or {}).items()}
+    skip = {os.path.join(str(path), str(i))
+            for i in list(exclude) + list(repositories)}
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': FINGERPRINT_VERSION,
+                              'inputs': inputs or {}},
+                             sort_keys=True).encode())
+
+    for name in sorted(repositories):
+        url, commit = repositories[name]
+        digest.update(json.dumps(['repository', name, url, commit]).encode())
+
+    entries = []
+    files = []
+    for name, full, st in _tree_entries(path, skip):
+        if stat.S_ISLNK(st.st_mode):
+            entries.append(['link', name, os.readlink(full)])
+        elif stat.S_ISDIR(st.st_mode):
+            entries.append(['dir', name])
+        elif stat.S_ISREG(st.st_mode):
+            entries.append(['file', name, bool(st.st_mode & stat.S_IXUSR)])
+            files.append((len(entries) - 1, full))
+
+    # file contents are hashed in parallel, hashlib releases the GIL
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        for (index, _), content in zip(
+                files, executor.map(file_digest, [f for _, f in files])):
+            entries[index].append(content)
+
+    for entry in entries:
+        digest.update(json.dumps(entry).encode() + b'\n')
+
+    return digest.hexdigest()
@@ -1,11 +1,13 @@
 import os
-import docker
+import logging
+import functools
 
-from jinja2 import Environment, FileSystemLoader
+from .export import export_stream
+from .lazy import lazy_import
+
+docker = lazy_import('docker')
+jinja2 = lazy_import('jinja2')
 
-JINJA2_ENV = Environment(loader=FileSystemLoader(os.path.dirname(__file__)),
-                         trim_blocks=True,
-                         lstrip_blocks=True)
 DEFAULT_BASE_IMAGE = 'python'
 DEFAULT_BASE_IMAGE_LABEL = '3.7.9-slim'
 DEFAULT_TINI_VERSION = '0.18.0'
@@ -13,6 +15,22 @@ DEFAULT_WORKSPACE_NAME = 'pyats'
 
 DOCKERIMAGE_TEMPLATE = 'Dockerfile.template'
 
+# module imported by the import time profile of precompiled images
+IMPORTTIME_MODULE = 'pyats.cli.__main__'
+IMPORTTIME_FILE = 'importtime.txt'
+
+
+@functools.lru_cache(maxsize=None)
+def jinja2_env():
+    '''
+    returns the environment rendering the Dockerfile template, created on
+    first use
+    '''
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+        trim_blocks=True,
+        lstrip_blocks=True)
+
 
 class Image(object):
     def __init__(self,
@@ -20,12 +38,17 @@ class Image(object):
                  env=None,
                  pre_pip_cmds=None,
                  post_pip_cmds=None,
+                 runtime_cmds=None,
+                 multistage=False,
+                 precompile=False,
                  base_image=DEFAULT_BASE_IMAGE,
                  base_image_label=DEFAULT_BASE_IMAGE_LABEL,
                  tini_version=DEFAULT_TINI_VERSION,
-                 workspace_name=DEFAULT_WORKSPACE_NAME):
+                 workspace_name=DEFAULT_WORKSPACE_NAME,
+                 logger=logging.getLogger(__name__)):
 
-        self._template = JINJA2_ENV.get_template(DOCKERIMAGE_TEMPLATE)
+        self._logger = logger
+        self._template = jinja2_env().get_template(DOCKERIMAGE_TEMPLATE)
 
         self.base_image = base_image
         self.base_image_label = base_image_label
@@ -37,6 +60,12 @@ class Image(object):
         self.tag = None
         self.platform = None
 
+        # per-instruction records parsed from the docker build output
+        self.build_steps = []
+
+        # fingerprint of the inputs the image is built from
+        self.fingerprint = None
+
         # environment variables
         self.env = env or {}
 
@@ -44,11 +73,78 @@ class Image(object):
         self.pre_pip_cmds = pre_pip_cmds
         self.post_pip_cmds = post_pip_cmds
 
+        # build python packages in a separate stage, and only copy the
+        # resulting workspace into the final image
+        self.multistage = multistage
+
+        # commands to run in the final stage of a multi-stage build
+        self.runtime_cmds = runtime_cmds
+
+        # compile bytecode at build time and profile the entry point imports
+        self.precompile = precompile
+        self.importtime_module = IMPORTTIME_MODULE
+        self.importtime_file = IMPORTTIME_FILE
+
+        # import time profile summary, read back from the built image
+        self.import_time = None
 
     def manifest(self):
         return self._template.render(image=self)
 
-    def push(self, remote_tag=None, credentials=None):
+    def remote_digest(self, remote_tag, credentials=None, api=None):
+        """
+        Query the registry for the manifest digest currently stored under
+        the given tag.
+
+        Arguments
+        ---------
+            remote_tag (str): Full name of the image in the registry
+            credentials (dict): optional override for username and password
+            api (docker.APIClient): docker api client to reuse
+
+        Returns
+        -------
+            digest string (sha256:...) or None if the tag does not exist
+        """
+        close = api is None
+        api = api or docker.from_env().api
+        try:
+            info = api.inspect_distribution(remote_tag,
+                                            auth_config=credentials)
+        except docker.errors.APIError:
+            # tag (or repository) does not exist in the registry yet
+            return None
+        finally:
+            if close:
+                api.close()
+
+        return info.get('Descriptor', {}).get('digest')
+
+    def local_digests(self, remote_tag, api=None):
+        """
+        Returns the registry digests the docker daemon has recorded for this
+        image under the repository of the given tag.
+        """
+        repository, _ = docker.utils.parse_repository_tag(remote_tag)
+
+        close = api is None
+        api = api or docker.from_env().api
+        try:
+            repo_digests = api.inspect_image(self.id).get('RepoDigests', [])
+        finally:
+            if close:
+                api.close()
+
+        digests = []
+        for repo_digest in repo_digests:
+            repo, _, digest = repo_digest.partition('@')
+            if repo == repository:
+                digests.append(digest)
+
+        return digests
+
+    def push(self, remote_tag=None, credentials=None, skip_unchanged=True,
+             api=None):
         """
         Push image to a registry
 
@@ -59,6 +155,13 @@ class Image(object):
                               ie. registry-host:5000/repo/image:latest
             credentials (dict): optional override for username and password when
                                 pushing image.
+            skip_unchanged (bool): do not push when the registry already holds
+                                   the same image digest under this tag.
+            api (docker.APIClient): docker api client to reuse
+
+        Returns
+        -------
+            True if the image was pushed, False if the push was skipped
         """
         # Get the tag to use
         if not remote_tag:
@@ -70,19 +173,94 @@ class Image(object):
 
         # Apply tag to image and push with new tag
         push_error = []
-        api = docker.from_env().api
+        existing = []
+        close = api is None
+        api = api or docker.from_env().api
+        try:
+            if not api.tag(self.id, remote_tag):
+                raise AttributeError("Cannot tag image with '%s'" % remote_tag)
+
+            if skip_unchanged:
+                # compare the registry manifest against the digests the
+                # daemon recorded for this image when it was last
+                # pushed/pulled
+                digest = self.remote_digest(remote_tag, credentials, api=api)
+                if digest and \
+                        digest in self.local_digests(remote_tag, api=api):
+                    self._logger.info("Image '%s' is up to date in the "
+                                      "registry (%s), skipping push" %
+                                      (remote_tag, digest))
+                    return False
 
-        if api.tag(self.id, remote_tag):
             for line in api.push(remote_tag,
                                  auth_config=credentials,
                                  stream=True,
                                  decode=True):
                 if 'errorDetail' in line:
                     push_error.append(line['errorDetail']['message'])
-        else:
-            raise AttributeError("Cannot tag image with '%s'" % remote_tag)
+                elif line.get('status') == 'Layer already exists':
+                    existing.append(line.get('id'))
+                    self._logger.debug('Layer already exists: %s' %
+                                       line.get('id'))
+        finally:
+            if close:
+                api.close()
 
         # Encountered error when pushing
         if push_error:
             raise Exception("Error pushing image '%s':\n%s" %
                             (remote_tag, '\n'.join(push_error)))
+
+        self._logger.info("Pushed '%s' (%s layer(s) already existed in the "
+                          "registry)" % (remote_tag, len(existing)))
+
+        return True
+
+    def export(self, path, compression=None, level=None, threads=None,
+               api=None):
+        """
+        Save image to a (compressed) docker-archive tarball, as
+        `docker save | gzip` would, for `docker load` on other hosts
+
+        The archive is streamed from the docker daemon into a multi-threaded
+        compressor, it is never staged on disk uncompressed.
+
+        Arguments
+        ---------
+            path (str): file to write
+            compression (str): gzip, zstd (requires the zstandard package) or
+                               none, from the extension of path by default
+                               (.tar.gz/.tgz, .tar.zst, .tar)
+            level (int): compression level
+            threads (int): compression threads, number of cpus by default
+            api (docker.APIClient): docker api client to reuse
+
+        Returns
+        -------
+            dict with bytes_in, bytes_out, seconds and throughput (MB/s)
+        """
+        # saving by tag keeps the image name in the archive
+        name = self.tag or self.id
+        if not name:
+            raise KeyError('Image has not been built')
+
+        close = api is None
+        api = api or docker.from_env().api
+        try:
+            result = export_stream(api.get_image(name),
+                                   path,
+                                   compression=compression,
+                                   level=level,
+                                   threads=threads)
+        finally:
+            if close:
+                api.close()
+
+        self._logger.info(
+            "Exported '%s' to %s (%s compression): %.1f MB -> %.1f MB in "
+            "%.1fs, %s MB/s" %
+            (name, result['path'], result['compression'],
+             result['bytes_in'] / 1e6, result['bytes_out'] / 1e6,
+             result['seconds'], result['throughput']))
+
+        return result
@@ -0,0 +1,38 @@
+import sys
+import importlib
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        '''
+        stands in for a module until one of its attributes is used, and only
+        then imports it
+
+        Keeps heavy dependencies (docker, requests, git, yaml, jinja2,
+        jsonschema) out of the start up of the command line entry points,
+        which mostly do not need all of them. Importing is thread-safe, and
+        the module is only imported once whatever the number of stand-ins.
+
+        Arguments:
+            name (str): absolute name of the module
+        '''
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (
+            self._name, '' if self._module is None else ' (imported)')
+
+
+def lazy_import(name):
+    '''
+    returns module `name`, imported at the first use of one of its
+    attributes unless it already is
+    '''
+    return sys.modules.get(name) or LazyModule(name)
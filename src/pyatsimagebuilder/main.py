@@ -1,9 +1,13 @@
 import sys
-import yaml
 import logging
 import argparse
 
 from .builder import ImageBuilder
+from .cache import DEFAULT_CACHE_DIR
+from .watch import watch, DEFAULT_DEBOUNCE
+from .lazy import lazy_import
+
+yaml = lazy_import('yaml')
 
 
 def main(argv=None, prog='pyats-image-build'):
@@ -25,6 +29,15 @@ def main(argv=None, prog='pyats-image-build'):
                         '-P',
                         action='store_true',
                         help='Push image to Dockerhub after buiding')
+    parser.add_argument('--force-push',
+                        action='store_true',
+                        help='Push image even if the registry already holds '
+                        'the same image digest under this tag')
+    parser.add_argument('--export',
+                        metavar='PATH',
+                        help='Save the built image to a tarball for docker '
+                        'load, compressed by extension (.tar.gz, .tar.zst, '
+                        '.tar)')
     parser.add_argument('--no-cache',
                         '-c',
                         action='store_true',
@@ -41,6 +54,47 @@ def main(argv=None, prog='pyats-image-build'):
         action='store_true',
         help='Set up the context directory but do not build the'
         ' image. Use with --keep-context.')
+    parser.add_argument('--reuse-unchanged',
+                        action='store_true',
+                        help='Do not build when an image built from the same '
+                        'inputs exists locally or under the tag in the '
+                        'registry, tag and use it instead')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help='Replace files with identical content in the '
+                        'build context by hard links before building')
+    parser.add_argument('--delta-context',
+                        action='store_true',
+                        help='Only send files the docker daemon has not '
+                        'received for a previous build (for remote daemons)')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='Only estimate the work of the build: commits '
+                        'to clone, bytes to download and likely cache hits, '
+                        'without fetching or building anything')
+    parser.add_argument('--watch',
+                        '-w',
+                        action='store_true',
+                        help='Keep watching the YAML file and local files '
+                        'inputs, and rebuild when they change')
+    parser.add_argument('--debounce',
+                        type=float,
+                        default=DEFAULT_DEBOUNCE,
+                        metavar='SECONDS',
+                        help='With --watch, wait for this long without '
+                        'changes before rebuilding (default: %(default)s)')
+    parser.add_argument('--timings',
+                        metavar='FILE',
+                        help='Write the per-phase build timing report (JSON) '
+                        'to this file')
+    parser.add_argument('--cache-dir',
+                        default=DEFAULT_CACHE_DIR,
+                        help='Directory for caches kept between builds '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-disk-cache',
+                        action='store_true',
+                        help='Do not use or update the caches kept between '
+                        'builds')
     parser.add_argument('--verbose',
                         '-v',
                         action='store_true',
@@ -56,18 +110,59 @@ def main(argv=None, prog='pyats-image-build'):
 
     logger.addHandler(logging.StreamHandler(sys.stdout))
 
+    cache_dir = None if args.no_disk_cache else args.cache_dir
+
+    if args.watch:
+        def on_build(image):
+            if args.dry_run:
+                return
+            if args.export:
+                image.export(args.export)
+            if args.push:
+                logger.info('Pushing image to registry')
+                image.push(skip_unchanged=not args.force_push)
+
+        # rebuilds reuse the docker layer cache unless asked not to
+        watch(args.file,
+              logger=logger,
+              cache_dir=cache_dir,
+              debounce=args.debounce,
+              keep_context=args.keep_context,
+              tag=args.tag,
+              no_cache=args.no_cache,
+              dry_run=args.dry_run,
+              timings_file=args.timings,
+              dedup=args.dedup,
+              delta_context=args.delta_context,
+              on_build=on_build)
+        return
+
     # Load given yaml file
     logger.info('Reading provided yaml')
     with open(args.file, 'r') as file:
         config = yaml.safe_load(file.read())
 
+    if args.plan:
+        builder = ImageBuilder(config, logger, cache_dir=cache_dir)
+        builder.log_plan(builder.plan())
+        return
+
     # Run builder
-    image = ImageBuilder(config, logger).run()
+    image = ImageBuilder(config, logger, cache_dir=cache_dir).run(
+        timings_file=args.timings,
+        reuse_unchanged=args.reuse_unchanged,
+        dedup=args.dedup,
+        delta_context=args.delta_context)
+
+    # Optionally save image to a tarball
+    if args.export:
+        logger.info('Exporting image to %s' % args.export)
+        image.export(args.export)
 
     # Optionally push image after building
     if args.push:
         logger.info('Pushing image to registry')
-        image.push()
+        image.push(skip_unchanged=not args.force_push)
 
     logger.info('Done')
 
@@ -0,0 +1,126 @@
+import os
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .fetch import FETCH_CONCURRENCY, HTTP_TIMEOUT, tree_size
+from .download import resumable_bytes
+from .fingerprint import FINGERPRINT_LABEL
+from .lazy import lazy_import
+
+docker = lazy_import('docker')
+requests = lazy_import('requests')
+
+logger = logging.getLogger(__name__)
+
+
+def probe_url(url, proxies=None, partial_dir=None, timeout=HTTP_TIMEOUT):
+    '''
+    returns what a download of url would transfer, without downloading it:
+    its size (None when the server does not tell), ETag and Last-Modified,
+    and the bytes a partial download in partial_dir already holds. Servers
+    refusing HEAD are asked with a GET whose body is not read.
+    '''
+    headers = {'Accept-Encoding': 'identity'}
+    r = requests.head(url,
+                      headers=headers,
+                      proxies=proxies,
+                      allow_redirects=True,
+                      timeout=timeout)
+    if r.status_code in (403, 405, 501):
+        r = requests.get(url,
+                         headers=headers,
+                         proxies=proxies,
+                         stream=True,
+                         timeout=timeout)
+        r.close()
+    if r.status_code != 200:
+        raise Exception('HTTP %s' % r.status_code)
+
+    size = r.headers.get('Content-Length')
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    if etag and etag.startswith('W/'):
+        # downloads only resume with strong validators
+        validator = last_modified
+    else:
+        validator = etag or last_modified
+
+    resumable = 0
+    if partial_dir and validator:
+        resumable = resumable_bytes(url, partial_dir, validator)
+
+    return {
+        'size': int(size) if size else None,
+        'etag': etag,
+        'last_modified': last_modified,
+        'resumable': resumable,
+    }
+
+
+def probe_files(files,
+                proxies=None,
+                partial_dir=None,
+                max_workers=FETCH_CONCURRENCY['http'],
+                logger=logger):
+    '''
+    adds the expected size of each `files` input to its dict, in place
+
+    http(s) urls are probed several at a time, local files and directories
+    are measured. The size of scp and ftp inputs is left unknown (None).
+
+    Arguments:
+        files (list): dicts with the `source` and `scheme` of each input
+        proxies (callable): returns the requests proxies of a url
+        partial_dir (Path): directory of the partial downloads kept between
+                            builds
+    '''
+    def probe(item):
+        if item['scheme'] == 'local':
+            path = os.path.expanduser(item['source'])
+            if not os.path.exists(path):
+                return {'size': None, 'error': 'not found'}
+            return {'size': tree_size(path)}
+
+        if item['scheme'] not in ('http', 'https'):
+            return {'size': None}
+
+        logger.debug('Probing %s' % item['source'])
+        try:
+            return probe_url(item['source'],
+                             proxies=proxies(item['source'])
+                             if proxies else None,
+                             partial_dir=partial_dir)
+        except Exception as e:
+            return {'size': None, 'error': str(e).strip()}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item, result in zip(files, executor.map(probe, files)):
+            item.update(result)
+
+    return files
+
+
+def layer_cache(api, base_image):
+    '''
+    returns whether the base image is present on the docker daemon, and the
+    number of images built here before on top of it, whose first build steps
+    (system packages, workspace setup) are likely to be reused from the
+    layer cache
+    '''
+    try:
+        base_id = api.inspect_image(base_image)['Id']
+    except docker.errors.ImageNotFound:
+        return {'base_image': False, 'builds': 0}
+
+    builds = 0
+    for image in api.images(filters={'label': FINGERPRINT_LABEL}):
+        try:
+            history = api.history(image['Id'])
+        except docker.errors.APIError:
+            continue
+        if any(layer.get('Id') == base_id for layer in history):
+            builds += 1
+
+    return {'base_image': True, 'builds': builds}
+
@@ -0,0 +1,384 @@
+import io
+import os
+import json
+import stat
+import time
+import uuid
+import logging
+import secrets
+import tarfile
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .fingerprint import file_digest, HASH_WORKERS
+from .lazy import lazy_import
+
+docker = lazy_import('docker')
+
+logger = logging.getLogger(__name__)
+
+# helper container (and its volume) keeping context blobs on the daemon side
+HELPER_NAME = 'pyats-image-builder-context'
+HELPER_VOLUME = 'pyats-image-builder-context'
+HELPER_LABEL = 'pyats-image-builder.context-cache'
+HELPER_ROOT = '/cache'
+HELPER_PORT = 8000
+# bump when the helper container changes, older ones are replaced
+HELPER_VERSION = '2'
+
+# blobs not used by any build for this long are removed from the helper
+BLOB_TTL = 7 * 24 * 3600
+
+# Runs inside the helper container, with the python of the base image.
+#   missing <key>         print digests from incoming/<key>/wanted.json that
+#                         are not stored yet
+#   assemble <key> <ttl>  store uploaded blobs, write contexts/<key>.tar from
+#                         incoming/<key>/manifest.json and the token it is
+#                         served with to contexts/<key>.token, prune unused
+#                         blobs
+#   remove <key>          delete contexts/<key>.tar and its token
+HELPER_SCRIPT = '''
+import os, sys, json, time, shutil, tarfile
+
+root = %(root)r
+command, key = sys.argv[1], sys.argv[2]
+incoming = os.path.join(root, 'incoming', key)
+contexts = os.path.join(root, 'contexts')
+
+
+def blob(digest):
+    return os.path.join(root, 'blobs', digest[:2], digest)
+
+
+def prune(directory, ttl):
+    expired = time.time() - ttl
+    for base, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(base, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+if command == 'missing':
+    with open(os.path.join(incoming, 'wanted.json')) as f:
+        for digest in json.load(f):
+            try:
+                # keep blobs in use from being pruned by other builds
+                os.utime(blob(digest))
+            except OSError:
+                print(digest)
+
+elif command == 'assemble':
+    uploaded = os.path.join(incoming, 'blobs')
+    if os.path.isdir(uploaded):
+        for digest in os.listdir(uploaded):
+            os.makedirs(os.path.dirname(blob(digest)), exist_ok=True)
+            os.replace(os.path.join(uploaded, digest), blob(digest))
+            os.utime(blob(digest))
+
+    with open(os.path.join(incoming, 'manifest.json')) as f:
+        entries = json.load(f)
+
+    os.makedirs(contexts, exist_ok=True)
+    target = os.path.join(contexts, key + '.tar')
+    with tarfile.open(target + '.tmp', 'w') as tar:
+        for name, kind, mode, mtime, value in entries:
+            info = tarfile.TarInfo(name)
+            info.mode = mode
+            info.mtime = mtime
+            if kind == 'dir':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif kind == 'symlink':
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+                tar.addfile(info)
+            elif kind == 'link':
+                info.type = tarfile.LNKTYPE
+                info.linkname = value
+                tar.addfile(info)
+            else:
+                info.size = os.path.getsize(blob(value))
+                with open(blob(value), 'rb') as f:
+                    tar.addfile(info, f)
+    os.replace(target + '.tmp', target)
+    os.replace(os.path.join(incoming, 'token'),
+               os.path.join(contexts, key + '.token'))
+
+    shutil.rmtree(incoming, ignore_errors=True)
+    prune(os.path.join(root, 'blobs'), int(sys.argv[3]))
+    # left behind by builds that did not finish
+    prune(contexts, 24 * 3600)
+    prune(os.path.join(root, 'incoming'), 24 * 3600)
+
+elif command == 'remove':
+    for name in (key + '.tar', key + '.token'):
+        try:
+            os.remove(os.path.join(contexts, name))
+        except OSError:
+            pass
+''' % {'root': HELPER_ROOT}
+
+# Serves the assembled contexts from the helper container, only as
+# /<key>.tar?token=<token> with the token of the build, and never lists them
+SERVE_SCRIPT = '''
+import os, re, hmac, shutil, urllib.parse
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+contexts = os.path.join(%(root)r, 'contexts')
+os.makedirs(contexts, exist_ok=True)
+context_path = re.compile(r'^/([0-9a-f]{32})\\.tar$')
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        match = context_path.match(url.path)
+        if not match:
+            return self.send_error(404)
+        token = urllib.parse.parse_qs(url.query).get('token', [''])[0]
+        path = os.path.join(contexts, match.group(1))
+        try:
+            with open(path + '.token') as f:
+                expected = f.read().strip()
+            if not hmac.compare_digest(token.encode(), expected.encode()):
+                return self.send_error(404)
+            f = open(path + '.tar', 'rb')
+        except OSError:
+            return self.send_error(404)
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('Content-Length',
+                             str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+Server(('', %(port)s), Handler).serve_forever()
+''' % {'root': HELPER_ROOT, 'port': HELPER_PORT}
+
+
+class DeltaContext(object):
+    def __init__(self, api, helper_image, logger=logger):
+        '''
+        build context transfer to a (remote) docker daemon that only sends
+        file content the daemon side does not have yet
+
+        A helper container on the daemon keeps a content-addressed store of
+        the files of previous contexts in a volume. For each build, the
+        missing blobs and a manifest of the context are uploaded, the helper
+        assembles the context tarball from the store and serves it over
+        HTTP, only with a token of the build, and the daemon builds from
+        that URL.
+
+        Arguments:
+            api (docker.APIClient): api client of the daemon to build on
+            helper_image (str): image to run the helper from, any image with
+                                python3 (eg. the base image of the build)
+        '''
+        self._logger = logger
+        self.api = api
+        self.helper_image = helper_image
+        self.key = None
+        self.stats = {}
+
+    def upload(self, path, dockerfile):
+        '''
+        upload the changed content of the build context at path
+
+        Returns:
+            URL of the assembled context, to pass to docker build
+        '''
+        self.key = uuid.uuid4().hex
+        token = secrets.token_hex(32)
+        entries, sources, size = self._manifest(path, dockerfile)
+
+        container = self._helper()
+        prefix = 'incoming/%s/' % self.key
+
+        wanted = json.dumps(sorted(sources)).encode()
+        sent = self._put(container, [(prefix + 'wanted.json', wanted)])
+        missing = self._exec(container, 'missing', self.key).split()
+
+        files = [(prefix + 'manifest.json', json.dumps(entries).encode()),
+                 (prefix + 'token', token.encode())]
+        files.extend((prefix + 'blobs/' + digest, sources[digest])
+                     for digest in missing)
+        sent += self._put(container, files)
+
+        self._exec(container, 'assemble', self.key, str(BLOB_TTL))
+
+        self.stats = {
+            'files': sum(1 for entry in entries if entry[1] == 'file'),
+            'context_bytes': size,
+            'blobs': len(sources),
+            'blobs_sent': len(missing),
+            'bytes_sent': sent,
+        }
+
+        return 'http://%s:%s/%s.tar?token=%s' % (
+            self._address(container), HELPER_PORT, self.key, token)
+
+    def remove(self):
+        '''
+        remove the assembled context of this build from the helper
+        '''
+        if self.key:
+            try:
+                self._exec(HELPER_NAME, 'remove', self.key)
+            except Exception:
+                self._logger.debug('Could not remove context %s' % self.key,
+                                   exc_info=True)
+
+    def _manifest(self, path, dockerfile):
+        # entries of the context tarball, in the order docker-py would tar
+        # them, and one local file per distinct content
+        path = str(path)
+        exclude = []
+        dockerignore = os.path.join(path, '.dockerignore')
+        if os.path.exists(dockerignore):
+            with open(dockerignore) as f:
+                exclude = [line.strip() for line in f.read().splitlines()
+                           if line.strip() and not line.startswith('#')]
+
+        entries = []
+        inodes = {}
+        files = []
+        size = 0
+        for name in sorted(docker.utils.build.exclude_paths(
+                path, exclude, dockerfile=dockerfile)):
+            full = os.path.join(path, name)
+            st = os.lstat(full)
+            mode = stat.S_IMODE(st.st_mode)
+            mtime = int(st.st_mtime)
+            if stat.S_ISDIR(st.st_mode):
+                entries.append([name, 'dir', mode, mtime, None])
+            elif stat.S_ISLNK(st.st_mode):
+                entries.append(
+                    [name, 'symlink', mode, mtime, os.readlink(full)])
+            elif not stat.S_ISREG(st.st_mode):
+                # sockets and such are left out by docker-py as well
+                continue
+            elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                # keep hard links (eg. from deduplication) as links
+                entries.append([name, 'link', mode, mtime,
+                                inodes[(st.st_dev, st.st_ino)]])
+            else:
+                inodes[(st.st_dev, st.st_ino)] = name
+                entries.append([name, 'file', mode, mtime, None])
+                files.append((len(entries) - 1, full))
+                size += st.st_size
+
+        sources = {}
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            for (index, full), digest in zip(
+                    files, executor.map(file_digest, [f for _, f in files])):
+                entries[index][4] = digest
+                sources.setdefault(digest, full)
+
+        return entries, sources, size
+
+    def _helper(self):
+        # returns the id of the running helper container, creating it first
+        # when needed
+        try:
+            info = self.api.inspect_container(HELPER_NAME)
+        except docker.errors.NotFound:
+            info = None
+
+        labels = (info['Config'].get('Labels') or {}) if info else {}
+        if info and labels.get(HELPER_LABEL) != HELPER_VERSION:
+            # created by an older version, eg. serving directory listings
+            self._logger.info('Replacing context cache container %s' %
+                              HELPER_NAME)
+            try:
+                self.api.remove_container(info['Id'], force=True)
+            except docker.errors.NotFound:
+                pass
+            info = None
+
+        if info is None:
+            self._create_helper()
+            info = self.api.inspect_container(HELPER_NAME)
+
+        if not info['State']['Running']:
+            self.api.start(info['Id'])
+
+        return info['Id']
+
+    def _create_helper(self):
+        self._logger.info('Creating context cache container %s' % HELPER_NAME)
+        try:
+            self.api.inspect_image(self.helper_image)
+        except docker.errors.ImageNotFound:
+            repository, tag = docker.utils.parse_repository_tag(
+                self.helper_image)
+            self.api.pull(repository, tag=tag)
+
+        host_config = self.api.create_host_config(
+            binds={HELPER_VOLUME: {'bind': HELPER_ROOT, 'mode': 'rw'}},
+            restart_policy={'Name': 'unless-stopped'})
+        try:
+            self.api.create_container(
+                self.helper_image,
+                name=HELPER_NAME,
+                entrypoint=['python3', '-c'],
+                command=[SERVE_SCRIPT],
+                labels={HELPER_LABEL: HELPER_VERSION},
+                host_config=host_config)
+        except docker.errors.APIError as e:
+            # created by a concurrent build in the meantime
+            if e.status_code != 409:
+                raise
+
+    def _address(self, container):
+        # address the daemon reaches the helper at
+        settings = self.api.inspect_container(container)['NetworkSettings']
+        if settings.get('IPAddress'):
+            return settings['IPAddress']
+        for network in settings.get('Networks', {}).values():
+            if network.get('IPAddress'):
+                return network['IPAddress']
+        raise Exception('Context cache container %s has no IP address' %
+                        HELPER_NAME)
+
+    def _exec(self, container, *args):
+        exec_id = self.api.exec_create(
+            container, ['python3', '-c', HELPER_SCRIPT] + list(args))['Id']
+        output = self.api.exec_start(exec_id).decode(errors='replace')
+        if self.api.exec_inspect(exec_id)['ExitCode']:
+            raise Exception('Context cache %s failed:\n%s' % (args[0], output))
+        return output
+
+    def _put(self, container, files):
+        # upload (name, bytes or local file path) pairs below the helper
+        # root, returns the number of bytes sent
+        with tempfile.TemporaryFile() as archive:
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for name, content in files:
+                    info = tarfile.TarInfo(name)
+                    info.mode = 0o644
+                    info.mtime = time.time()
+                    if isinstance(content, bytes):
+                        info.size = len(content)
+                        tar.addfile(info, io.BytesIO(content))
+                    else:
+                        info.size = os.path.getsize(content)
+                        with open(content, 'rb') as f:
+                            tar.addfile(info, f)
+
+            size = archive.tell()
+            archive.seek(0)
+            self.api.put_archive(container, HELPER_ROOT, archive)
+
+        return size
@@ -1,4 +1,6 @@
-import jsonschema
+from .lazy import lazy_import
+
+jsonschema = lazy_import('jsonschema')
 
 BUILD_SCHEMA = {
     # Nothing is required
@@ -113,6 +115,29 @@ BUILD_SCHEMA = {
                         },
                         'GIT_SSL_NO_VERIFY': {
                             'type': 'boolean'
+                        },
+                        'submodules': {
+                            'oneOf': [{
+                                'type': 'boolean'
+                            }, {
+                                'type': 'object',
+                                'additionalProperties': False,
+                                'properties': {
+                                    'recursive': {
+                                        'type': 'boolean'
+                                    },
+                                    'jobs': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    },
+                                    'shallow': {
+                                        'type': 'boolean'
+                                    },
+                                    'reference': {
+                                        'type': 'string'
+                                    }
+                                }
+                            }]
                         }
                     }
                 }
@@ -167,6 +192,61 @@ BUILD_SCHEMA = {
                 },
                 'post': {
                     'type': 'string'
+                },
+                'runtime': {
+                    'type': 'string'
+                }
+            }
+        },
+        'multistage': {
+            'type': 'boolean'
+        },
+        'precompile': {
+            'type': 'boolean'
+        },
+        'fetch': {
+            'type': 'object',
+            'additionalProperties': False,
+            'properties': {
+                'retries': {
+                    'type': 'integer',
+                    'minimum': 0
+                },
+                'backoff': {
+                    'type': 'number',
+                    'minimum': 0
+                },
+                'max_backoff': {
+                    'type': 'number',
+                    'minimum': 0
+                },
+                # MB/s of http/ftp/scp transfers together, 0 for unlimited.
+                # git clones are not limited
+                'bandwidth': {
+                    'type': 'number',
+                    'minimum': 0
+                },
+                'host_limit': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
+                # parallel ranges of large http downloads
+                'segments': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
+                # MB, smaller downloads are not split
+                'split_size': {
+                    'type': 'number',
+                    'minimum': 0
+                },
+                # per host limits
+                'hosts': {
+                    'type': 'object',
+                    'additionalProperties': {
+                        'type': 'integer',
+                        'minimum': 1
+                    }
                 }
             }
         },
@@ -197,5 +277,18 @@ BUILD_SCHEMA = {
 }
 
 
+_validator = None
+
+
 def validate_builder_schema(data):
-    jsonschema.validate(data, BUILD_SCHEMA)
+    # same as jsonschema.validate(data, BUILD_SCHEMA), but the schema is only
+    # checked and compiled once per process
+    global _validator
+    if _validator is None:
+        cls = jsonschema.validators.validator_for(BUILD_SCHEMA)
+        cls.check_schema(BUILD_SCHEMA)
+        _validator = cls(BUILD_SCHEMA)
+
+    error = jsonschema.exceptions.best_match(_validator.iter_errors(data))
+    if error is not None:
+        raise error
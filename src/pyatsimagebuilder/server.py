@@ -0,0 +1,654 @@
+import os
+import sys
+import hmac
+import json
+import uuid
+import signal
+import socket
+import logging
+import argparse
+import datetime
+import secrets
+import threading
+import socketserver
+import urllib.parse
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .builder import ImageBuilder
+from .cache import DEFAULT_CACHE_DIR
+from .schema import validate_builder_schema
+from .lazy import lazy_import
+
+yaml = lazy_import('yaml')
+docker = lazy_import('docker')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8700
+DEFAULT_WORKERS = 1
+DEFAULT_HISTORY = 100
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+# every request has to carry the token of the server in this header, as
+# `Bearer <token>`
+TOKEN_HEADER = 'Authorization'
+
+# content types of POST /builds. Browsers send the "simple" ones (eg.
+# text/plain) cross-origin without asking first, they are refused.
+YAML_CONTENT_TYPES = ('application/yaml', 'application/x-yaml')
+JSON_CONTENT_TYPES = ('application/json', )
+
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+
+# build options accepted as query parameters of POST /builds
+BOOLEAN_OPTIONS = ('no_cache', 'dry_run', 'keep_context', 'push',
+                   'force_push', 'reuse_unchanged', 'dedup',
+                   'delta_context')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class BuildLogHandler(logging.Handler):
+    def __init__(self, build):
+        '''
+        logging handler collecting the log lines of one build
+        '''
+        super().__init__()
+        self.build = build
+
+    def emit(self, record):
+        try:
+            self.build.append_log(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class Build(object):
+    def __init__(self, config, options, handlers=()):
+        '''
+        a build request submitted to the server, and its state and logs
+        '''
+        self.id = uuid.uuid4().hex[:12]
+        self.config = config
+        self.options = options
+
+        self.status = QUEUED
+        self.created = _now()
+        self.started = None
+        self.finished = None
+        self.image_id = None
+        self.tag = None
+        self.pushed = None
+        self.error = None
+        self.timings = None
+
+        self.logs = []
+        self._condition = threading.Condition()
+
+        # not registered with the logging module, so finished builds can be
+        # garbage collected
+        self.logger = logging.Logger('%s.build.%s' % (__name__, self.id),
+                                     logging.DEBUG)
+        handler = BuildLogHandler(self)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.logger.addHandler(handler)
+        for handler in handlers:
+            self.logger.addHandler(handler)
+
+    def append_log(self, line):
+        with self._condition:
+            self.logs.append(line)
+            self._condition.notify_all()
+
+    def set_status(self, status):
+        with self._condition:
+            self.status = status
+            if status == RUNNING:
+                self.started = _now()
+            elif status in FINISHED:
+                self.finished = _now()
+            self._condition.notify_all()
+
+    def follow_logs(self, start=0, timeout=None):
+        '''
+        yield log lines from `start`, waiting for new lines until the build
+        is finished
+        '''
+        index = start
+        while True:
+            with self._condition:
+                while index >= len(self.logs) and \
+                        self.status not in FINISHED:
+                    if not self._condition.wait(timeout):
+                        return
+                lines = self.logs[index:]
+                done = self.status in FINISHED
+            index += len(lines)
+            yield from lines
+            if done and index >= len(self.logs):
+                return
+
+    def to_dict(self):
+        def iso(value):
+            return value.isoformat() if value else None
+
+        duration = None
+        if self.started:
+            duration = ((self.finished or _now()) -
+                        self.started).total_seconds()
+
+        return {
+            'id': self.id,
+            'status': self.status,
+            'tag': self.tag,
+            'image_id': self.image_id,
+            'pushed': self.pushed,
+            'error': self.error,
+            'options': self.options,
+            'created': iso(self.created),
+            'started': iso(self.started),
+            'finished': iso(self.finished),
+            'duration': duration,
+            'timings': self.timings,
+        }
+
+
+class BuildServer(object):
+    def __init__(self,
+                 workers=DEFAULT_WORKERS,
+                 cache_dir=DEFAULT_CACHE_DIR,
+                 history=DEFAULT_HISTORY,
+                 logger=logging.getLogger(__name__)):
+        '''
+        runs submitted builds in a pool of worker threads
+
+        the python process, compiled schema, docker api client and caches
+        are shared by all the builds, so they are only set up once.
+        '''
+        self._logger = logger
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.history = history
+
+        self._builds = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._docker_api = None
+        self._stopping = False
+
+        # build logs are also echoed to the server log
+        self._handlers = list(logger.handlers)
+
+    @property
+    def docker_api(self):
+        with self._lock:
+            if self._docker_api is None:
+                self._docker_api = docker.from_env().api
+            return self._docker_api
+
+    def submit(self, config, options=None):
+        '''
+        validate and queue a build
+
+        Arguments
+        ---------
+            config (dict): Build configuration
+            options (dict): tag, no_cache, dry_run, keep_context, push,
+                            force_push, reuse_unchanged, dedup and
+                            delta_context options of the build
+
+        Returns
+        -------
+            Build object
+        '''
+        if self._stopping:
+            raise RuntimeError('Server is shutting down')
+
+        # reject invalid configurations straight away
+        validate_builder_schema(config)
+
+        build = Build(config, dict(options or {}), self._handlers)
+        with self._lock:
+            self._builds[build.id] = build
+            self._prune()
+
+        self._logger.info('Queued build %s' % build.id)
+        self._executor.submit(self._run, build)
+        return build
+
+    def _prune(self):
+        # drop the oldest finished builds beyond the history size
+        finished = [b for b in self._builds.values() if b.status in FINISHED]
+        for build in finished[:max(0, len(self._builds) - self.history)]:
+            del self._builds[build.id]
+
+    def get(self, build_id):
+        with self._lock:
+            return self._builds.get(build_id)
+
+    def builds(self):
+        with self._lock:
+            return list(self._builds.values())
+
+    def status(self):
+        builds = self.builds()
+        return {
+            'workers': self.workers,
+            'cache_dir': self.cache_dir,
+            'queued': sum(1 for b in builds if b.status == QUEUED),
+            'running': sum(1 for b in builds if b.status == RUNNING),
+            'builds': len(builds),
+        }
+
+    def _run(self, build):
+        if self._stopping:
+            build.set_status(CANCELLED)
+            return
+
+        build.set_status(RUNNING)
+        options = build.options
+        logger = build.logger
+        try:
+            api = None if options.get('dry_run') else self.docker_api
+
+            builder = ImageBuilder(build.config,
+                                   logger,
+                                   cache_dir=self.cache_dir,
+                                   docker_api=api)
+            try:
+                image = builder.run(keep_context=options.get('keep_context',
+                                                             False),
+                                    tag=options.get('tag'),
+                                    no_cache=options.get('no_cache', False),
+                                    dry_run=options.get('dry_run', False),
+                                    reuse_unchanged=options.get(
+                                        'reuse_unchanged', False),
+                                    dedup=options.get('dedup', False),
+                                    delta_context=options.get(
+                                        'delta_context', False))
+            finally:
+                if builder.timings:
+                    build.timings = builder.timings.to_dict()
+
+            build.image_id = image.id
+            build.tag = image.tag
+
+            if options.get('push') and not options.get('dry_run'):
+                logger.info('Pushing image to registry')
+                build.pushed = image.push(
+                    skip_unchanged=not options.get('force_push'), api=api)
+
+        except Exception as e:
+            logger.exception('Build %s failed' % build.id)
+            build.error = '%s: %s' % (type(e).__name__, e)
+            build.set_status(FAILED)
+        else:
+            logger.info('Build %s done' % build.id)
+            build.set_status(SUCCEEDED)
+
+    def shutdown(self):
+        '''
+        stop accepting builds, cancel queued ones and wait for the running
+        builds to finish
+        '''
+        self._stopping = True
+        self._executor.shutdown(wait=True)
+        if self._docker_api is not None:
+            self._docker_api.close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP API of the build server
+
+    Every request has to send the token of the server (`Authorization:
+    Bearer <token>`), with a Host header naming the address the server
+    listens on. Build files are posted as application/yaml or
+    application/json.
+
+        GET  /                      server status
+        GET  /builds                all known builds
+        POST /builds                submit a build YAML, options as query
+                                    parameters (tag, no_cache, dry_run,
+                                    keep_context, push, force_push,
+                                    reuse_unchanged, dedup,
+                                    delta_context)
+        GET  /builds/<id>           build status
+        GET  /builds/<id>/logs      build logs, streamed until the build is
+                                    finished unless ?follow=0
+    '''
+    server_version = 'pyats-image-serve'
+
+    @property
+    def build_server(self):
+        return self.server.build_server
+
+    def address_string(self):
+        # unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        self.build_server._logger.debug('%s - %s' % (self.address_string(),
+                                                     format % args))
+
+    def _send_json(self, data, code=200):
+        body = json.dumps(data, indent=2).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        self._send_json({'error': message}, code)
+
+    def _authorized(self):
+        # refuse requests without the token, and requests for another host
+        # name (DNS rebinding), before anything else
+        server = self.server
+        if server.allowed_hosts is not None:
+            host = urllib.parse.urlsplit(
+                '//%s' % self.headers.get('Host', '')).hostname
+            if host not in server.allowed_hosts:
+                self._send_error(403, 'Host not allowed')
+                return False
+
+        scheme, _, token = self.headers.get(TOKEN_HEADER, '').partition(' ')
+        if scheme.lower() != 'bearer' or \
+                not hmac.compare_digest(token.strip().encode(),
+                                        server.token.encode()):
+            self._send_error(401, 'Missing or invalid token')
+            return False
+        return True
+
+    def _route(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return parts, query
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        parts, query = self._route()
+
+        if not parts:
+            return self._send_json(self.build_server.status())
+
+        if parts == ['builds']:
+            return self._send_json(
+                [b.to_dict() for b in self.build_server.builds()])
+
+        if parts[0] != 'builds' or len(parts) > 3:
+            return self._send_error(404, 'Not found')
+
+        build = self.build_server.get(parts[1])
+        if build is None:
+            return self._send_error(404, 'No build %s' % parts[1])
+
+        if len(parts) == 2:
+            return self._send_json(build.to_dict())
+
+        if parts[2] != 'logs':
+            return self._send_error(404, 'Not found')
+
+        follow = _parse_bool(query.get('follow', '1'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        if follow:
+            lines = build.follow_logs()
+        else:
+            lines = list(build.logs)
+        try:
+            for line in lines:
+                self.wfile.write(line.encode() + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # client stopped following
+            pass
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        parts, query = self._route()
+
+        if parts != ['builds']:
+            return self._send_error(404, 'Not found')
+
+        content_type = self.headers.get('Content-Type', '')
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type not in YAML_CONTENT_TYPES + JSON_CONTENT_TYPES:
+            return self._send_error(
+                415, 'Content-Type must be one of: %s' %
+                ', '.join(YAML_CONTENT_TYPES + JSON_CONTENT_TYPES))
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        if content_type in JSON_CONTENT_TYPES:
+            try:
+                config = json.loads(body.decode() or '{}')
+            except ValueError as e:
+                return self._send_error(400, 'Invalid JSON: %s' % e)
+        else:
+            try:
+                config = yaml.safe_load(body) or {}
+            except yaml.YAMLError as e:
+                return self._send_error(400, 'Invalid YAML: %s' % e)
+        if not isinstance(config, dict):
+            return self._send_error(400, 'The build file must be a mapping')
+
+        options = {}
+        if query.get('tag'):
+            options['tag'] = query['tag']
+        for option in BOOLEAN_OPTIONS:
+            if option in query:
+                options[option] = _parse_bool(query[option])
+
+        try:
+            build = self.build_server.submit(config, options)
+        except RuntimeError as e:
+            return self._send_error(503, str(e))
+        except Exception as e:
+            # schema validation errors
+            return self._send_error(400, getattr(e, 'message', str(e)))
+
+        self._send_json(build.to_dict(), 202)
+
+
+def _parse_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        # only the user running the server can connect
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        # HTTPServer attributes used by BaseHTTPRequestHandler
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def make_server(build_server, token, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                unix_socket=None, allowed_hosts=()):
+    '''
+    returns the HTTP server for the given BuildServer, listening on a unix
+    socket if one is given (only accessible to the current user), otherwise
+    on host:port
+
+    Arguments:
+        token (str): token every request has to send
+        allowed_hosts (list): host names accepted in the Host header, besides
+                              the address listened on (and localhost for
+                              loopback addresses). Not checked on unix
+                              sockets, or when listening on all addresses
+                              without any given.
+    '''
+    if not token:
+        raise ValueError('The build server requires a token')
+
+    if unix_socket:
+        httpd = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+        httpd.allowed_hosts = None
+    else:
+        httpd = ThreadingHTTPServer((host, port), RequestHandler)
+        hosts = set(h.lower() for h in allowed_hosts or ())
+        if host not in WILDCARD_HOSTS:
+            hosts.add(host.strip('[]'))
+            if host.strip('[]') in LOOPBACK_HOSTS:
+                hosts.update(LOOPBACK_HOSTS)
+        httpd.allowed_hosts = hosts or None
+    httpd.build_server = build_server
+    httpd.token = token
+    return httpd
+
+
+def read_token(path):
+    '''
+    returns the token kept in the file at path, creating the file (readable
+    by the current user only) with a new token if there is none
+    '''
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        token = None
+    if token:
+        return token
+
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return token
+
+
+def main(argv=None, prog='pyats-image-serve'):
+    """
+    Command line entrypoint
+    """
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Run a pyATS image build server with a local HTTP API')
+    parser.add_argument('--host',
+                        default=DEFAULT_HOST,
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--port',
+                        type=int,
+                        default=DEFAULT_PORT,
+                        help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--socket',
+                        metavar='PATH',
+                        help='Listen on this unix socket instead of a port')
+    parser.add_argument('--token-file',
+                        metavar='PATH',
+                        help='File holding the token clients have to send, '
+                        'created with a new token if missing (default: a '
+                        'new token is generated and printed at start)')
+    parser.add_argument('--allowed-host',
+                        action='append',
+                        default=[],
+                        metavar='HOST',
+                        help='Host name clients may use to reach the server, '
+                        'besides the listening address (can be repeated)')
+    parser.add_argument('--workers',
+                        '-w',
+                        type=int,
+                        default=DEFAULT_WORKERS,
+                        help='Number of builds to run at the same time '
+                        '(default: %(default)s)')
+    parser.add_argument('--history',
+                        type=int,
+                        default=DEFAULT_HISTORY,
+                        help='Number of finished builds to keep the status '
+                        'and logs of (default: %(default)s)')
+    parser.add_argument('--cache-dir',
+                        default=DEFAULT_CACHE_DIR,
+                        help='Directory for caches kept between builds '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-disk-cache',
+                        action='store_true',
+                        help='Do not use or update the caches kept between '
+                        'builds')
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+
+    cache_dir = None if args.no_disk_cache else args.cache_dir
+    build_server = BuildServer(workers=args.workers,
+                               cache_dir=cache_dir,
+                               history=args.history,
+                               logger=logger)
+    if args.token_file:
+        token = read_token(args.token_file)
+    else:
+        token = secrets.token_urlsafe(32)
+    httpd = make_server(build_server,
+                        token,
+                        host=args.host,
+                        port=args.port,
+                        unix_socket=args.socket,
+                        allowed_hosts=args.allowed_host)
+
+    # stop the same way on SIGTERM (eg. from a service manager) as on ctrl-c
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    logger.info('Serving builds on %s with %s worker(s)' %
+                (args.socket or '%s:%s' % (args.host, args.port),
+                 args.workers))
+    if args.token_file:
+        logger.info('Clients authenticate with the token in %s' %
+                    args.token_file)
+    else:
+        logger.info('Clients authenticate with: %s: Bearer %s' %
+                    (TOKEN_HEADER, token))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Shutting down, waiting for running builds')
+    finally:
+        httpd.server_close()
+        build_server.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import os
+import re
+import sys
+import json
+import logging
+import tarfile
+import argparse
+import datetime
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import git_auth_env
+from .fetch import FETCH_CONCURRENCY
+from .cache import DEFAULT_CACHE_DIR
+from .lazy import lazy_import
+
+git = lazy_import('git')
+yaml = lazy_import('yaml')
+docker = lazy_import('docker')
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_FILE = 'snapshot.yaml'
+
+FULL_SHA = re.compile(r'^[0-9a-fA-F]{40}$')
+ABBREVIATED_SHA = re.compile(r'^[0-9a-fA-F]{4,39}$')
+
+# Runs in the base image of the build, resolves all the requirement files of
+# the context (in install order) to the packages pip would install, as a pip
+# installation report (pip >= 22.2) on stdout
+RESOLVE_SCRIPT = '''
+set -e
+reqs=""
+for req in `ls %(workspace)s/installation/requirements/*.txt | sort -V`; do
+    reqs="$reqs --requirement $req"
+done
+if [ -f %(workspace)s/pip.conf ]; then
+    export PIP_CONFIG_FILE=%(workspace)s/pip.conf
+fi
+pip3 install --quiet --disable-pip-version-check --upgrade pip >&2
+pip3 install --dry-run --ignore-installed --quiet \\
+    --disable-pip-version-check --report - $reqs
+'''
+
+
+def resolve_ref(url,
+                ref=None,
+                credentials=None,
+                ssh_key=None,
+                GIT_SSL_NO_VERIFY=False,
+                env=None):
+    '''
+    returns the commit a branch, tag or HEAD (by default) of a remote
+    repository points to, with `git ls-remote`. Full commit ids are returned
+    as they are.
+    '''
+    if ref and FULL_SHA.match(ref):
+        return ref.lower()
+
+    env = dict(env or {})
+    if GIT_SSL_NO_VERIFY:
+        env['GIT_SSL_NO_VERIFY'] = 'true'
+
+    ref = ref or 'HEAD'
+    with git_auth_env(env, credentials=credentials, ssh_key=ssh_key,
+                      url=url) as env:
+        # the peeled entries of annotated tags only match their own pattern
+        out = git.Git().ls_remote(url, ref, ref + '^{}', env=env)
+
+    refs = {}
+    for line in out.splitlines():
+        commit, name = line.split('\t', 1)
+        refs[name] = commit
+
+    # same precedence as git rev-parse, annotated tags peeled to the commit
+    for name in (ref, 'refs/%s' % ref, 'refs/tags/%s' % ref,
+                 'refs/heads/%s' % ref):
+        if name + '^{}' in refs:
+            return refs[name + '^{}']
+        if name in refs:
+            return refs[name]
+
+    if ABBREVIATED_SHA.match(ref):
+        # only a clone could tell the full commit id, and it already names
+        # a single commit
+        return ref.lower()
+
+    raise Exception('%s not found in %s' % (ref, url))
+
+
+def resolve_repositories(repositories,
+                         env=None,
+                         max_workers=FETCH_CONCURRENCY['git'],
+                         logger=logger):
+    '''
+    resolves the `commit_id` of repositories (as in the build file) to
+    commits, several at a time
+
+    Returns:
+        dict of repository name to url and commit_id, in the given order
+    '''
+    def resolve(item):
+        name, vals = item
+        logger.info('Resolving %s %s' % (vals['url'],
+                                         vals.get('commit_id', 'HEAD')))
+        return resolve_ref(vals['url'],
+                           vals.get('commit_id'),
+                           credentials=vals.get('credentials'),
+                           ssh_key=vals.get('ssh_key'),
+                           GIT_SSL_NO_VERIFY=vals.get('GIT_SSL_NO_VERIFY',
+                                                      False),
+                           env=env)
+
+    items = list(repositories.items())
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(resolve, item) for item in items]
+
+    resolved = {}
+    errors = []
+    for (name, vals), future in zip(items, futures):
+        try:
+            resolved[name] = {'url': vals['url'],
+                              'commit_id': future.result()}
+        except Exception as e:
+            logger.error('Failed to resolve %s: %s' % (vals['url'], e))
+            errors.append('- %s: %s' % (vals['url'], str(e).strip()))
+
+    if errors:
+        raise Exception('Could not resolve %s repositories:\n%s' %
+                        (len(errors), '\n'.join(errors)))
+
+    return resolved
+
+
+def resolve_packages(api, image, context_path, env=None, logger=logger):
+    '''
+    resolves the requirement files of a populated build context to the exact
+    versions pip installs, by running pip's resolver in the base image of
+    the build. Requirements given by url or path are left out, they stay in
+    the requirement files.
+
+    Arguments:
+        api (docker.APIClient): docker api client
+        image (Image): image being built (base image, workspace, platform)
+        context_path (Path): populated build context directory
+        env (dict): environment of pip (eg. proxies)
+
+    Returns:
+        sorted list of `name==version`
+    '''
+    requirements = os.path.join(str(context_path), 'installation',
+                                'requirements')
+    if not any(name.endswith('.txt') for name in os.listdir(requirements)):
+        return []
+
+    base = '%s:%s' % (image.base_image, image.base_image_label)
+    try:
+        api.inspect_image(base)
+    except docker.errors.ImageNotFound:
+        logger.info('Pulling %s' % base)
+        repository, tag = docker.utils.parse_repository_tag(base)
+        api.pull(repository, tag=tag)
+
+    workspace = image.workspace_dir
+    container = api.create_container(
+        base,
+        entrypoint=['sh', '-c'],
+        command=[RESOLVE_SCRIPT % {'workspace': workspace}],
+        environment=env or {},
+        working_dir=workspace,
+        platform=image.platform)['Id']
+    try:
+        # the whole context, so requirements given by path resolve the same
+        # way as in the build
+        with tempfile.TemporaryFile() as archive:
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                tar.add(str(context_path), arcname=workspace.lstrip('/'))
+            archive.seek(0)
+            api.put_archive(container, '/', archive)
+
+        logger.info('Resolving python packages in %s' % base)
+        api.start(container)
+        status = api.wait(container)['StatusCode']
+        if status:
+            raise Exception('Could not resolve python packages:\n%s' %
+                            api.logs(container, stdout=False,
+                                     stderr=True).decode(errors='replace'))
+        report = json.loads(api.logs(container, stdout=True, stderr=False))
+    finally:
+        api.remove_container(container, force=True)
+
+    packages = []
+    for item in report.get('install', []):
+        if item.get('is_direct'):
+            continue
+        packages.append('%s==%s' % (item['metadata']['name'],
+                                    item['metadata']['version']))
+
+    return sorted(packages, key=str.lower)
+
+
+def write_snapshot(snapshot, path, source=None):
+    '''
+    writes a snapshot as YAML, to be used with `snapshot: <path>` in the
+    build file
+    '''
+    header = '# pyATS image snapshot'
+    if source:
+        header += ' of %s' % source
+    header += ', %s\n' % datetime.datetime.now(
+        datetime.timezone.utc).replace(microsecond=0).isoformat()
+
+    with open(path, 'w') as f:
+        f.write(header)
+        f.write('# use with `snapshot: %s` in the build file\n' %
+                os.path.basename(path))
+        yaml.safe_dump(snapshot, f, default_flow_style=False,
+                       sort_keys=False)
+
+
+def main(argv=None, prog='pyats-image-snapshot'):
+    """
+    Command line entrypoint
+    """
+    # builder uses the resolvers above
+    from .builder import ImageBuilder
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Resolve the branches, tags and python packages of a '
+        'build file to exact commits and versions, and write them to a '
+        'snapshot file for reproducible builds')
+    parser.add_argument('file',
+                        help='YAML file describing the image build details.')
+    parser.add_argument('--output',
+                        '-o',
+                        default=DEFAULT_SNAPSHOT_FILE,
+                        help='Snapshot file to write (default: %(default)s)')
+    parser.add_argument('--no-packages',
+                        action='store_true',
+                        help='Only resolve repositories, without python '
+                        'packages (which needs docker)')
+    parser.add_argument('--cache-dir',
+                        default=DEFAULT_CACHE_DIR,
+                        help='Directory for caches kept between builds '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-disk-cache',
+                        action='store_true',
+                        help='Do not use or update the caches kept between '
+                        'builds')
+    parser.add_argument('--verbose',
+                        '-v',
+                        action='store_true',
+                        help='Prints debug output')
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    with open(args.file, 'r') as file:
+        config = yaml.safe_load(file.read())
+
+    cache_dir = None if args.no_disk_cache else args.cache_dir
+    snapshot = ImageBuilder(config, logger, cache_dir=cache_dir).snapshot(
+        packages=not args.no_packages)
+
+    write_snapshot(snapshot, args.output, source=args.file)
+    logger.info('Snapshot of %s repositories and %s packages written to %s' %
+                (len(snapshot.get('repositories', {})),
+                 len(snapshot.get('packages', [])), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+
+class Timings(object):
+    def __init__(self):
+        '''
+        collection of nested timing spans recorded during a build
+        '''
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.spans = []
+
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **attrs):
+        '''
+        time the enclosed block as a span named `name`
+
+        spans opened inside another span (in the same thread) are recorded as
+        its children. Spans opened from worker threads can be attached to a
+        span explicitly using `parent`.
+        '''
+        stack = self._stack()
+        if parent is None and stack:
+            parent = stack[-1]
+
+        record = {'name': name}
+        record.update(attrs)
+        record['start'] = round(time.perf_counter() - self._origin, 6)
+        record['duration'] = None
+        record['spans'] = []
+
+        with self._lock:
+            if parent is None:
+                self.spans.append(record)
+            else:
+                parent['spans'].append(record)
+
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['duration'] = round(time.perf_counter() - start, 6)
+            stack.remove(record)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'started': self.started.isoformat(),
+                'total': round(time.perf_counter() - self._origin, 6),
+                'spans': self.spans
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+
+def span(timings, name, **attrs):
+    '''
+    returns timings.span(...) or a no-op context when timings is None
+    '''
+    if timings is None:
+        return contextlib.nullcontext()
+    return timings.span(name, **attrs)
@@ -1,6 +1,5 @@
 import re
 import ssl
-import git
 import shutil
 import ftplib
 import pathlib
@@ -9,10 +8,21 @@ import os
 import tempfile
 import logging
 import json
-import yaml
 import sys
+import heapq
+import asyncio
+import threading
+import contextlib
+import multiprocessing
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .timings import span
+from .lazy import lazy_import
+
+git = lazy_import('git')
+requests = lazy_import('requests')
+yaml = lazy_import('yaml')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -26,9 +36,49 @@ DEFAULT_JOB_REGEXES = [
 ]
 MANIFEST_REGEX = r'.*\.tem$'
 MANIFEST_VERSION = 1
+# bump when the parsing of manifest files changes, invalidates cached results
+MANIFEST_PARSER_VERSION = 1
+# bump when the per repository discovery results change, invalidates cached
+# results
+DISCOVERY_VERSION = 1
 
 GIT_REGEX = r'.*\.git$'
 
+# parallel fetches of `git submodule update`
+SUBMODULE_JOBS = 4
+
+IMPORTTIME_REGEX = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+'
+                              r'(?P<cumulative>\d+) \| (?P<indent> *)'
+                              r'(?P<module>\S+)')
+
+# below this many manifests to parse, starting worker processes costs more
+# than it saves
+PROCESS_POOL_THRESHOLD = 256
+
+# number of manifests parsed and enriched at a time when streaming
+MANIFEST_BATCH_SIZE = 512
+
+
+def run_async(coroutine):
+    """ Run a coroutine to completion and return its result
+
+    Uses a separate thread when called from within a running event loop
+    (eg. from async code or a notebook).
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        running = False
+    else:
+        running = True
+
+    if not running:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
 def copy(fro, to):
     # Copy either a single file or an entire directory
     fro = pathlib.Path(fro).expanduser()
@@ -41,23 +91,29 @@ def copy(fro, to):
         raise OSError('Cannot copy %s' % fro)
 
 
-def scp(host, from_path, to_path, port=None):
-    # scp file or dir. Must have passwordless ssh set up.
+def scp(host, from_path, to_path, port=None, env=None, limit=None):
+    # scp file or dir. Must have passwordless ssh set up. limit is the
+    # bandwidth in Kbit/s.
     scp_cmd = 'scp -B -r '
     if port:
         scp_cmd += '-P %s ' % port
+    if limit:
+        scp_cmd += '-l %s ' % limit
     scp_cmd += '%s:%s %s' % (host, from_path, to_path)
     p = subprocess.Popen(scp_cmd,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.STDOUT,
-                         shell=True)
+                         shell=True,
+                         env=dict(os.environ, **env) if env else None)
     return_code = p.wait()
     if return_code != 0:
         raise Exception('Could not scp %s' % from_path)
     return return_code
 
 
-def ftp_retrieve(host, from_path, to_path, port=None, secure=False):
+def ftp_retrieve(host, from_path, to_path, port=None, secure=False,
+                 throttle=None):
+    # throttle is called with the size of each block received
     if secure:
         ftp = ftplib.FTP_TLS(context=ssl.create_default_context())
     else:
@@ -66,7 +122,13 @@ def ftp_retrieve(host, from_path, to_path, port=None, secure=False):
     ftp.connect(*host)
     ftp.login()
     with open(to_path, 'wb') as f:
-        ftp.retrbinary('RETR ' + from_path, f.write, 1024)
+
+        def write(block):
+            f.write(block)
+            if throttle:
+                throttle(len(block))
+
+        ftp.retrbinary('RETR ' + from_path, write, 1024)
     ftp.close()
 
 
@@ -109,73 +171,145 @@ def git_clone(url,
               rm_git=False,
               credentials=None,
               ssh_key=None,
-              GIT_SSL_NO_VERIFY=False):
+              GIT_SSL_NO_VERIFY=False,
+              env=None,
+              submodules=None):
     # Clone the repo
 
-    GIT_SSL_NO_VERIFY_old = os.environ.get('GIT_SSL_NO_VERIFY', None)
+    # environment of the git processes of this clone only, so clones with
+    # different settings can run at the same time
+    env = dict(env or {})
 
     if GIT_SSL_NO_VERIFY:
-        os.environ['GIT_SSL_NO_VERIFY'] = 'true'
+        env['GIT_SSL_NO_VERIFY'] = 'true'
 
-    if credentials:
-        # https git credentials provided
-        repo = clone_with_credentials(url, path, credentials)
-    elif ssh_key:
-        # ssh key provided
-        repo = clone_with_ssh(url, path, ssh_key)
-    else:
-        # repo is public
-        repo = git.Repo.clone_from(url, path)
+    # credentials stay available for fetching submodules after the clone,
+    # only for those hosted on the same server
+    with git_auth_env(env, credentials=credentials, ssh_key=ssh_key,
+                      url=url) as env:
+        repo = git.Repo.clone_from(url, path, env=env)
+        repo.git.update_environment(**env)
 
-    if commit_id:
-        # If given a commit_id (could be a branch), switch to it
-        repo.git.checkout(commit_id)
+        if commit_id:
+            # If given a commit_id (could be a branch), switch to it
+            repo.git.checkout(commit_id)
 
-    if GIT_SSL_NO_VERIFY_old:
-        os.environ['GIT_SSL_NO_VERIFY'] = GIT_SSL_NO_VERIFY_old
-    elif GIT_SSL_NO_VERIFY:
-        del os.environ['GIT_SSL_NO_VERIFY']
+        if submodules:
+            update_submodules(repo, submodules)
 
     info = git_info(path, repo)
 
+    if submodules:
+        info['submodules'] = submodule_info(repo)
+
     if rm_git:
-        # Delete the .git dir to save space after checking out
+        # Delete the .git dir to save space after checking out. Submodules
+        # only hold a .git file pointing into it.
+        for submodule in info.get('submodules', {}):
+            git_file = pathlib.Path(path) / submodule / '.git'
+            if git_file.is_file():
+                git_file.unlink()
         shutil.rmtree(repo.git_dir)
 
     return info
 
 
-def clone_with_credentials(url, path, credentials):
+def update_submodules(repo, options):
+    """ Initialize and check out the submodules of a cloned repository
 
-    GIT_ASKPASS_old = os.environ.get('GIT_ASKPASS', None)
-    GIT_USERNAME_old = os.environ.get('GIT_USERNAME', None)
-    GIT_PASSWORD_old = os.environ.get('GIT_PASSWORD', None)
+    Arguments:
+        repo (git.Repo): cloned repository, checked out at its final commit
+        options (bool/dict): True, or dict of `recursive` (default True),
+                             `jobs` (parallel fetches, default 4), `shallow`
+                             (fetch only the recorded commits, default
+                             False) and `reference` (local repository to
+                             borrow git objects from)
+    """
+    if not isinstance(options, dict):
+        options = {}
+
+    args = ['update', '--init',
+            '--jobs', str(options.get('jobs', SUBMODULE_JOBS))]
+    if options.get('recursive', True):
+        args.append('--recursive')
+    if options.get('shallow', False):
+        args.extend(['--depth', '1'])
+    if options.get('reference'):
+        reference = os.path.expanduser(options['reference'])
+        if os.path.isdir(reference):
+            args.extend(['--reference', reference])
+        else:
+            logger.warning('Submodule reference %s not found, fetching all '
+                           'objects' % reference)
 
-    os.environ['GIT_ASKPASS'] = "pyats-image-build-askpass"
-    os.environ['GIT_USERNAME'] = credentials['username']
-    os.environ['GIT_PASSWORD'] = credentials['password']
+    repo.git.submodule(*args)
 
-    repo = git.Repo.clone_from(url, path)
 
-    if GIT_ASKPASS_old:
-        os.environ['GIT_ASKPASS'] = GIT_ASKPASS_old
-    else:
-        del os.environ['GIT_ASKPASS']
+def submodule_info(repo):
+    """ Returns the checked out submodules of a repository (recursively), as
+    dict of path relative to the repository to commit and url
+    """
+    # tab separated, paths may contain spaces
+    out = repo.git.submodule(
+        'foreach', '--quiet', '--recursive',
+        'printf "%s\\t%s\\t%s\\n" "$displaypath" "$sha1" '
+        '"$(git config --get remote.origin.url)"')
+
+    submodules = {}
+    for line in out.splitlines():
+        path, commit, url = line.split('\t', 2)
+        submodules[path] = {'commit': commit, 'url': url}
+
+    return submodules
+
+
+@contextlib.contextmanager
+def git_auth_env(env=None, credentials=None, ssh_key=None, url=None):
+    """ Context manager returning a git environment using the given https
+    credentials or ssh key. A key is written to a temporary file, removed
+    again on exit. With url, credentials are only given to git for that
+    scheme, host and port, not to submodules hosted elsewhere.
+    """
+    env = dict(env or {})
 
-    if GIT_USERNAME_old:
-        os.environ['GIT_USERNAME'] = GIT_USERNAME_old
-    else:
-        del os.environ['GIT_USERNAME']
+    if credentials:
+        # https git credentials provided
+        env['GIT_ASKPASS'] = "pyats-image-build-askpass"
+        env['GIT_USERNAME'] = credentials['username']
+        env['GIT_PASSWORD'] = credentials['password']
+        if url:
+            env['GIT_CREDENTIALS_URL'] = url
+        yield env
+
+    elif ssh_key:
+        # ssh key provided
+        temp = _ssh_key_file(ssh_key)
+        try:
+            # $socks_proxy is expanded by the shell running the
+            # ProxyCommand, from the environment of the git process
+            if env.get('socks_proxy', os.environ.get('socks_proxy', None)):
+                env['GIT_SSH_COMMAND'] = 'ssh -o "StrictHostKeyChecking no" -o "UserKnownHostsFile /dev/null" -o "ProxyCommand nc -x $socks_proxy %h %p" -i {}'.format(
+                        temp.name)
+            else:
+                env['GIT_SSH_COMMAND'] = 'ssh -o "StrictHostKeyChecking no" -o "UserKnownHostsFile /dev/null" -i {}'.format(
+                        temp.name)
+            yield env
+        finally:
+            temp.close()
 
-    if GIT_PASSWORD_old:
-        os.environ['GIT_PASSWORD'] = GIT_PASSWORD_old
     else:
-        del os.environ['GIT_PASSWORD']
+        # repo is public
+        yield env
 
-    return repo
 
+def clone_with_credentials(url, path, credentials, env=None):
+    # kept for compatibility, git_clone() is what the builder uses
 
-def clone_with_ssh(url, path, ssh_key):
+    with git_auth_env(env, credentials=credentials, url=url) as env:
+        return git.Repo.clone_from(url, path, env=env)
+
+
+def _ssh_key_file(ssh_key):
 
     # make temp file for ssh_key
     temp = tempfile.NamedTemporaryFile(mode="w")
@@ -201,26 +335,96 @@ def clone_with_ssh(url, path, ssh_key):
     temp.write(ssh_key)
     temp.seek(0)
 
-    GIT_SSH_COMMAND_old = os.environ.get('GIT_SSH_COMMAND', None)
+    return temp
 
-    if os.environ.get('socks_proxy', None):
-        os.environ[
-            'GIT_SSH_COMMAND'] = 'ssh -o "StrictHostKeyChecking no" -o "UserKnownHostsFile /dev/null" -o "ProxyCommand nc -x $socks_proxy %h %p" -i {}'.format(
-                temp.name)
-    else:
-        os.environ[
-            'GIT_SSH_COMMAND'] = 'ssh -o "StrictHostKeyChecking no" -o "UserKnownHostsFile /dev/null" -i {}'.format(
-                temp.name)
 
-    repo = git.Repo.clone_from(url, path)
+def clone_with_ssh(url, path, ssh_key, env=None):
+    # kept for compatibility, git_clone() is what the builder uses
+
+    with git_auth_env(env, ssh_key=ssh_key) as env:
+        return git.Repo.clone_from(url, path, env=env)
+
+
+def requests_proxies(url, env):
+    """ Returns the `proxies` argument for requests to fetch `url` with
+        the proxy environment variables in `env`
+    """
+    if not env:
+        return None
 
-    if GIT_SSH_COMMAND_old:
-        os.environ['GIT_SSH_COMMAND'] = GIT_SSH_COMMAND_old
+    proxies = {}
+    for scheme in ('http', 'https', 'ftp'):
+        proxy = env.get('%s_proxy' % scheme) or \
+            env.get('%s_PROXY' % scheme.upper())
+        if proxy:
+            proxies[scheme] = proxy
+
+    no_proxy = env.get('no_proxy') or env.get('NO_PROXY')
+    if no_proxy:
+        proxies['no_proxy'] = no_proxy
+        if requests.utils.should_bypass_proxies(url, no_proxy=no_proxy):
+            # None also keeps requests from using proxies from os.environ
+            proxies = {'http': None, 'https': None, 'ftp': None}
+
+    return proxies or None
+
+
+def cpu_count():
+    # number of cpus this process may run on (respects container cpusets)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def process_pool(max_workers):
+    '''
+    returns a ProcessPoolExecutor whose workers are not forked from this
+    process, which may be running builds (and holding locks) in other
+    threads, eg. in the build server
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
     else:
-        del os.environ['GIT_SSH_COMMAND']
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def parse_importtime(text, top=10):
+    '''
+    summarizes `python -X importtime` output
+
+    Returns:
+        dict with the total import time and the modules with the highest
+        self time (in microseconds), or None if text holds no profile
+    '''
+    modules = []
+    total = 0
+    for line in text.splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if not match:
+            continue
+        cumulative = int(match.group('cumulative'))
+        # only top level imports add up, nested ones are part of them
+        if not match.group('indent'):
+            total += cumulative
+        modules.append({
+            'module': match.group('module'),
+            'self': int(match.group('self')),
+            'cumulative': cumulative
+        })
 
-    temp.close()
-    return repo
+    if not modules:
+        return None
+
+    modules.sort(key=lambda m: m['self'], reverse=True)
+    return {'total': total, 'modules': len(modules), 'slowest': modules[:top]}
+
+
+def yaml_load(content):
+    # use the libyaml based loader when available, it is many times faster
+    # than the pure python implementation
+    return yaml.load(content,
+                     Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
 def stringify_config_lists(config):
@@ -255,17 +459,46 @@ def is_pyats_job(job_file):
     return False
 
 
+def walk_entries(path, ignore_folders=[]):
+    """ Recursively yield os.DirEntry objects for everything below `path`
+
+    Entries are yielded in the same order as path.rglob('*'). Ignored folders
+    (relative to `path`) and .git directories are yielded themselves, but not
+    descended into.
+    """
+    ignore = {os.path.join(str(path), str(i)) for i in ignore_folders}
+    yield from _walk_entries(str(path), ignore)
+
+
+def _walk_entries(directory, ignore):
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    subdirs = []
+    for entry in entries:
+        yield entry
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            continue
+        if is_dir and entry.name != '.git' and entry.path not in ignore:
+            subdirs.append(entry.path)
+
+    for subdir in subdirs:
+        yield from _walk_entries(subdir, ignore)
+
+
 def search_regex(regexes, path, ignore_folders=[]):
         regexes = [re.compile(regex) for regex in regexes]
-        ignore_folders = [path / i for i in ignore_folders]
 
         match = []
 
-        for file in path.rglob('*'):
-            if any(i in file.parents for i in ignore_folders):
-                continue
-            if any(regex.match(file.name) for regex in regexes):
-                match.append(file)
+        for entry in walk_entries(path, ignore_folders):
+            if any(regex.match(entry.name) for regex in regexes):
+                match.append(pathlib.Path(entry.path))
 
         return match
 
@@ -297,7 +530,8 @@ def to_image_path(path, search_path, workspace_dir):
 def discover_jobs(jobfiles,
                   search_path,
                   ignore_folders=None,
-                  relative_path=None):
+                  relative_path=None,
+                  repositories=None):
     """ Discover job files based on regex
 
     Arguments:
@@ -305,22 +539,20 @@ def discover_jobs(jobfiles,
         search_path (Path): pathlib Path object with the directory to start discovery from
         ignore_folders (list): list of strings with directories being excluded from searching
         relative_path (str): String with the directory search results will be relative to
+        repositories (dict): already discovered repositories, see
+                             discover_repository. These are not searched
+                             again, their job files are used instead.
     """
     logger.info('Discovering Jobfiles')
 
-    if not ignore_folders:
-        ignore_folders = []
+    ignore_folders = list(ignore_folders or []) + \
+        _repository_folders(repositories, search_path)
 
-    jobfiles.setdefault('match', DEFAULT_JOB_REGEXES)
+    discovered_jobs = _discover_job_files(jobfiles, search_path,
+                                          ignore_folders)
 
-    # 1. find all the job files in context by regex pattern
-    discovered_jobs = search_regex(jobfiles['match'],
-                                   search_path,
-                                   ignore_folders=ignore_folders)
-
-    # 2. find all job files by glob
-    for pattern in jobfiles.get('glob', []):
-        discovered_jobs.extend(search_path.rglob(pattern))
+    for repo_dir, record in (repositories or {}).items():
+        discovered_jobs.extend(repo_dir / job for job in record['jobs'])
 
     # 3. find all job files by specificy paths
     for path in jobfiles.get('paths', []):
@@ -329,10 +561,6 @@ def discover_jobs(jobfiles,
         if path.exists() and path.is_file():
             discovered_jobs.append(path)
 
-    # 4. discover all files that are pyats job by marker
-    discovered_jobs.extend(
-        filter(is_pyats_job, search_path.rglob('*.py')))
-
     # sort and remove duplicates
     discovered_jobs = sorted(set(discovered_jobs))
 
@@ -349,10 +577,64 @@ def discover_jobs(jobfiles,
     return job_paths
 
 
-def parse_manifest(manifest_file, jobs, search_path, relative_path=None, repo_data=None):
+def _discover_job_files(jobfiles, search_path, ignore_folders=None,
+                        glob_root=None):
+    # job files found by searching the directory tree, the `paths` given in
+    # the config are handled by the caller. `glob` patterns are relative to
+    # glob_root (the context), also when search_path is a directory within
+    # it.
+    if not ignore_folders:
+        ignore_folders = []
+
+    jobfiles.setdefault('match', DEFAULT_JOB_REGEXES)
+
+    # 1. find all the job files in context by regex pattern
+    discovered_jobs = search_regex(jobfiles['match'],
+                                   search_path,
+                                   ignore_folders=ignore_folders)
+
+    # 2. find all job files by glob
+    ignored = [search_path / i for i in ignore_folders]
+    for pattern in jobfiles.get('glob', []):
+        discovered_jobs.extend(
+            i for i in _glob(pattern, search_path, glob_root or search_path)
+            if not any(folder in i.parents for folder in ignored))
+
+    # 4. discover all files that are pyats job by marker
+    discovered_jobs.extend(
+        pathlib.Path(entry.path)
+        for entry in walk_entries(search_path, ignore_folders)
+        if entry.name.endswith('.py') and is_pyats_job(entry.path))
+
+    return discovered_jobs
+
+
+def _glob(pattern, search_path, glob_root):
+    # files below search_path matching pattern as glob_root.rglob() would
+    if glob_root == search_path:
+        return search_path.rglob(pattern)
+    if '**' in pattern:
+        return (i for i in glob_root.rglob(pattern)
+                if search_path in i.parents)
+    # rglob patterns match the end of the path, only the part of the path
+    # above search_path is missing to match them there
+    return (i for i in search_path.rglob(pathlib.PurePath(pattern).name)
+            if i.relative_to(glob_root).match(pattern))
+
+
+def _repository_folders(repositories, search_path):
+    # folders of already discovered repositories, relative to search_path
+    return [repo_dir.relative_to(search_path)
+            for repo_dir in repositories or {}]
+
+
+def _parse_manifest_content(manifest_file, content):
+    # Parse and restructure the manifest content. The result does not depend
+    # on where the manifest is located, so it can be cached by content: the
+    # location dependent 'file' key is left as a placeholder and is filled
+    # in by rebase_manifest
     try:
-        with open(manifest_file) as f:
-            manifest_data = yaml.safe_load(f.read())
+        manifest_data = yaml_load(content)
     except yaml.error.YAMLError as e:
         logger.error('Error loading manifest file {} from yaml\n{}'.format(
             manifest_file, str(e)))
@@ -363,18 +645,7 @@ def parse_manifest(manifest_file, jobs, search_path, relative_path=None, repo_da
         return
 
     try:
-        if relative_path:
-            manifest_data['file'] = to_image_path(str(manifest_file),
-                                                    search_path,
-                                                    relative_path)
-        else:
-            manifest_data['file'] = str(manifest_file)
-
-        # Find any repo containing this manifest file
-        for repo in repo_data:
-            if manifest_data['file'].startswith(repo):
-                manifest_data['repo_path'] = repo
-                break
+        manifest_data['file'] = None
 
         manifest_data['run_type'] = 'manifest'
         manifest_data['job_type'] = manifest_data.pop('type', None)
@@ -436,46 +707,171 @@ def parse_manifest(manifest_file, jobs, search_path, relative_path=None, repo_da
             manifest_data['runtimes'].append(runtimes[profile_name])
             manifest_data['runtimes'][-1]['name'] = profile_name
 
-        jobs.append(manifest_data)
+        return manifest_data
 
     except Exception as e:
         logger.exception('Error processing manifest file {}'.format(
             manifest_file))
 
 
-def parse_manifests(manifests, search_path, relative_path=None, repo_data=None):
+def rebase_manifest(manifest_data, manifest_file, search_path,
+                    relative_path=None, repo_data=None):
+    # Fill in the location dependent fields of a parsed manifest
+    if relative_path:
+        file = to_image_path(str(manifest_file), search_path, relative_path)
+    else:
+        file = str(manifest_file)
+
+    # Find any repo containing this manifest file
+    repo_path = None
+    for repo in repo_data or {}:
+        if file.startswith(repo):
+            repo_path = repo
+            break
+
+    # rebuild the dict to keep the key order of the original parsing, with
+    # 'repo_path' directly following 'file' unless it was already given
+    rebased = {}
+    for key, value in manifest_data.items():
+        if key == 'file':
+            rebased['file'] = file
+            if repo_path and 'repo_path' not in manifest_data:
+                rebased['repo_path'] = repo_path
+        elif key == 'repo_path' and repo_path:
+            rebased['repo_path'] = repo_path
+        else:
+            rebased[key] = value
+
+    return rebased
+
+
+def parse_manifests(manifests, search_path, relative_path=None,
+                    repo_data=None, cache=None, max_workers=None,
+                    executor=None):
+    """ Parse manifest files into the manifest.json job structure
+
+    Manifests not found in the cache are parsed in a pool of worker processes
+    (yaml parsing is CPU bound). Jobs are returned sorted by manifest file so
+    the output is identical from build to build.
+
+    Arguments:
+        manifests (list): list of manifest file paths
+        search_path (Path): pathlib Path object with the directory to start discovery from
+        relative_path (str): String with the directory search results will be relative to
+        repo_data (dict): dict of repositories to link to each manifest file
+        cache (ManifestCache): optional cache of parsed manifest files
+        max_workers (int): number of worker processes, defaults to cpu count
+        executor (ProcessPoolExecutor): existing process pool to parse with
+    """
     if repo_data is None:
         repo_data = {}
-    jobs = []
 
-    with ThreadPoolExecutor(max_workers=15) as executor:
-        for manifest in manifests:
-            executor.submit(parse_manifest, manifest, jobs, search_path, relative_path, repo_data)
+    # read all files, taking what we can from the cache
+    parsed = {}
+    to_parse = []
+    keys = {}
+    for manifest in sorted(manifests):
+        try:
+            with open(manifest, 'rb') as f:
+                content = f.read()
+        except OSError:
+            logger.exception('Error reading manifest file {}'.format(
+                manifest))
+            continue
+
+        manifest_data = None
+        if cache:
+            keys[manifest] = cache.key(content)
+            manifest_data = cache.get(keys[manifest])
+
+        if manifest_data is None:
+            to_parse.append((manifest, content))
+        else:
+            parsed[manifest] = manifest_data
+
+    for manifest, manifest_data in zip(
+            [m for m, _ in to_parse],
+            _parse_manifest_contents(to_parse, max_workers, executor)):
+        if manifest_data is None:
+            continue
+        parsed[manifest] = manifest_data
+        if cache:
+            cache.set(keys[manifest], manifest_data)
+
+    jobs = []
+    for manifest in sorted(parsed):
+        try:
+            jobs.append(rebase_manifest(parsed[manifest], manifest,
+                                        search_path, relative_path,
+                                        repo_data))
+        except Exception as e:
+            logger.exception('Error processing manifest file {}'.format(
+                manifest))
 
     return jobs
 
 
-def discover_manifests(search_path, ignore_folders=None, relative_path=None,
-                       repo_data=None):
-    """ Discover manifest files and write manifest.json file
+def _parse_manifest_contents(to_parse, max_workers=None, executor=None):
+    # returns the parsed content of each (file, content) pair, in order
+    if not to_parse:
+        return []
+
+    files = [str(f) for f, _ in to_parse]
+    contents = [c for _, c in to_parse]
+
+    max_workers = max_workers or cpu_count()
+    if executor or (max_workers > 1 and
+                    len(to_parse) >= PROCESS_POOL_THRESHOLD):
+        chunksize = max(1, len(to_parse) // (max_workers * 4))
+        try:
+            if executor:
+                return list(executor.map(_parse_manifest_content,
+                                         files,
+                                         contents,
+                                         chunksize=chunksize))
+
+            with process_pool(max_workers) as executor:
+                return list(executor.map(_parse_manifest_content,
+                                         files,
+                                         contents,
+                                         chunksize=chunksize))
+        except (OSError, RuntimeError):
+            # no multiprocessing support on this platform/environment
+            logger.warning('Could not parse manifests in worker processes, '
+                           'falling back to a single process', exc_info=True)
+
+    return list(map(_parse_manifest_content, files, contents))
+
+
+def find_manifests(search_path, ignore_folders=None, relative_path=None,
+                   repo_data=None, timings=None, repositories=None):
+    """ Find manifest files, and the git repos they may belong to
 
     Arguments:
         search_path (Path): pathlib Path object with the directory to start discovery from
         ignore_folders (list): list of strings with directories being excluded from searching
         relative_path (str): String with the directory search results will be relative to
-        repo_list (dict): dict of repositories to link to each manifest file.
-                          Additional repos are discovered and appended to
-                          this list.
+        repo_data (dict): dict of repositories to link to each manifest file.
+                          Additional repos are discovered and added to it.
+        timings (Timings): optional Timings object to record spans into
+        repositories (dict): already discovered repositories, see
+                             discover_repository. These are not searched
+                             again, their manifests and git repos are used
+                             instead.
+
+    Returns:
+        sorted list of manifest file paths
     """
     logger.info('Discovering Manifests')
 
-    if not ignore_folders:
-        ignore_folders = []
+    ignore_folders = list(ignore_folders or []) + \
+        _repository_folders(repositories, search_path)
 
     # Combine search for manifests and git repos in one recursive glob search
-    discovered_manifests = search_regex([MANIFEST_REGEX, GIT_REGEX],
-                                        search_path,
-                                        ignore_folders=ignore_folders)
+    with span(timings, 'search_files'):
+        discovered_manifests = search_regex([MANIFEST_REGEX, GIT_REGEX],
+                                            search_path,
+                                            ignore_folders=ignore_folders)
 
     # Separate git repos and manifests
     git_regex = re.compile(GIT_REGEX)
@@ -490,6 +886,17 @@ def discover_manifests(search_path, ignore_folders=None, relative_path=None,
     if repo_data is None:
         repo_data = {}
 
+    for repo_dir, record in (repositories or {}).items():
+        for path, info in record['repos']:
+            image_repo = str(repo_dir / path)
+            if relative_path:
+                image_repo = to_image_path(image_repo, search_path,
+                                           relative_path)
+            if image_repo not in repo_data:
+                repo_data[image_repo] = dict(info, path=image_repo)
+        discovered_manifests.extend(repo_dir / path
+                                    for path, _ in record['manifests'])
+
     for repo in discovered_repos:
         # remove /.git from path and convert from Path to str
         repo = os.path.dirname(str(repo))
@@ -500,7 +907,8 @@ def discover_manifests(search_path, ignore_folders=None, relative_path=None,
         # only add undiscovered repos
         if image_repo not in repo_data:
             try:
-                r = git_info(repo)
+                with span(timings, 'git_info', path=image_repo):
+                    r = git_info(repo)
                 # use corrected image path
                 r['path'] = image_repo
                 repo_data[image_repo] = r
@@ -508,27 +916,263 @@ def discover_manifests(search_path, ignore_folders=None, relative_path=None,
                 # problem getting git information - probably not an actual repo
                 logger.exception('Error getting git info about {}'.format(repo))
 
-    # Generate single manifest structure linking the files to the data
-    jobs = parse_manifests(discovered_manifests,
-                           search_path=search_path,
-                           relative_path=relative_path,
-                           repo_data=repo_data)
-
     logger.info('Number of discovered manifest files: %s' % \
                 len(discovered_manifests))
 
+    return sorted(discovered_manifests)
+
+
+def iter_manifests(manifest_files, search_path, relative_path=None,
+                   repo_data=None, timings=None, cache=None,
+                   batch_size=MANIFEST_BATCH_SIZE, repositories=None):
+    """ Parse and enrich manifest files, yielding one manifest.json job at a
+        time in the order of the given files
+
+    Manifests are processed in batches of `batch_size`, so only one batch of
+    parsed manifests is held in memory at once.
+
+    Arguments:
+        manifest_files (list): sorted list of manifest file paths
+        search_path (Path): pathlib Path object with the directory to start discovery from
+        relative_path (str): String with the directory search results will be relative to
+        repo_data (dict): dict of repositories to link to each manifest file
+        timings (Timings): optional Timings object to record spans into
+        cache (ManifestCache): optional cache of parsed manifest files
+        batch_size (int): number of manifests to process at once
+        repositories (dict): already discovered repositories, see
+                             discover_repository. Their manifests are taken
+                             as they are instead of being parsed again.
+    """
+    # shared across batches, each referenced YAML file is loaded only once
+    yaml_cache = YamlInfoCache()
+
+    # manifests already parsed and enriched with their repository
+    discovered = {}
+    for repo_dir, record in (repositories or {}).items():
+        for path, manifest_data in record['manifests']:
+            discovered[repo_dir / path] = manifest_data
+
+    with contextlib.ExitStack() as stack:
+        executor = None
+        workers = cpu_count()
+        if workers > 1 and len(manifest_files) >= PROCESS_POOL_THRESHOLD:
+            try:
+                executor = stack.enter_context(process_pool(workers))
+            except (OSError, RuntimeError):
+                logger.warning('Could not start manifest parsing worker '
+                               'processes', exc_info=True)
+
+        for i in range(0, len(manifest_files), batch_size):
+            batch = manifest_files[i:i + batch_size]
+            to_parse = [f for f in batch if f not in discovered]
+
+            with span(timings, 'parse_manifests', count=len(to_parse)):
+                jobs = parse_manifests(to_parse,
+                                       search_path=search_path,
+                                       relative_path=relative_path,
+                                       repo_data=repo_data,
+                                       cache=cache,
+                                       executor=executor)
+
+            if jobs:
+                with span(timings, 'discover_yamls', count=len(jobs)):
+                    discover_yamls(jobs,
+                                   search_path=search_path,
+                                   relative_path=relative_path,
+                                   yaml_cache=yaml_cache)
+
+            if len(to_parse) == len(batch):
+                yield from jobs
+                continue
+
+            rebased = [rebase_manifest(discovered[f], f, search_path,
+                                       relative_path, repo_data)
+                       for f in batch if f in discovered]
+
+            # both lists are sorted by manifest file
+            yield from heapq.merge(
+                jobs, rebased,
+                key=lambda job: pathlib.PurePosixPath(job['file']))
+
+    if cache:
+        logger.info('Manifest parse cache: %s hit(s), %s miss(es)' %
+                    (cache.hits, cache.misses))
+
+
+def write_manifest_json(path, jobs):
+    """ Incrementally write manifest jobs into a manifest.json file
+
+    The output is identical to json.dumps({'version': ..., 'jobs': [...]}),
+    but only one job is serialized at a time. Nothing is written when there
+    are no jobs.
+
+    Arguments:
+        path (Path): file to write
+        jobs (iterable): manifest jobs, eg. from iter_manifests
+
+    Returns:
+        number of jobs written
+    """
+    path = pathlib.Path(path)
+    temp = path.with_name(path.name + '.tmp')
+
+    count = 0
+    try:
+        with open(temp, 'w') as f:
+            f.write('{"version": %s, "jobs": [' %
+                    json.dumps(MANIFEST_VERSION))
+            for job in jobs:
+                if count:
+                    f.write(', ')
+                f.write(json.dumps(job))
+                count += 1
+            f.write(']}')
+    except BaseException:
+        if temp.exists():
+            temp.unlink()
+        raise
+
+    if count:
+        os.replace(str(temp), str(path))
+    else:
+        temp.unlink()
+
+    return count
+
+
+def discover_manifests(search_path, ignore_folders=None, relative_path=None,
+                       repo_data=None, timings=None, cache=None):
+    """ Discover manifest files and write manifest.json file
+
+    Arguments:
+        search_path (Path): pathlib Path object with the directory to start discovery from
+        ignore_folders (list): list of strings with directories being excluded from searching
+        relative_path (str): String with the directory search results will be relative to
+        repo_list (dict): dict of repositories to link to each manifest file.
+                          Additional repos are discovered and appended to
+                          this list.
+        timings (Timings): optional Timings object to record spans into
+        cache (ManifestCache): optional cache of parsed manifest files
+    """
+    if repo_data is None:
+        repo_data = {}
+
+    manifest_files = find_manifests(search_path,
+                                    ignore_folders=ignore_folders,
+                                    relative_path=relative_path,
+                                    repo_data=repo_data,
+                                    timings=timings)
+
+    jobs = list(iter_manifests(manifest_files,
+                               search_path=search_path,
+                               relative_path=relative_path,
+                               repo_data=repo_data,
+                               timings=timings,
+                               cache=cache))
+
     if jobs:
-        discover_yamls(jobs, search_path=search_path, relative_path=relative_path)
         return {'version': MANIFEST_VERSION, 'jobs': jobs}
     else:
         return {}
 
 
-def _process_testbed_file(profile, yaml_contents):
-    # Extract specific device information from each device
-    # in the testbed and attach to the profile
+def discover_repository(repo_dir, search_path, jobfiles=None,
+                        relative_path=None, cache=None):
+    """ Discover the job files, manifests and git repos within a repository
+
+    The result does not depend on where the repository is located: all paths
+    are relative to `repo_dir`, and the manifests are enriched with testbed
+    and clean information but not yet linked to a repo (see
+    rebase_manifest). It only holds plain JSON types, so it can be cached by
+    repository commit. Only `glob` patterns of jobfiles, relative to
+    search_path, depend on the location of the repository within it.
+
+    Arguments:
+        repo_dir (Path): pathlib Path object with the repository directory
+        search_path (Path): pathlib Path object with the directory to start discovery from
+        jobfiles (dict): Dict of jobfiles config, `paths` are not applied
+        relative_path (str): String with the directory search results will be relative to
+        cache (ManifestCache): optional cache of parsed manifest files
+
+    Returns:
+        dict with the `jobs`, `manifests` and (nested) git `repos` found.
+        `portable` is False when a manifest references YAML files by
+        absolute path or outside of the repository, the result then depends
+        on more than the repository contents.
+    """
+    jobfiles = dict(jobfiles or {})
+    jobfiles.pop('paths', None)
+
+    jobs = sorted(set(_discover_job_files(jobfiles, repo_dir,
+                                          glob_root=search_path)))
+
+    discovered = search_regex([MANIFEST_REGEX, GIT_REGEX], repo_dir)
+    git_regex = re.compile(GIT_REGEX)
+    manifest_files = [i for i in discovered if not git_regex.match(str(i))]
+
+    repos = []
+    for repo in discovered:
+        if not git_regex.match(str(repo)):
+            continue
+        repo = repo.parent
+        try:
+            info = git_info(str(repo))
+        except Exception:
+            # problem getting git information - probably not an actual repo
+            logger.exception('Error getting git info about {}'.format(repo))
+            continue
+        info.pop('path')
+        repos.append([repo.relative_to(repo_dir).as_posix(), info])
+
+    manifests = parse_manifests(manifest_files,
+                                search_path=search_path,
+                                relative_path=relative_path,
+                                cache=cache)
+    yaml_cache = YamlInfoCache()
+    discover_yamls(manifests,
+                   search_path=search_path,
+                   relative_path=relative_path,
+                   yaml_cache=yaml_cache)
+
+    repo_root = os.path.realpath(str(repo_dir))
+    portable = all(path.startswith(repo_root + os.sep)
+                   for path in yaml_cache.paths())
+
+    if relative_path:
+        image_dir = to_image_path(str(repo_dir), search_path, relative_path)
+    else:
+        image_dir = str(repo_dir)
+
+    records = []
+    for manifest in manifests:
+        manifest_dir = os.path.dirname(manifest['file'])
+        for profile in manifest['profiles']:
+            arguments = profile.get('arguments')
+            if not isinstance(arguments, dict):
+                continue
+            for argument in yaml_processors:
+                value = arguments.get(argument)
+                if not isinstance(value, str) or value.startswith('$'):
+                    continue
+                yaml_file = os.path.normpath(
+                    os.path.join(manifest_dir, value))
+                if value.startswith('/') or \
+                        not yaml_file.startswith(image_dir + os.sep):
+                    portable = False
+        path = os.path.relpath(manifest['file'], image_dir)
+        records.append([pathlib.PurePath(path).as_posix(),
+                        dict(manifest, file=None)])
+
+    return {'jobs': [i.relative_to(repo_dir).as_posix() for i in jobs],
+            'manifests': records,
+            'repos': repos,
+            'portable': portable}
+
+
+def _extract_testbed_info(yaml_contents):
+    # Extract specific device information from each device in the testbed
+    testbed_info = {}
     if yaml_contents.get('devices'):
-        testbed_info = profile.setdefault('testbed_info', {})
         for dev_name, dev in yaml_contents['devices'].items():
             if isinstance(dev, dict):
                 testbed_info[dev_name] = {}
@@ -542,23 +1186,112 @@ def _process_testbed_file(profile, yaml_contents):
                         testbed_info[dev_name]['console'] = f'{ip}:{port}'
                 if dev.get("device_id"):
                     testbed_info[dev_name]['device_id'] = dev['device_id']
- 
+        return testbed_info
 
-def _process_clean_file(profile, yaml_contents):
-    # Extract bringup information from the clean file and
-    # attach to the profile
+
+def _extract_clean_info(yaml_contents):
+    # Extract bringup information from the clean file
     bringup_module = yaml_contents.get('bringup', {}).get('BringUpWorker', {}).get('module')
     if bringup_module:
-        clean_info = profile.setdefault('clean_info', {})
-        clean_info['bringup_module'] = bringup_module
+        return {'bringup_module': bringup_module}
+
+
+def _process_testbed_file(profile, testbed_info):
+    # attach the device information of a testbed to the profile. The device
+    # entries are shared between all profiles using the same testbed file
+    profile.setdefault('testbed_info', {}).update(testbed_info)
+
+
+def _process_clean_file(profile, clean_info):
+    # attach bringup information from the clean file to the profile
+    profile.setdefault('clean_info', {}).update(clean_info)
 
 yaml_processors = {
-    'testbed-file': _process_testbed_file,
-    'logical-testbed-file': _process_testbed_file,
-    'clean-file': _process_clean_file
+    'testbed-file': (_extract_testbed_info, _process_testbed_file),
+    'logical-testbed-file': (_extract_testbed_info, _process_testbed_file),
+    'clean-file': (_extract_clean_info, _process_clean_file)
 }
 
-def discover_yamls_from_manifest(manifest, search_path, relative_path=None):
+
+class YamlInfoCache(object):
+    def __init__(self):
+        '''
+        thread-safe cache of the information extracted from testbed/clean
+        YAML files, keyed by resolved path
+
+        each file is loaded and processed once, no matter how many profiles
+        of how many manifests reference it. Only the extracted information is
+        kept, not the (possibly very large) YAML contents.
+        '''
+        self._lock = threading.Lock()
+        self._files = {}
+        self.loads = 0
+        self.hits = 0
+
+    def _entry(self, path):
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None:
+                entry = self._files[path] = {'lock': threading.Lock(),
+                                             'info': None}
+                self.loads += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def paths(self):
+        '''
+        returns the resolved paths of all the files requested so far
+        '''
+        with self._lock:
+            return list(self._files)
+
+    def get(self, yaml_file, extractor):
+        '''
+        returns the result of extractor(yaml contents) for the given file
+
+        loading/extraction errors are raised to every caller
+        '''
+        entry = self._entry(os.path.realpath(yaml_file))
+
+        with entry['lock']:
+            if entry['info'] is None:
+                entry['info'] = self._load(yaml_file)
+
+        info = entry['info']
+        if isinstance(info, Exception):
+            raise info
+
+        result = info[extractor]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _load(self, yaml_file):
+        # run every extractor on the file at once, so the contents can be
+        # released straight away
+        try:
+            with open(yaml_file) as f:
+                # load yaml contents with handling for an
+                # empty file
+                yaml_contents = yaml_load(f.read()) or {}
+        except Exception as e:
+            return e
+
+        info = {}
+        for extractor, _ in yaml_processors.values():
+            if extractor in info:
+                continue
+            try:
+                info[extractor] = extractor(yaml_contents) \
+                    if yaml_contents else None
+            except Exception as e:
+                info[extractor] = e
+        return info
+
+
+def discover_yamls_from_manifest(manifest, search_path, relative_path=None,
+                                 yaml_cache=None):
     """ Discover yaml files referenced in manifest file and extract key
         information
 
@@ -566,7 +1299,12 @@ def discover_yamls_from_manifest(manifest, search_path, relative_path=None):
         manifest (dict): manifest object
         search_path (Path): pathlib Path object with the directory to start discovery from
         relative_path (str): String with the directory search results will be relative to
+        yaml_cache (YamlInfoCache): cache of information already extracted
+                                    from YAML files
     """
+    if yaml_cache is None:
+        yaml_cache = YamlInfoCache()
+
     manifest_dir = os.path.dirname(manifest['file'])
     for profile in manifest['profiles']:
         if not isinstance(profile.get('arguments'), dict):
@@ -599,19 +1337,7 @@ def discover_yamls_from_manifest(manifest, search_path, relative_path=None):
             if relative_path:
                 yaml_file = to_image_path(yaml_file, relative_path, search_path)
 
-            if os.path.isfile(yaml_file):
-                try:
-                    with open(yaml_file) as f:
-                        # load yaml contents with handling for an
-                        # empty file
-                        yaml_contents = yaml.safe_load(f.read()) or {}
-                except Exception as e:
-                    msg = f'Error loading YAML file {value} from ' \
-                            f'manifest {manifest["file"]}'
-                    logger.exception(msg)
-                    yaml_contents = None
-                    continue
-            else:
+            if not os.path.isfile(yaml_file):
                 # YAML file relative path from manifest does not
                 # exist.
                 msg = f'Could not find YAML file {value} from ' \
@@ -619,18 +1345,27 @@ def discover_yamls_from_manifest(manifest, search_path, relative_path=None):
                 logger.warning(msg)
                 continue
 
-            processor = yaml_processors.get(argument)
-            if processor and yaml_contents:
-                try:
-                    processor(profile, yaml_contents)
-                except Exception as e:
-                    # Problem processing the specific type of YAML file
-                    msg = f'Error processing {argument} {value} from ' \
-                            f'manifest {manifest["file"]}'
-                    logger.exception(msg)
+            extractor, processor = yaml_processors[argument]
+            try:
+                info = yaml_cache.get(yaml_file, extractor)
+            except yaml.error.YAMLError as e:
+                msg = f'Error loading YAML file {value} from ' \
+                        f'manifest {manifest["file"]}'
+                logger.error('%s\n%s' % (msg, e))
+                continue
+            except Exception as e:
+                # Problem processing the specific type of YAML file
+                msg = f'Error processing {argument} {value} from ' \
+                        f'manifest {manifest["file"]}'
+                logger.error('%s\n%s: %s' % (msg, type(e).__name__, e))
+                continue
+
+            if info is not None:
+                processor(profile, info)
 
 
-def discover_yamls(manifests, search_path, relative_path=None):
+def discover_yamls(manifests, search_path, relative_path=None,
+                   yaml_cache=None):
     """ Discover yaml files referenced in manifest files and extract key
         information
 
@@ -638,13 +1373,24 @@ def discover_yamls(manifests, search_path, relative_path=None):
         manifests (list): list of contents of discovered manifests
         search_path (Path): pathlib Path object with the directory to start discovery from
         relative_path (str): String with the directory search results will be relative to
+        yaml_cache (YamlInfoCache): cache of information already extracted
+                                    from YAML files
     """
     logger.info('Discovering YAML files from manifests')
+
+    # shared by all manifests, each YAML file is loaded only once
+    if yaml_cache is None:
+        yaml_cache = YamlInfoCache()
+
     with ThreadPoolExecutor(max_workers=15) as executor:
         for manifest in manifests:
             executor.submit(discover_yamls_from_manifest,
                             manifest,
                             search_path,
-                            relative_path)
+                            relative_path,
+                            yaml_cache)
+
+    logger.info('Loaded %s YAML file(s) referenced %s time(s)' %
+                (yaml_cache.loads, yaml_cache.loads + yaml_cache.hits))
 
     return manifests
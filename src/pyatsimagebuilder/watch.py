@@ -0,0 +1,338 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import logging
+import pathlib
+import ctypes.util
+
+from .builder import ImageBuilder
+from .lazy import lazy_import
+
+yaml = lazy_import('yaml')
+
+logger = logging.getLogger(__name__)
+
+# wait this long after the last change before rebuilding, editors and VCS
+# checkouts touch many files in a row
+DEFAULT_DEBOUNCE = 1.0
+
+# interval of the polling fallback where inotify is not available
+POLL_INTERVAL = 1.0
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class Watcher(object):
+    def __init__(self, paths, logger=logger):
+        '''
+        watches files and directory trees for changes
+
+        Uses inotify on Linux, and compares modification times every
+        POLL_INTERVAL seconds elsewhere. Watched files are watched through
+        their directory, so files replaced by editors (written to a temporary
+        file and renamed) keep being watched.
+
+        Arguments:
+            paths (list): files and directories to watch, directories are
+                          watched recursively
+        '''
+        self._logger = logger
+        self.paths = [pathlib.Path(p).absolute() for p in paths]
+
+        self._fd = None
+        self._watches = {}
+        self._libc = _load_libc()
+        if self._libc:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                self._logger.debug('inotify not available: %s' %
+                                   os.strerror(ctypes.get_errno()))
+                self._libc = None
+            else:
+                self._fd = fd
+
+        if self._fd is not None:
+            for path in self.paths:
+                if path.is_dir():
+                    self._add_tree(path)
+                else:
+                    self._add_watch(path.parent)
+        else:
+            self._snapshot = self._scan()
+
+    def wait(self, debounce=DEFAULT_DEBOUNCE):
+        '''
+        block until something changed, then until nothing changed for
+        `debounce` seconds
+
+        Returns:
+            set of changed paths (Path)
+        '''
+        changes = set()
+        while not changes:
+            changes |= self._poll(None)
+
+        while True:
+            more = self._poll(debounce)
+            if not more:
+                return changes
+            changes |= more
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _watched(self, path):
+        # whether path is (below) one of the watched paths
+        return any(path == p or p in path.parents for p in self.paths)
+
+    def _poll(self, timeout):
+        if self._fd is None:
+            return self._poll_scan(timeout)
+
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changes = set()
+        # give writers of many files the chance to finish a batch
+        time.sleep(0.05)
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            changes |= self._parse(data)
+
+        return changes
+
+    def _parse(self, data):
+        changes = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, everything may have changed
+                self._logger.warning('Too many changes at once, treating '
+                                     'all watched paths as changed')
+                changes.update(self.paths)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+
+            path = directory / os.fsdecode(name) if name else directory
+            if not self._watched(path):
+                continue
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changes.add(path)
+
+        return changes
+
+    def _add_tree(self, path):
+        for root, dirs, _ in os.walk(str(path)):
+            self._add_watch(pathlib.Path(root))
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(str(path)),
+                                          WATCH_MASK)
+        if wd < 0:
+            self._logger.warning('Cannot watch %s: %s' %
+                                 (path, os.strerror(ctypes.get_errno())))
+        else:
+            self._watches[wd] = path
+
+    def _scan(self):
+        snapshot = {}
+        for path in self.paths:
+            if not path.is_dir():
+                try:
+                    st = os.lstat(str(path))
+                    snapshot[path] = (st.st_mtime_ns, st.st_size, st.st_mode)
+                except OSError:
+                    pass
+                continue
+            for root, dirs, files in os.walk(str(path)):
+                for name in dirs + files:
+                    full = pathlib.Path(root, name)
+                    try:
+                        st = os.lstat(str(full))
+                    except OSError:
+                        continue
+                    snapshot[full] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        return snapshot
+
+    def _poll_scan(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changes = {path for path in set(snapshot) | set(self._snapshot)
+                       if snapshot.get(path) != self._snapshot.get(path)}
+            self._snapshot = snapshot
+            if changes:
+                return changes
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(POLL_INTERVAL if deadline is None else
+                       min(POLL_INTERVAL, max(deadline - time.monotonic(),
+                                              0)))
+
+
+def watch(config_file,
+          logger=logger,
+          cache_dir=None,
+          debounce=DEFAULT_DEBOUNCE,
+          keep_context=False,
+          tag=None,
+          no_cache=False,
+          dry_run=False,
+          timings_file=None,
+          dedup=False,
+          delta_context=False,
+          on_build=None):
+    '''
+    build an image, then rebuild it whenever the build file or local `files`
+    inputs change, until interrupted
+
+    Changes to local inputs are applied to the kept context and rebuilt with
+    ImageBuilder.rebuild(). Changes to the build file start over with a new
+    context. Failed builds are logged and retried on the next change.
+
+    Arguments:
+        config_file (str): YAML build file
+        debounce (float): seconds without changes before rebuilding
+        keep_context (bool): keep the context directory when done
+        on_build (callable): called with each successfully built image
+        other arguments: see ImageBuilder.run()
+    '''
+    config_file = pathlib.Path(config_file).absolute()
+    builder = None
+    watcher = None
+
+    def build():
+        try:
+            with open(str(config_file)) as f:
+                config = yaml.safe_load(f.read())
+            new = ImageBuilder(config, logger, cache_dir=cache_dir)
+        except Exception:
+            logger.exception('Cannot load %s' % config_file)
+            return None
+
+        try:
+            image = new.run(keep_context=True,
+                            tag=tag,
+                            no_cache=no_cache,
+                            dry_run=dry_run,
+                            timings_file=timings_file,
+                            dedup=dedup,
+                            delta_context=delta_context)
+        except Exception:
+            logger.exception('Build failed')
+        else:
+            if on_build:
+                on_build(image)
+        return new
+
+    def discard(old):
+        if old and old.context and old.context.path:
+            old.context.keep = keep_context
+            old.context.delete()
+
+    try:
+        while True:
+            builder = build()
+
+            # the context is only complete once fingerprinted
+            populated = builder is not None and \
+                builder.image.fingerprint is not None
+            sources = builder.local_files if builder else []
+
+            watcher = Watcher([config_file] +
+                              [source for source, _ in sources],
+                              logger=logger)
+            logger.info('Watching %s and %s local input(s) for changes '
+                        '(Ctrl+C to stop)' % (config_file, len(sources)))
+
+            while True:
+                changes = watcher.wait(debounce)
+                if config_file in changes or not populated:
+                    # the build file changed, or there is no complete
+                    # context to apply changes to: start over
+                    logger.info('Rebuilding from scratch')
+                    break
+
+                logger.info('%s change(s) detected, rebuilding' %
+                            len(changes))
+                try:
+                    image = builder.rebuild(changes,
+                                            no_cache=no_cache,
+                                            dry_run=dry_run,
+                                            timings_file=timings_file,
+                                            dedup=dedup,
+                                            delta_context=delta_context)
+                except Exception:
+                    logger.exception('Build failed')
+                else:
+                    if on_build:
+                        on_build(image)
+
+            watcher.close()
+            discard(builder)
+
+    except KeyboardInterrupt:
+        logger.info('Stopped watching')
+
+    finally:
+        if watcher:
+            watcher.close()
+        discard(builder)
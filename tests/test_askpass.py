@@ -0,0 +1,42 @@
+import sys
+import subprocess
+
+import pytest
+
+from pyatsimagebuilder.utils import git_auth_env
+
+CREDENTIALS = {'username': 'user', 'password': 'secret'}
+
+
+def _askpass(env, prompt):
+    result = subprocess.run(
+        [sys.executable, '-m', 'pyatsimagebuilder.askpass', prompt],
+        env=dict(env, PYTHONPATH=':'.join(sys.path)),
+        stdout=subprocess.PIPE,
+        universal_newlines=True)
+    return result.returncode, result.stdout.strip()
+
+
+@pytest.mark.parametrize('prompt, answer', [
+    ("Username for 'https://git.example.com': ", 'user'),
+    ("Password for 'https://user@git.example.com': ", 'secret'),
+    ("Password for 'https://user@GIT.example.com:443': ", 'secret'),
+])
+def test_same_host(prompt, answer):
+    with git_auth_env(credentials=CREDENTIALS,
+                      url='https://git.example.com/group/repo.git') as env:
+        assert _askpass(env, prompt) == (0, answer)
+
+
+@pytest.mark.parametrize('prompt', [
+    "Username for 'https://other.example.com': ",
+    "Password for 'https://user@git.example.com.other.example': ",
+    "Password for 'http://user@git.example.com': ",
+    "Password for 'https://user@git.example.com:8443': ",
+    'Password: ',
+])
+def test_other_host(prompt):
+    # eg. a submodule hosted somewhere else
+    with git_auth_env(credentials=CREDENTIALS,
+                      url='https://git.example.com/group/repo.git') as env:
+        assert _askpass(env, prompt) == (1, '')
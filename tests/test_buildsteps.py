@@ -0,0 +1,32 @@
+from pyatsimagebuilder.buildsteps import BuildSteps
+
+STREAM = '''\
+Step 1/5 : FROM python:3.7.9-slim AS builder
+ ---> 1f2b3c4d5e6f
+Step 2/5 : RUN pip install psutil
+ ---> Using cache
+ ---> 2a2b2c2d2e2f
+Step 3/5 : COPY . /pyats
+ ---> 3a3b3c3d3e3f
+Step 4/5 : FROM python:3.7.9-slim
+ ---> 1f2b3c4d5e6f
+Step 5/5 : COPY --from=builder /pyats /pyats
+ ---> Running in 0123456789ab
+Removing intermediate container 0123456789ab
+ ---> 5a5b5c5d5e5f
+Successfully built 5a5b5c5d5e5f
+'''
+
+
+def test_stage_images():
+    steps = BuildSteps()
+    for line in STREAM.splitlines(True):
+        steps.feed(line)
+    steps.finish()
+
+    assert [step['image'] for step in steps.steps] == [
+        '1f2b3c4d5e6f', '2a2b2c2d2e2f', '3a3b3c3d3e3f', '1f2b3c4d5e6f',
+        '5a5b5c5d5e5f']
+    assert steps.steps[1]['cached']
+    assert steps.steps[4]['container'] == '0123456789ab'
+    assert steps.stage_images() == ['3a3b3c3d3e3f', '5a5b5c5d5e5f']
@@ -0,0 +1,43 @@
+import os
+
+from pyatsimagebuilder.dedup import dedup_tree
+
+CONTENT = b'fixture\n' * 1024
+
+
+def _write(path, content=CONTENT, mtime_ns=1500000000 * 10**9):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    os.utime(str(path), ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def test_dedup_identical(tmp_path):
+    a = _write(tmp_path / 'repo1' / 'data.bin')
+    b = _write(tmp_path / 'repo2' / 'data.bin')
+    other = _write(tmp_path / 'repo2' / 'other.bin', b'x' * len(CONTENT))
+
+    result = dedup_tree(tmp_path)
+    assert (result.linked, result.bytes_saved) == (1, len(CONTENT))
+    assert os.path.samefile(str(a), str(b))
+    assert not os.path.samefile(str(a), str(other))
+    assert b.read_bytes() == CONTENT
+
+
+def test_dedup_keeps_mtime(tmp_path):
+    # docker copies modification times into the image, files differing in
+    # them are not linked
+    a = _write(tmp_path / 'repo1' / 'data.bin')
+    b = _write(tmp_path / 'files' / 'data.bin',
+               mtime_ns=1600000000 * 10**9 + 1)
+
+    assert dedup_tree(tmp_path).linked == 0
+    assert not os.path.samefile(str(a), str(b))
+    assert os.stat(str(b)).st_mtime_ns == 1600000000 * 10**9 + 1
+
+
+def test_dedup_exclude(tmp_path):
+    _write(tmp_path / 'repo1' / 'data.bin')
+    _write(tmp_path / 'installation' / 'data.bin')
+
+    assert dedup_tree(tmp_path, exclude=['installation']).linked == 0
@@ -0,0 +1,49 @@
+import pytest
+
+from pyatsimagebuilder.utils import discover_jobs, discover_repository
+
+RELATIVE_PATH = '/pyats'
+
+EXPECTED = ['/pyats/myrepo/tests/run_a.py', '/pyats/myrepo/tests/run_b.py']
+
+
+@pytest.fixture
+def context(tmp_path):
+    tests = tmp_path / 'myrepo' / 'tests'
+    tests.mkdir(parents=True)
+    for name in ('run_a.py', 'run_b.py', 'helper.py'):
+        (tests / name).write_text('# not a job file by name\n')
+    (tmp_path / 'other').mkdir()
+    (tmp_path / 'other' / 'run_c.py').write_text('\n')
+    return tmp_path
+
+
+def _jobs(context, jobfiles, cached):
+    repositories = None
+    if cached:
+        repo_dir = context / 'myrepo'
+        repositories = {
+            repo_dir: discover_repository(repo_dir,
+                                          search_path=context,
+                                          jobfiles=dict(jobfiles),
+                                          relative_path=RELATIVE_PATH)
+        }
+    return discover_jobs(jobfiles=dict(jobfiles),
+                         search_path=context,
+                         relative_path=RELATIVE_PATH,
+                         repositories=repositories)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+@pytest.mark.parametrize('pattern', ['myrepo/tests/run_*.py',
+                                     'tests/run_*.py',
+                                     'myrepo/**/run_*.py'])
+def test_glob_relative_to_context(context, pattern, cached):
+    jobfiles = {'match': [], 'glob': [pattern]}
+    assert _jobs(context, jobfiles, cached) == EXPECTED
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_glob_outside_repository(context, cached):
+    jobfiles = {'match': [], 'glob': ['other/run_*.py']}
+    assert _jobs(context, jobfiles, cached) == ['/pyats/other/run_c.py']
@@ -0,0 +1,154 @@
+import os
+import re
+import threading
+import http.server
+
+import pytest
+
+from pyatsimagebuilder.download import ResumableDownload
+
+DATA = os.urandom(3 * 1000 * 1000 + 123)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    # file server honoring Range and If-Range against its current ETag, and
+    # dropping the connection part way through the body when asked to
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server.state
+        requested = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        state['requests'].append((requested, if_range))
+
+        data = state['data']
+        start, end = 0, len(data) - 1
+        status = 200
+        if requested and state['ranges'] and \
+                (if_range is None or if_range == state['etag']):
+            match = re.match(r'bytes=(\d+)-(\d*)$', requested)
+            start = int(match.group(1))
+            if match.group(2):
+                end = int(match.group(2))
+            status = 206
+
+        body = data[start:end + 1]
+        self.send_response(status)
+        self.send_header('ETag', state['etag'])
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (start, end, len(data)))
+        self.end_headers()
+
+        with state['lock']:
+            cut = state['cut']
+            if requested is None and state['ranged']:
+                cut = None
+            else:
+                state['cut'] = None
+        try:
+            if cut is not None:
+                self.wfile.write(body[:cut])
+                self.wfile.flush()
+                self.connection.shutdown(2)
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client only wanted the headers
+            self.close_connection = True
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.state = {
+        'data': DATA,
+        'etag': '"v1"',
+        # bytes sent by the next response before dropping the connection
+        'cut': None,
+        # only drop a response to a range request
+        'ranged': False,
+        # honor range requests, Accept-Ranges is sent either way
+        'ranges': True,
+        'requests': [],
+        'lock': threading.Lock(),
+    }
+    httpd.url = 'http://127.0.0.1:%s/file.bin' % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(server, tmp_path, **kwargs):
+    return ResumableDownload(server.url,
+                             tmp_path / 'file.bin',
+                             partial_dir=tmp_path / 'partial',
+                             **kwargs).run()
+
+
+def _dropped(server, tmp_path, cut, **kwargs):
+    server.state['cut'] = cut
+    with pytest.raises(Exception):
+        _download(server, tmp_path, **kwargs)
+    assert not (tmp_path / 'file.bin').exists()
+    server.state['requests'].clear()
+
+
+def test_resume_single_stream(server, tmp_path):
+    _dropped(server, tmp_path, 1000 * 1000)
+
+    result = _download(server, tmp_path)
+    assert (tmp_path / 'file.bin').read_bytes() == DATA
+    assert 0 < result['resumed'] <= 1000 * 1000
+    assert server.state['requests'] == [
+        ('bytes=%s-%s' % (result['resumed'], len(DATA) - 1), '"v1"')]
+    # nothing left to resume
+    assert not [name for name in os.listdir(str(tmp_path / 'partial'))
+                if not name.endswith('.lock')]
+
+
+def test_resume_segments(server, tmp_path):
+    server.state['ranged'] = True
+    _dropped(server, tmp_path, 200 * 1000, segments=3, split_size=1)
+
+    result = _download(server, tmp_path, segments=3, split_size=1)
+    assert (tmp_path / 'file.bin').read_bytes() == DATA
+    assert result['segments'] == 3
+    assert result['resumed'] >= len(DATA) - 1000 * 1000
+    # only the rest of the dropped range is downloaded again
+    assert len(server.state['requests']) == 1
+    requested, if_range = server.state['requests'][0]
+    assert if_range == '"v1"'
+    assert requested.startswith('bytes=')
+
+
+def test_restart_changed(server, tmp_path):
+    _dropped(server, tmp_path, 500 * 1000)
+
+    server.state['data'] = DATA[::-1]
+    server.state['etag'] = '"v2"'
+    result = _download(server, tmp_path)
+    assert (tmp_path / 'file.bin').read_bytes() == DATA[::-1]
+    assert result['resumed'] == 0
+    # the If-Range of the resume got the whole changed file, which is
+    # downloaded again from the start
+    assert [if_range for _, if_range in server.state['requests']] == \
+        ['"v1"', None]
+
+
+def test_ranges_ignored(server, tmp_path):
+    # advertises Accept-Ranges, but answers range requests with the whole
+    # file
+    server.state['ranges'] = False
+    result = _download(server, tmp_path, segments=3, split_size=1)
+    assert (tmp_path / 'file.bin').read_bytes() == DATA
+    assert result['segments'] == 1
+    assert server.state['requests'][-1] == (None, None)
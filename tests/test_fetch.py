@@ -0,0 +1,134 @@
+import time
+import threading
+
+import pytest
+
+from pyatsimagebuilder.fetch import FetchError, FetchScheduler
+from pyatsimagebuilder.utils import run_async
+
+
+def _fetches(tmp_path, runs, source='http://artifacts.example.com/%s'):
+    return [{'source': source % i,
+             'target': tmp_path / ('file%s' % i),
+             'scheme': 'http',
+             'run': run} for i, run in enumerate(runs)]
+
+
+def _failing(errors):
+    # fails with each of errors in turn, then succeeds
+    calls = []
+
+    def run(parent_span):
+        calls.append(time.perf_counter())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'done'
+
+    return run, calls
+
+
+def test_retry(tmp_path):
+    scheduler = FetchScheduler(retries=3, backoff=0)
+    run, calls = _failing([FetchError('HTTP 503'), FetchError('HTTP 503')])
+
+    assert run_async(scheduler.run(_fetches(tmp_path, [run]))) == ['done']
+    assert len(calls) == 3
+    assert scheduler.summary()['artifacts.example.com']['retries'] == 2
+
+
+def test_retries_exhausted(tmp_path):
+    scheduler = FetchScheduler(retries=1, backoff=0)
+    run, calls = _failing([FetchError('HTTP 503')] * 3)
+
+    result, = run_async(scheduler.run(_fetches(tmp_path, [run])))
+    assert isinstance(result, FetchError)
+    assert len(calls) == 2
+
+
+def test_no_retry(tmp_path):
+    scheduler = FetchScheduler(retries=3, backoff=0)
+    run, calls = _failing([FetchError('HTTP 404', retry=False)])
+
+    result, = run_async(scheduler.run(_fetches(tmp_path, [run])))
+    assert isinstance(result, FetchError)
+    assert len(calls) == 1
+    summary = scheduler.summary()['artifacts.example.com']
+    assert (summary['fetches'], summary['retries'], summary['failed']) == \
+        (1, 0, 1)
+
+
+def test_retry_after(tmp_path):
+    # the wait is at least what the server asked for
+    scheduler = FetchScheduler(retries=1, backoff=0)
+    run, calls = _failing([FetchError('HTTP 429', delay=0.3)])
+
+    assert run_async(scheduler.run(_fetches(tmp_path, [run]))) == ['done']
+    assert calls[1] - calls[0] >= 0.3
+
+
+@pytest.mark.parametrize('host_limits, expected', [
+    ({}, 2),
+    ({'artifacts.example.com': 1}, 1),
+])
+def test_host_limit(tmp_path, host_limits, expected):
+    scheduler = FetchScheduler(host_limit=2, host_limits=host_limits)
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def run(parent_span):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.05)
+        with lock:
+            running['now'] -= 1
+
+    run_async(scheduler.run(_fetches(tmp_path, [run] * 6)))
+    assert running['max'] == expected
+
+
+def test_summary(tmp_path):
+    scheduler = FetchScheduler(backoff=0)
+
+    def run(parent_span):
+        time.sleep(0.01)
+        (tmp_path / 'file0').write_bytes(b'x' * 1000)
+
+    local = tmp_path / 'local'
+    local.write_bytes(b'y' * 10)
+    fetches = _fetches(tmp_path, [run]) + [{
+        'source': str(local),
+        'target': tmp_path / 'copy',
+        'scheme': 'local',
+        'run': lambda parent_span: (tmp_path / 'copy').write_bytes(b'y' * 10),
+    }]
+    run_async(scheduler.run(fetches))
+
+    summary = scheduler.summary()
+    assert sorted(summary) == ['artifacts.example.com', 'local']
+    http = summary['artifacts.example.com']
+    assert (http['fetches'], http['retries'], http['failed'], http['bytes']) \
+        == (1, 0, 0, 1000)
+    assert http['seconds'] >= 0.01
+    assert http['throughput'] == round(1000 / 1e6 / http['seconds'], 2)
+    assert summary['local']['bytes'] == 10
+
+
+def test_scp_share():
+    # 1 MB/s split between up to 4 scp copies and the downloads
+    scheduler = FetchScheduler(scheme_limits={'scp': 4}, bandwidth=1e6)
+    assert scheduler.scp_limit == int(2e5 * 8 / 1024)
+    assert FetchScheduler().scp_limit is None
+
+    bucket = scheduler._bucket
+    with scheduler.scp_transfer() as limit:
+        assert limit == scheduler.scp_limit
+        with scheduler.scp_transfer():
+            # downloads get what the scp copies leave
+            assert bucket.rate == pytest.approx(6e5)
+    assert bucket.rate == pytest.approx(1e6)
+
+
+def test_scp_unlimited():
+    with FetchScheduler().scp_transfer() as limit:
+        assert limit is None
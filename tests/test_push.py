@@ -0,0 +1,145 @@
+import io
+import time
+import types
+import tarfile
+import logging
+import urllib.request
+
+import pytest
+
+import docker
+
+from pyatsimagebuilder.image import Image
+
+REGISTRY_IMAGE = 'registry:2'
+
+
+class FailingAPI(object):
+    # docker api client whose push fails part way through
+    def __init__(self):
+        self.closed = False
+
+    def tag(self, image, tag):
+        return True
+
+    def inspect_distribution(self, tag, auth_config=None):
+        raise docker.errors.APIError('manifest unknown')
+
+    def inspect_image(self, image):
+        return {'RepoDigests': ['localhost:5000/test@sha256:1']}
+
+    def push(self, *args, **kwargs):
+        raise docker.errors.APIError('connection reset')
+
+    def close(self):
+        self.closed = True
+
+
+def test_push_closes_api(monkeypatch):
+    api = FailingAPI()
+    monkeypatch.setattr(docker, 'from_env',
+                        lambda: types.SimpleNamespace(api=api))
+
+    image = Image()
+    image.id = 'sha256:0'
+    with pytest.raises(docker.errors.APIError):
+        image.push('localhost:5000/test:latest')
+    assert api.closed
+
+
+def test_digests_close_api(monkeypatch):
+    api = FailingAPI()
+    monkeypatch.setattr(docker, 'from_env',
+                        lambda: types.SimpleNamespace(api=api))
+
+    image = Image()
+    image.id = 'sha256:0'
+    assert image.remote_digest('localhost:5000/test:latest') is None
+    assert api.closed
+
+    api.closed = False
+    assert image.local_digests('localhost:5000/test:latest') == ['sha256:1']
+    assert api.closed
+
+    # a client given by the caller is left open
+    api.closed = False
+    image.local_digests('localhost:5000/test:latest', api=api)
+    assert not api.closed
+
+
+@pytest.fixture(scope='module')
+def api():
+    try:
+        api = docker.from_env().api
+        api.ping()
+    except Exception as e:
+        pytest.skip('docker is not available: %s' % e)
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def registry(api):
+    try:
+        api.pull(REGISTRY_IMAGE)
+    except docker.errors.APIError as e:
+        pytest.skip('Could not pull %s: %s' % (REGISTRY_IMAGE, e))
+
+    container = api.create_container(
+        REGISTRY_IMAGE,
+        ports=[5000],
+        host_config=api.create_host_config(port_bindings={5000: None}))
+    api.start(container)
+    try:
+        port = api.port(container, 5000)[0]['HostPort']
+        # give the registry a moment to listen
+        for _ in range(50):
+            try:
+                urllib.request.urlopen('http://localhost:%s/v2/' % port,
+                                       timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.2)
+        yield 'localhost:%s' % port
+    finally:
+        api.remove_container(container, force=True)
+
+
+def _build(api):
+    # smallest image there is, without pulling a base image
+    dockerfile = b'FROM scratch\nCOPY hello /hello\n'
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode='w') as tar:
+        for name, data in (('Dockerfile', dockerfile),
+                           ('hello', b'%f\n' % time.time())):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    context.seek(0)
+
+    image_id = None
+    for line in api.build(fileobj=context, custom_context=True, rm=True,
+                          decode=True):
+        if 'errorDetail' in line:
+            raise Exception(line['errorDetail']['message'])
+        if 'aux' in line:
+            image_id = line['aux'].get('ID', image_id)
+    return image_id
+
+
+def test_push_skip_unchanged(api, registry, caplog):
+    image = Image(logger=logging.getLogger(__name__))
+    image.id = _build(api)
+    remote_tag = '%s/pyats-image-builder-test:latest' % registry
+    try:
+        assert image.push(remote_tag, api=api)
+
+        caplog.set_level(logging.DEBUG)
+        assert not image.push(remote_tag, api=api)
+        assert 'skipping push' in caplog.text
+        assert 'Layer already exists' not in caplog.text
+
+        # still pushed when asked to
+        assert image.push(remote_tag, skip_unchanged=False, api=api)
+    finally:
+        api.remove_image(image.id, force=True)
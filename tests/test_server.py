@@ -0,0 +1,82 @@
+import os
+import stat
+import logging
+import threading
+import http.client
+
+import pytest
+
+from pyatsimagebuilder.server import BuildServer, make_server, read_token
+
+TOKEN = 'test-token'
+AUTH = {'Authorization': 'Bearer %s' % TOKEN}
+
+
+@pytest.fixture
+def server():
+    build_server = BuildServer(cache_dir=None,
+                               logger=logging.getLogger(__name__))
+    httpd = make_server(build_server, TOKEN, host='127.0.0.1', port=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    build_server.shutdown()
+
+
+def _request(httpd, method, path, headers, body=None):
+    connection = http.client.HTTPConnection(*httpd.server_address)
+    try:
+        connection.request(method, path, body=body, headers=headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer nope'},
+                                     {'Authorization': TOKEN}])
+def test_token_required(server, headers):
+    assert _request(server, 'GET', '/', headers) == 401
+
+
+def test_token(server):
+    assert _request(server, 'GET', '/', AUTH) == 200
+
+
+@pytest.mark.parametrize('host, status', [('localhost', 200),
+                                          ('127.0.0.1', 200),
+                                          ('rebound.example', 403)])
+def test_host(server, host, status):
+    headers = dict(AUTH, Host='%s:%s' % (host, server.server_address[1]))
+    assert _request(server, 'GET', '/', headers) == status
+
+
+@pytest.mark.parametrize('content_type, status', [
+    ('text/plain', 415),
+    ('application/x-www-form-urlencoded', 415),
+    ('multipart/form-data; boundary=x', 415),
+    ('application/yaml', 400),
+    ('application/json', 400),
+])
+def test_content_type(server, content_type, status):
+    # schema violation, so accepted content types end with a 400
+    headers = dict(AUTH, **{'Content-Type': content_type})
+    assert _request(server, 'POST', '/builds', headers,
+                    b'{"tag": 3}') == status
+
+
+def test_unix_socket_permissions(tmp_path):
+    path = str(tmp_path / 'serve.sock')
+    httpd = make_server(None, TOKEN, unix_socket=path)
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    finally:
+        httpd.server_close()
+
+
+def test_read_token(tmp_path):
+    path = str(tmp_path / 'token')
+    token = read_token(path)
+    assert token and read_token(path) == token
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600